@@ -0,0 +1,268 @@
+"""
+Pipeline Benchmarks
+Purpose: Time and memory-profile every stage of main_pipeline.py and the
+         profiler on synthetic datasets of increasing size, and write the
+         results as JSON so runs can be compared across commits
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+from datetime import datetime
+
+# The pipeline modules live in src/
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+
+import numpy as np
+import pandas as pd
+
+from data_profiling import profile_dataframe
+from id_codes import IdDictionary
+from identity_rings import IdentityClusters
+from instrumentation import RunReport, peak_rss_bytes
+from memory_budget import downcast_tables
+from pipeline_stages import (
+    adjust_referral_timestamps, assign_source_category, build_report, detect_fraud,
+    clean_dimensions, join_referrals, normalize_text, process_dimensions, referrer_history
+)
+from query_report import query_report
+from report_sinks import REPORT_FILE_NAMES, report_path, write_report
+from schema import FACT_TABLE, TABLE_SCHEMAS
+from synthetic_data import generate_dataset, parse_size
+from table_cache import read_tables
+from velocity import add_velocity_features
+
+BENCHMARK_DIR = os.path.join(ROOT_DIR, 'benchmarks')
+DEFAULT_SIZES = '10k,100k'
+
+RESULTS_FORMAT_VERSION = 1
+
+
+def run_stage(report, name, func, *args, **kwargs):
+    """Run one stage under the report and record how many rows it produced"""
+    with report.stage(name) as record:
+        result = func(*args, **kwargs)
+        output = result[0] if isinstance(result, tuple) else result
+        if isinstance(output, pd.DataFrame):
+            record['rows_out'] = len(output)
+        elif isinstance(output, dict) and 'rows' in output:
+            record['rows_out'] = output['rows']  # a report writer's summary
+        elif isinstance(output, dict):
+            record['rows_out'] = sum(len(df) for df in output.values())
+    return result
+
+
+def run_stages(data_dir, output_dir, trace_memory=False):
+    """
+    Run STEP 1-10 and the per-table profiler once, stage by stage
+
+    STEP 10 writes the report in every output format to output_dir, and one
+    referrer is looked up in each through its index.
+
+    Returns:
+        list of stage records (see instrumentation.RunReport)
+    """
+    report = RunReport('benchmark', trace_memory=trace_memory)
+
+    def stage(name, func, *args, **kwargs):
+        return run_stage(report, name, func, *args, **kwargs)
+
+    table_names = list(TABLE_SCHEMAS)
+
+    tables, _ = stage('STEP 1 load (csv)', read_tables, data_dir, table_names, use_cache=False)
+    # Build the Arrow cache outside the measurement, then time a warm read
+    read_tables(data_dir, table_names, use_cache=True)
+    stage('STEP 1 load (table cache)', read_tables, data_dir, table_names, use_cache=True)
+    ids = IdDictionary()
+    encoded = stage('STEP 1 encode ids', ids.encode_tables, tables)
+    # What --memory-budget adds to STEP 1; the stages below use the encoded tables
+    stage('STEP 1 downcast', downcast_tables, encoded)
+
+    dims = stage('STEP 2 clean dimensions', clean_dimensions, encoded)
+    dims = stage('STEP 3 process dimensions', process_dimensions, dims)
+    df = stage('STEP 4 join', join_referrals, encoded[FACT_TABLE], dims)
+    df = stage('STEP 5 referral timestamps', adjust_referral_timestamps, df)
+    history = stage('STEP 5b referrer history', referrer_history, encoded[FACT_TABLE], dims)
+    df = stage('STEP 5b referrer velocity', add_velocity_features, df, history)
+    clusters = stage('STEP 5c identity graph', IdentityClusters, encoded[FACT_TABLE], dims, ids)
+    df = stage('STEP 5c identity clusters', clusters.assign, df)
+    df = stage('STEP 6 source category', assign_source_category, df)
+    df = stage('STEP 7 normalize text', normalize_text, df)
+    df = stage('STEP 8 fraud detection', detect_fraud, df)
+    final_df = stage('STEP 9 build report', build_report, df)
+    final_df = stage('STEP 10 decode ids', ids.decode_columns, final_df)
+
+    referrers = final_df['referrer_id'].dropna().iloc[:1].tolist()
+    for output_format in REPORT_FILE_NAMES:
+        path = report_path(output_dir, output_format)
+        stage(f'STEP 10 write {output_format}', write_report, final_df, path, output_format)
+        stage(f'query referrer ({output_format})', query_report, path, referrer_ids=referrers)
+
+    for table_name, table in tables.items():
+        stage(f'profile {table_name}', profile_dataframe, table, table_name)
+
+    report.close()
+    return report.stages
+
+
+def ensure_dataset(data_root, n_referrals, seed):
+    """
+    Generate the dataset for a size once and reuse it on later runs
+
+    Returns:
+        (data_dir, rows per table)
+    """
+    data_dir = os.path.join(data_root, f'referrals_{n_referrals}_seed{seed}')
+    manifest_path = os.path.join(data_dir, 'dataset.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            return data_dir, json.load(f)['rows']
+
+    print(f"  - Generating {n_referrals} referrals in {data_dir}...")
+    rows = generate_dataset(data_dir, n_referrals, seed)
+    with open(manifest_path, 'w') as f:
+        json.dump({'referrals': n_referrals, 'seed': seed, 'rows': rows}, f, indent=2)
+    return data_dir, rows
+
+
+def benchmark_size(data_dir, repeat, trace_memory):
+    """
+    Benchmark one dataset: repeat timed runs, then one traced run for memory
+
+    The timing runs do not trace allocations (tracemalloc slows Python-level
+    code considerably); the best of the repeats is reported per stage.
+    """
+    output_dir = os.path.join(data_dir, 'benchmark_output')
+    os.makedirs(output_dir, exist_ok=True)
+    runs = [run_stages(data_dir, output_dir) for _ in range(repeat)]
+
+    stages = []
+    for records in zip(*runs):
+        stages.append({
+            'stage': records[0]['stage'],
+            'seconds': min(record['seconds'] for record in records),
+            'cpu_seconds': min(record['cpu_seconds'] for record in records),
+            'seconds_all': [record['seconds'] for record in records],
+            'rows_out': records[0].get('rows_out'),
+        })
+
+    if trace_memory:
+        traced = run_stages(data_dir, output_dir, trace_memory=True)
+        for summary, record in zip(stages, traced):
+            summary['peak_traced_bytes'] = record['peak_traced_bytes']
+
+    shutil.rmtree(output_dir)
+    return stages
+
+
+def environment_info():
+    """Interpreter, library and commit details stored with the results"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                    cwd=ROOT_DIR, capture_output=True, text=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+
+    try:
+        import pyarrow
+        pyarrow_version = pyarrow.__version__
+    except ImportError:
+        pyarrow_version = None
+
+    return {
+        'git_commit': commit,
+        'git_dirty': dirty,
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'pyarrow': pyarrow_version,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def compare_results(current, baseline_path):
+    """Print the seconds ratio current/baseline for every stage both runs measured"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    previous = {
+        (result['referrals'], stage['stage']): stage['seconds']
+        for result in baseline['results'] for stage in result['stages']
+    }
+    print(f"\nComparison with {baseline_path} (commit {baseline['environment']['git_commit']}):")
+    for result in current['results']:
+        for stage in result['stages']:
+            before = previous.get((result['referrals'], stage['stage']))
+            if before:
+                print(f"  {result['referrals']:>10} {stage['stage']:<32} "
+                      f"{before:9.3f}s -> {stage['seconds']:9.3f}s  x{stage['seconds'] / before:.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic data.")
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help="comma-separated referral counts, e.g. 10k,1m,10m (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="timed runs per size; the fastest is reported (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0, help="random seed (default: %(default)s)")
+    parser.add_argument('--data-root', default=os.path.join(BENCHMARK_DIR, 'data'),
+                        help="where generated datasets are kept (default: benchmarks/data)")
+    parser.add_argument('--output', help="results file (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument('--no-memory', dest='trace_memory', action='store_false',
+                        help="skip the tracemalloc run")
+    parser.add_argument('--compare', metavar='RESULTS_JSON',
+                        help="earlier results file to compare stage timings against")
+    args = parser.parse_args(argv)
+
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+    output = args.output or os.path.join(
+        BENCHMARK_DIR, 'results', f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    )
+
+    results = {
+        'format_version': RESULTS_FORMAT_VERSION,
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'environment': environment_info(),
+        'settings': {'repeat': args.repeat, 'seed': args.seed, 'trace_memory': args.trace_memory},
+        'results': [],
+    }
+
+    print("=" * 80)
+    print("PIPELINE BENCHMARKS")
+    print("=" * 80)
+    for n_referrals in sizes:
+        print(f"\nSize: {n_referrals} referrals")
+        data_dir, rows = ensure_dataset(args.data_root, n_referrals, args.seed)
+        stages = benchmark_size(data_dir, args.repeat, args.trace_memory)
+        for stage in stages:
+            memory = (f"  peak {stage['peak_traced_bytes'] / 2**20:9.1f} MB"
+                      if 'peak_traced_bytes' in stage else '')
+            print(f"  - {stage['stage']:<32} {stage['seconds']:9.3f}s{memory}")
+        results['results'].append({
+            'referrals': n_referrals,
+            'input_rows': rows,
+            'stages': stages,
+            'total_seconds': sum(stage['seconds'] for stage in stages),
+            'peak_rss_bytes': peak_rss_bytes(),
+        })
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\n✓ Results saved to: {output}")
+
+    if args.compare:
+        compare_results(results, args.compare)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
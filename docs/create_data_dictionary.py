@@ -1,12 +1,20 @@
 """
 Data Dictionary Generator
-Purpose: Create comprehensive data dictionary for business users
+Purpose: Create comprehensive data dictionary for business users,
+         generated from the schema registry (src/schema.py) and the
+         fraud rule registry (src/fraud_rules.py)
 """
 
 import pandas as pd
 import os
 import sys
 
+# The schema registry and fraud rules live in src/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from fraud_rules import FRAUD_RULES
+from schema import REPORT_SCHEMA, TABLE_SCHEMAS
+
 print("=" * 80)
 print("DATA DICTIONARY GENERATOR")
 print("=" * 80)
@@ -26,152 +34,14 @@ except Exception as e:
 
 print("Building data dictionary...")
 
-# Define data dictionary
+# Build the report dictionary from the schema registry
 data_dictionary = {
-    'Column Name': [
-        'referral_details_id',
-        'referral_id',
-        'referral_source',
-        'referral_source_category',
-        'referral_at',
-        'referrer_id',
-        'referrer_name',
-        'referrer_phone_number',
-        'referrer_homeclub',
-        'referee_id',
-        'referee_name',
-        'referee_phone',
-        'referral_status',
-        'num_reward_days',
-        'transaction_id',
-        'transaction_status',
-        'transaction_at',
-        'transaction_location',
-        'transaction_type',
-        'updated_at',
-        'reward_granted_at',
-        'is_business_logic_valid'
-    ],
-    'Data Type': [
-        'INTEGER',
-        'TEXT',
-        'TEXT',
-        'TEXT',
-        'DATETIME',
-        'TEXT',
-        'TEXT',
-        'TEXT',
-        'TEXT',
-        'TEXT',
-        'TEXT',
-        'TEXT',
-        'TEXT',
-        'INTEGER',
-        'TEXT',
-        'TEXT',
-        'DATETIME',
-        'TEXT',
-        'TEXT',
-        'DATETIME',
-        'DATETIME',
-        'BOOLEAN'
-    ],
-    'Description': [
-        'Unique identifier for each referral detail record. This is an auto-generated number.',
-        'Unique code assigned to each referral. This is the main identifier for tracking a referral.',
-        'How the referral was made. Values: "User Sign Up" (online), "Draft Transaction" (in-store), or "Lead" (marketing campaign).',
-        'Simplified category of referral source. Values: "Online" or "Offline".',
-        'The exact date and time when the referral was created (in local timezone).',
-        'Unique identifier of the person who referred the new user.',
-        'Full name of the person who referred the new user.',
-        'Contact phone number of the person who made the referral.',
-        'The gym location where the referrer is a member.',
-        'Unique identifier of the person who was referred (new user).',
-        'Full name of the person who was referred.',
-        'Contact phone number of the person who was referred.',
-        'Current status of the referral. Values: "Berhasil" (Successful), "Menunggu" (Pending), "Tidak Berhasil" (Failed).',
-        'Number of days awarded as reward. For example, 10 means 10 days free membership.',
-        'Unique code of the transaction linked to this referral.',
-        'Payment status of the transaction. Value: "Paid" or "No Transaction".',
-        'The exact date and time when the transaction was completed (in local timezone).',
-        'The gym location where the transaction took place.',
-        'Type of transaction. Values: "New" (new membership) or "Rejoin" (returning member).',
-        'The date and time when the referral record was last updated.',
-        'The date and time when the reward was actually given to the referee.',
-        'Indicates if this referral passed all fraud detection checks. TRUE = Valid referral, FALSE = Potential fraud detected.'
-    ],
-    'Business Rules': [
-        'Always unique. System-generated.',
-        'Always unique. Cannot be null.',
-        'Must be one of three values: User Sign Up, Draft Transaction, or Lead.',
-        'Derived from referral_source. Either Online or Offline.',
-        'Cannot be null. Must be a valid date/time.',
-        'Must exist in user system. Can be null for some transaction types.',
-        'Formatted in Title Case (First Letter Capitalized).',
-        'Valid phone number format.',
-        'Must be a valid gym location. UPPERCASE format preserved.',
-        'Can be null if referral source is not "Lead".',
-        'Formatted in Title Case.',
-        'Valid phone number format.',
-        'Must be one of: Berhasil, Menunggu, or Tidak Berhasil.',
-        'Zero or positive integer. Zero means no reward.',
-        'Can be null if transaction has not occurred yet.',
-        'Either "Paid" or "No Transaction".',
-        'Can be null if no transaction yet. Must be after referral_at.',
-        'Must be a valid gym location.',
-        'Either "New" or "Rejoin" or "No Transaction".',
-        'Must be same or after referral_at.',
-        'Only filled when reward is actually granted.',
-        'TRUE if all fraud checks passed, FALSE otherwise.'
-    ],
-    'Example Values': [
-        '1, 2, 3, 4...',
-        '9331c8f144dad5a3b8e4a10467b4343a',
-        'User Sign Up, Draft Transaction, Lead',
-        'Online, Offline',
-        '2024-05-15 14:35:00',
-        '2c71c5d66c7e12a0b3c200ba6ed3b78e',
-        'John Doe, Jane Smith',
-        '123-456-7890, 987-654-3210',
-        'PERMATA HIJAU, BENHIL, BLOK M',
-        'f12348hbsdkjkfhkjdf',
-        'Michael Johnson, Sarah Williams',
-        '555-123-4567',
-        'Berhasil, Menunggu, Tidak Berhasil',
-        '0, 10, 15, 20',
-        '1d1eb8a9e864a1cccb2d850398461807',
-        'Paid, No Transaction',
-        '2024-05-20 10:00:00',
-        'BENHIL, ARTERI PONDOK INDAH',
-        'New, Rejoin, No Transaction',
-        '2024-05-21 12:00:00',
-        '2024-05-30 14:00:00',
-        'TRUE, FALSE'
-    ],
-    'Used By': [
-        'System tracking and reporting',
-        'Customer service, Operations team',
-        'Marketing team for campaign analysis',
-        'Marketing team for channel analysis',
-        'Operations team for timeline tracking',
-        'Customer service, Rewards team',
-        'Customer service for contact',
-        'Customer service for contact',
-        'Operations team for location analysis',
-        'Customer service, Operations team',
-        'Customer service for contact',
-        'Customer service for contact',
-        'Rewards team for approval workflow',
-        'Rewards team for reward distribution',
-        'Finance team for payment tracking',
-        'Finance team for payment verification',
-        'Finance team for transaction tracking',
-        'Operations team for location analysis',
-        'Operations team for membership type',
-        'System audit and tracking',
-        'Rewards team for fulfillment tracking',
-        'Fraud detection team, Compliance team'
-    ]
+    'Column Name': [column.name for column in REPORT_SCHEMA],
+    'Data Type': [column.data_type for column in REPORT_SCHEMA],
+    'Description': [column.description for column in REPORT_SCHEMA],
+    'Business Rules': [column.business_rules for column in REPORT_SCHEMA],
+    'Example Values': [column.example_values for column in REPORT_SCHEMA],
+    'Used By': [column.used_by for column in REPORT_SCHEMA]
 }
 
 print(f"  - Main dictionary created with {len(data_dictionary['Column Name'])} columns")
@@ -180,6 +50,25 @@ print(f"  - Main dictionary created with {len(data_dictionary['Column Name'])} c
 df_dict = pd.DataFrame(data_dictionary)
 print(f"  ✓ Dictionary DataFrame created")
 
+# Input tables, one row per source column
+input_tables = {
+    'Table Name': [],
+    'File': [],
+    'Column Name': [],
+    'Type': [],
+    'Description': []
+}
+for table_name, table_schema in TABLE_SCHEMAS.items():
+    for column_name, column in table_schema.columns.items():
+        input_tables['Table Name'].append(table_name)
+        input_tables['File'].append(table_schema.file_name)
+        input_tables['Column Name'].append(column_name)
+        input_tables['Type'].append(column.kind)
+        input_tables['Description'].append(column.description)
+
+df_input_tables = pd.DataFrame(input_tables)
+print(f"  ✓ Input tables sheet created with {len(df_input_tables)} source columns")
+
 # Create explanation sheet
 explanation = {
     'Section': [
@@ -205,41 +94,13 @@ explanation = {
 df_explanation = pd.DataFrame(explanation)
 print(f"  ✓ Explanation sheet created")
 
-# Fraud detection rules
+# Fraud detection rules, in the order they are evaluated
 fraud_rules = {
-    'Check Type': [
-        'Reward Without Success',
-        'Reward Without Transaction',
-        'Transaction Without Reward',
-        'Success Without Reward',
-        'Transaction Before Referral',
-        'Expired Membership',
-        'Deleted Account',
-        'Different Month',
-        'Reward Not Granted'
-    ],
-    'Description': [
-        'A reward was assigned but the referral status is not "Berhasil" (Successful).',
-        'A reward was assigned but there is no transaction ID linked to the referral.',
-        'A paid transaction exists but no reward was assigned to the referrer.',
-        'The referral status is "Berhasil" but the reward value is zero or null.',
-        'The transaction date is before the referral creation date (impossible scenario).',
-        'The referrer\'s membership had expired when the referral was made.',
-        'The referrer\'s account has been deleted.',
-        'The transaction occurred in a different month than the referral.',
-        'The reward has not been granted even though the referral is successful.'
-    ],
-    'Action Required': [
-        'Review by Compliance team',
-        'Review by Operations team',
-        'Review by Rewards team',
-        'Review by Rewards team',
-        'Investigate - Critical issue',
-        'Review eligibility',
-        'Investigate account status',
-        'Review reward policy',
-        'Process reward distribution'
-    ]
+    'Bit': list(range(len(FRAUD_RULES))),
+    'Check Type': [rule.name.replace('_', ' ').title() for rule in FRAUD_RULES],
+    'Fraud Reason': [rule.reason for rule in FRAUD_RULES],
+    'Description': [rule.description for rule in FRAUD_RULES],
+    'Action Required': [rule.action for rule in FRAUD_RULES]
 }
 
 df_fraud_rules = pd.DataFrame(fraud_rules)
@@ -260,6 +121,10 @@ try:
         print("  - Writing 'Data Dictionary' sheet...")
         df_dict.to_excel(writer, sheet_name='Data Dictionary', index=False)
         
+        # Write input tables
+        print("  - Writing 'Input Tables' sheet...")
+        df_input_tables.to_excel(writer, sheet_name='Input Tables', index=False)
+        
         # Write fraud rules
         print("  - Writing 'Fraud Detection Rules' sheet...")
         df_fraud_rules.to_excel(writer, sheet_name='Fraud Detection Rules', index=False)
@@ -287,8 +152,9 @@ try:
     print("=" * 80)
     print("\nThe dictionary includes:")
     print("  - How to Use: Guide for business users")
-    print("  - Data Dictionary: Complete column definitions (22 columns)")
-    print("  - Fraud Detection Rules: Explanation of validation checks (9 rules)")
+    print(f"  - Data Dictionary: Complete column definitions ({len(df_dict)} columns)")
+    print(f"  - Input Tables: Source columns and their types ({len(df_input_tables)} columns)")
+    print(f"  - Fraud Detection Rules: Explanation of validation checks ({len(df_fraud_rules)} rules)")
     print()
     print("Script completed successfully!")
     
@@ -297,6 +163,3 @@ except Exception as e:
     import traceback
     traceback.print_exc()
     sys.exit(1)
-
-print("\nPress Enter to exit...")
-input()
\ No newline at end of file
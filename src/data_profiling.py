@@ -4,129 +4,145 @@ Purpose: Profile all CSV tables to understand data quality and structure
 Author: Data Engineer Intern
 """
 
+import argparse
 import pandas as pd
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import sys
 
-print("Script started...")
-print(f"Python version: {sys.version}")
-print(f"Pandas version: {pd.__version__}")
-print(f"Current working directory: {os.getcwd()}")
-print()
-
-# Define data directory
-DATA_DIR = 'data'
-OUTPUT_DIR = 'output'
-
-print(f"Looking for data in: {os.path.abspath(DATA_DIR)}")
-print(f"Output will be saved to: {os.path.abspath(OUTPUT_DIR)}")
-print()
-
-# Create output directory if it doesn't exist
-try:
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
-    print(f"✓ Output directory ready: {OUTPUT_DIR}")
-except Exception as e:
-    print(f"✗ Error creating output directory: {e}")
-    sys.exit(1)
-
-# Check if data directory exists
-if not os.path.exists(DATA_DIR):
-    print(f"✗ ERROR: Data directory not found: {DATA_DIR}")
-    print(f"Please create '{DATA_DIR}' folder and place CSV files there.")
-    sys.exit(1)
-else:
-    print(f"✓ Data directory found: {DATA_DIR}")
-    print(f"  Contents: {os.listdir(DATA_DIR)}")
-    print()
+import profile_cache
+from instrumentation import RunReport
+from profile_writers import PROFILE_WRITERS, write_profile
+from schema import TABLE_SCHEMAS, input_path, read_csv_appended
+from table_cache import read_table
+from table_profiler import TableProfiler
+
+RUN_REPORT_FILE_NAME = 'data_profiling_run_report.json'
+
+# Parallel runs split tables wider than this into column groups of this size
+COLUMNS_PER_TASK = 8
 
-# List of all CSV files to profile
-csv_files = {
-    'lead_log': 'lead_log(in).csv',
-    'user_referrals': 'user_referrals(in).csv',
-    'user_referral_logs': 'user_referral_logs(in).csv',
-    'user_logs': 'user_logs(in).csv',
-    'user_referral_statuses': 'user_referral_statuses(in).csv',
-    'referral_rewards': 'referral_rewards(in).csv',
-    'paid_transactions': 'paid_transactions(in).csv'
-}
-
-def profile_dataframe(df, table_name):
+def profile_dataframe(df, table_name, approximate=False):
     """
     Profile a single dataframe and return profiling statistics
     
     Args:
         df: pandas DataFrame to profile
         table_name: name of the table
+        approximate: estimate distinct counts with HyperLogLog and take
+                     sample values from a reservoir sample
         
     Returns:
         DataFrame with profiling information
     """
-    profile_data = []
-    
-    for column in df.columns:
-        # Calculate statistics
-        total_rows = len(df)
-        null_count = df[column].isnull().sum()
-        null_percentage = (null_count / total_rows) * 100
-        distinct_count = df[column].nunique()
-        data_type = str(df[column].dtype)
-        
-        # Sample values (first 3 non-null unique values)
-        sample_values = df[column].dropna().unique()[:3]
-        sample_str = ', '.join([str(v) for v in sample_values])
-        
-        profile_data.append({
-            'Table Name': table_name,
-            'Column Name': column,
-            'Data Type': data_type,
-            'Total Rows': total_rows,
-            'Null Count': null_count,
-            'Null Percentage': round(null_percentage, 2),
-            'Distinct Count': distinct_count,
-            'Sample Values': sample_str
-        })
-    
-    return pd.DataFrame(profile_data)
+    profiler = TableProfiler(table_name, approximate)
+    profiler.update(df)
+    return profiler.to_frame()
 
-def main():
+def profile_table(data_dir, table_name, approximate=False, chunk_size=None, columns=None,
+                  appended_from=None):
     """
-    Main function to profile all tables
+    Read and profile one input table
+
+    Args:
+        data_dir: directory holding the input CSV files
+        table_name: key in TABLE_SCHEMAS
+        approximate: see profile_dataframe
+        chunk_size: read and profile the CSV this many rows at a time, so
+                    memory stays bounded by the chunk size (use with
+                    approximate=True for tables with many distinct values)
+        columns: profile (and read) only these columns
+        appended_from: profile only the rows after this byte offset
+                       (see profile_cache.lookup)
+
+    Returns:
+        TableProfiler
+    """
+    profiler = TableProfiler(table_name, approximate)
+    if appended_from is not None:
+        data = read_csv_appended(data_dir, table_name, appended_from, columns, chunk_size)
+    else:
+        data = read_table(data_dir, table_name, columns=columns, chunksize=chunk_size)
+    for chunk in [data] if chunk_size is None else data:
+        profiler.update(chunk)
+    return profiler
+
+def lookup_cached_profile(data_dir, table_name, approximate, report):
+    """profile_cache.lookup recorded as a report stage"""
+    with report.stage(f'cache lookup {table_name}') as stage:
+        cached = profile_cache.lookup(data_dir, table_name, approximate)
+        stage['cache'] = cached.status
+    return cached
+
+def _profile_task(data_dir, table_name, columns, approximate, chunk_size, appended_from):
+    """profile_table in a worker process; also returns the time it took"""
+    started = time.perf_counter()
+    profiler = profile_table(data_dir, table_name, approximate, chunk_size, columns, appended_from)
+    return profiler, time.perf_counter() - started
+
+def profile_tables_serial(data_dir, table_names, report, approximate=False, chunk_size=None,
+                          use_cache=True):
+    """
+    Profile tables one after another
+
+    Returns:
+        list of profile DataFrames in table_names order (failed tables are skipped)
     """
-    print("=" * 80)
-    print("DATA PROFILING STARTED")
-    print("=" * 80)
-    print(f"Timestamp: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    print()
-    
     all_profiles = []
-    
+
     # Profile each CSV file
-    for table_name, filename in csv_files.items():
-        filepath = os.path.join(DATA_DIR, filename)
+    for table_name in table_names:
+        filename = TABLE_SCHEMAS[table_name].file_name
+        filepath = input_path(data_dir, table_name)
         
         print(f"Profiling: {table_name} ({filename})")
         print(f"  Path: {filepath}")
         
-        # Check if file exists
-        if not os.path.exists(filepath):
-            print(f"  ✗ File not found: {filepath}")
-            print()
-            continue
-        
         try:
-            # Read CSV file
-            print(f"  - Reading CSV...")
-            df = pd.read_csv(filepath)
-            print(f"  - CSV loaded: {len(df)} rows, {len(df.columns)} columns")
-            
-            # Profile the dataframe
-            print(f"  - Profiling...")
-            profile_df = profile_dataframe(df, table_name)
-            all_profiles.append(profile_df)
+            cached = lookup_cached_profile(data_dir, table_name, approximate, report) if use_cache else None
+            if cached is not None and cached.status == 'hit':
+                print(f"  - Unchanged since the last run, using the cached profile")
+                profiler = cached.profiler
+            elif cached is not None and cached.status == 'appended':
+                # Only the new rows of an append-only table are read
+                print(f"  - Profiling the rows appended since the last run...")
+                with report.stage(f'profile {table_name} appended rows') as stage:
+                    appended = profile_table(data_dir, table_name, approximate, chunk_size,
+                                             appended_from=cached.appended_from)
+                    profiler = cached.profiler
+                    profiler.merge_rows(appended)
+                    stage['rows_in'] = appended.total_rows
+                    stage['rows_out'] = len(profiler.columns)
+                print(f"  - Appended rows: {appended.total_rows}")
+            elif chunk_size is not None:
+                # Read and profile chunk by chunk; the table is never fully in memory
+                print(f"  - Profiling in chunks of {chunk_size} rows...")
+                with report.stage(f'profile {table_name}') as stage:
+                    profiler = profile_table(data_dir, table_name, approximate, chunk_size)
+                    stage['rows_in'] = profiler.total_rows
+                    stage['rows_out'] = len(profiler.columns)
+            else:
+                # Read CSV file
+                print(f"  - Reading CSV with schema types...")
+                with report.stage(f'load {table_name}') as stage:
+                    df = read_table(data_dir, table_name)
+                    stage['rows_out'] = len(df)
+                print(f"  - CSV loaded: {len(df)} rows, {len(df.columns)} columns")
+
+                # Profile the dataframe
+                print(f"  - Profiling...")
+                with report.stage(f'profile {table_name}', rows_in=len(df)) as stage:
+                    profiler = TableProfiler(table_name, approximate)
+                    profiler.update(df)
+                    stage['rows_out'] = len(profiler.columns)
+
+            if cached is not None and cached.status != 'hit':
+                profile_cache.store(data_dir, table_name, cached.fingerprint, profiler)
+            all_profiles.append(profiler.to_frame())
             
-            print(f"  ✓ Rows: {len(df)}, Columns: {len(df.columns)}")
+            print(f"  ✓ Rows: {profiler.total_rows}, Columns: {len(profiler.columns)}")
             print()
             
         except Exception as e:
@@ -134,6 +150,203 @@ def main():
             import traceback
             traceback.print_exc()
             print()
+
+    return all_profiles
+
+def profile_tables_parallel(data_dir, table_names, report, approximate=False, chunk_size=None,
+                            workers=None, use_cache=True):
+    """
+    Profile tables in a process pool: one task per table, or per group of
+    COLUMNS_PER_TASK columns for wider tables
+
+    Tables found unchanged in the profile cache are not read; append-only
+    tables that only grew get one task for their new rows.
+
+    Returns:
+        list of profile DataFrames in table_names order (failed tables are skipped)
+    """
+    cached = {table_name: lookup_cached_profile(data_dir, table_name, approximate, report)
+              if use_cache else None for table_name in table_names}
+
+    # (columns, appended_from) of every task, per table
+    tasks = {}
+    for table_name in table_names:
+        entry = cached[table_name]
+        if entry is not None and entry.status == 'hit':
+            tasks[table_name] = []
+        elif entry is not None and entry.status == 'appended':
+            tasks[table_name] = [(None, entry.appended_from)]
+        else:
+            columns = list(TABLE_SCHEMAS[table_name].columns)
+            groups = ([columns[i:i + COLUMNS_PER_TASK] for i in range(0, len(columns), COLUMNS_PER_TASK)]
+                      if len(columns) > COLUMNS_PER_TASK else [None])
+            tasks[table_name] = [(group, None) for group in groups]
+
+    print(f"Profiling {len(table_names)} tables in {workers} processes "
+          f"({sum(len(table_tasks) for table_tasks in tasks.values())} tasks)...")
+    print()
+    profiles = []
+    with report.stage('profile tables') as stage:
+        stage['workers'] = workers
+        stage['tables'] = {}
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                table_name: [pool.submit(_profile_task, data_dir, table_name, columns,
+                                         approximate, chunk_size, appended_from)
+                             for columns, appended_from in table_tasks]
+                for table_name, table_tasks in tasks.items()
+            }
+            for table_name, table_futures in futures.items():
+                try:
+                    results = [future.result() for future in table_futures]
+                except Exception as e:
+                    print(f"  ✗ Error profiling {table_name}: {str(e)}")
+                    continue
+
+                entry = cached[table_name]
+                if entry is not None and entry.status != 'miss':
+                    profiler = entry.profiler
+                    for appended, _ in results:
+                        profiler.merge_rows(appended)
+                else:
+                    profiler = TableProfiler(table_name, approximate)
+                    for group, _ in results:
+                        profiler.merge_columns(group)
+                if entry is not None and entry.status != 'hit':
+                    profile_cache.store(data_dir, table_name, entry.fingerprint, profiler)
+
+                seconds = sum(task_seconds for _, task_seconds in results)
+                profiles.append(profiler.to_frame())
+                stage['tables'][table_name] = {
+                    'rows': profiler.total_rows, 'seconds': seconds, 'tasks': len(results),
+                    'cache': entry.status if entry is not None else None,
+                }
+                source = f" ({entry.status} in cache)" if entry is not None and entry.status != 'miss' else ''
+                print(f"  ✓ {table_name}: {profiler.total_rows} rows, {len(profiler.columns)} columns "
+                      f"in {seconds:.3f}s{source}")
+        stage['rows_in'] = sum(table['rows'] for table in stage['tables'].values())
+        stage['rows_out'] = sum(len(profile_df) for profile_df in profiles)
+    print()
+    return profiles
+
+def prepare_directories(data_dir, output_dir):
+    """
+    Check the data directory and create the output directory
+
+    Returns:
+        True when profiling can start
+    """
+    print(f"Looking for data in: {os.path.abspath(data_dir)}")
+    print(f"Output will be saved to: {os.path.abspath(output_dir)}")
+    print()
+
+    # Create output directory if it doesn't exist
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        print(f"✓ Output directory ready: {output_dir}")
+    except Exception as e:
+        print(f"✗ Error creating output directory: {e}")
+        return False
+
+    # Check if data directory exists
+    if not os.path.exists(data_dir):
+        print(f"✗ ERROR: Data directory not found: {data_dir}")
+        print(f"Please create '{data_dir}' folder and place CSV files there.")
+        return False
+
+    print(f"✓ Data directory found: {data_dir}")
+    print(f"  Contents: {os.listdir(data_dir)}")
+    print()
+    return True
+
+def main(data_dir='data', output_dir='output', trace_memory=False, profile_stage=None,
+         approximate=False, chunk_size=None, workers=1, formats=('xlsx',), use_cache=True):
+    """
+    Main function to profile all tables
+
+    Args:
+        data_dir: directory holding the input CSV files
+        output_dir: directory for data_profiling_report.xlsx and the run report
+        trace_memory: record tracemalloc peaks per stage in the run report
+        profile_stage: stage to run under cProfile, e.g. 'profile user_referrals'
+        approximate: approximate distinct counts and sampled values (see profile_dataframe)
+        chunk_size: profile each table this many rows at a time (see profile_table)
+        workers: processes profiling tables in parallel (None: one per CPU)
+        formats: report formats to write, keys of PROFILE_WRITERS
+        use_cache: reuse (and update) per-table profiles from the profile
+                   cache in data_dir (see profile_cache.py)
+
+    Returns:
+        Combined profile DataFrame, or None if nothing was profiled
+    """
+    print("Script started...")
+    print(f"Python version: {sys.version}")
+    print(f"Pandas version: {pd.__version__}")
+    print(f"Current working directory: {os.getcwd()}")
+    print()
+
+    if not prepare_directories(data_dir, output_dir):
+        return None
+
+    report = RunReport('data_profiling', trace_memory=trace_memory,
+                       profile_stage=profile_stage, profile_dir=output_dir)
+    report.details['approximate'] = approximate
+    report.details['chunk_size'] = chunk_size
+    report.details['workers'] = workers
+    report.details['formats'] = list(formats)
+    report.details['use_cache'] = use_cache
+    report_file = os.path.join(output_dir, RUN_REPORT_FILE_NAME)
+    try:
+        return profile_tables(data_dir, output_dir, report, approximate, chunk_size,
+                              workers, formats, use_cache)
+    finally:
+        report.write(report_file)
+        print(f"✓ Run report saved to: {report_file}")
+
+def profile_tables(data_dir, output_dir, report, approximate=False, chunk_size=None,
+                   workers=1, formats=('xlsx',), use_cache=True):
+    """
+    Profile every input table and save the report
+
+    Args:
+        data_dir: directory holding the input CSV files
+        output_dir: directory for data_profiling_report.<format>
+        report: RunReport receiving one load and one profile stage per table
+                (one combined profile stage per table when chunked, one
+                stage for all tables when parallel) and one write stage
+                per format
+        approximate: approximate distinct counts and sampled values
+        chunk_size: profile each table this many rows at a time
+        workers: processes profiling tables in parallel (None: one per CPU)
+        formats: report formats to write, keys of PROFILE_WRITERS
+        use_cache: reuse (and update) per-table profiles from the profile cache
+
+    Returns:
+        Combined profile DataFrame, or None if nothing was profiled
+    """
+    print("=" * 80)
+    print("DATA PROFILING STARTED")
+    print("=" * 80)
+    print(f"Timestamp: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    print()
+
+    # Check which CSV files exist
+    table_names = []
+    for table_name in TABLE_SCHEMAS:
+        filepath = input_path(data_dir, table_name)
+        if os.path.exists(filepath):
+            table_names.append(table_name)
+        else:
+            print(f"✗ File not found for {table_name}: {filepath}")
+            print()
+
+    workers = min(workers or os.cpu_count() or 1, max(len(table_names), 1))
+    if workers > 1:
+        all_profiles = profile_tables_parallel(data_dir, table_names, report, approximate,
+                                               chunk_size, workers, use_cache)
+    else:
+        all_profiles = profile_tables_serial(data_dir, table_names, report, approximate,
+                                             chunk_size, use_cache)
     
     # Combine all profiles
     if all_profiles:
@@ -141,33 +354,21 @@ def main():
         combined_profile = pd.concat(all_profiles, ignore_index=True)
         print(f"Total profile records: {len(combined_profile)}")
         
-        # Save to Excel
-        output_file = os.path.join(OUTPUT_DIR, 'data_profiling_report.xlsx')
-        print(f"Saving to: {output_file}")
-        
         try:
-            with pd.ExcelWriter(output_file, engine='openpyxl') as writer:
-                # Write combined profile
-                print("  - Writing 'All Tables Profile' sheet...")
-                combined_profile.to_excel(writer, sheet_name='All Tables Profile', index=False)
-                
-                # Write individual table profiles
-                for table_name in csv_files.keys():
-                    table_profile = combined_profile[combined_profile['Table Name'] == table_name]
-                    if not table_profile.empty:
-                        sheet_name = table_name[:31]  # Excel sheet name limit
-                        print(f"  - Writing '{sheet_name}' sheet...")
-                        table_profile.to_excel(writer, sheet_name=sheet_name, index=False)
-            
+            for output_format in formats:
+                with report.stage(f'write {output_format}', rows_in=len(combined_profile)):
+                    print(f"  - Writing {output_format}...")
+                    output_file = write_profile(combined_profile, output_dir, output_format)
+                print(f"  ✓ Report saved to: {output_file}")
+
             print()
             print("=" * 80)
             print(f"✓ Profiling completed successfully!")
-            print(f"✓ Report saved to: {output_file}")
             print("=" * 80)
             
             # Print summary statistics
             print("\nSUMMARY:")
-            print(f"Total tables profiled: {len(csv_files)}")
+            print(f"Total tables profiled: {len(TABLE_SCHEMAS)}")
             print(f"Total columns profiled: {len(combined_profile)}")
             print(f"\nTables with null values:")
             
@@ -181,7 +382,7 @@ def main():
             print("Script completed successfully!")
             
         except Exception as e:
-            print(f"✗ Error saving Excel file: {e}")
+            print(f"✗ Error saving the report: {e}")
             import traceback
             traceback.print_exc()
     
@@ -189,15 +390,53 @@ def main():
         print("=" * 80)
         print("✗ No profiles generated. Check for errors above.")
         print("=" * 80)
+        return None
+
+    return combined_profile
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile every input table into an Excel report.")
+    parser.add_argument('--data-dir', default='data',
+                        help="directory holding the input CSV files (default: %(default)s)")
+    parser.add_argument('--output-dir', default='output',
+                        help="directory for data_profiling_report.xlsx (default: %(default)s)")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="record tracemalloc peaks per stage in the run report")
+    parser.add_argument('--profile-stage', metavar='STAGE',
+                        help="run one stage under cProfile, e.g. 'profile user_referrals'")
+    parser.add_argument('--approximate', action='store_true',
+                        help="estimate distinct counts with HyperLogLog and sample values "
+                             "from a reservoir (fixed memory per column)")
+    parser.add_argument('--chunk-size', type=int,
+                        help="read and profile each table this many rows at a time")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="processes profiling tables (and column groups of wide tables) "
+                             "in parallel; 0 uses one per CPU (default: %(default)s)")
+    parser.add_argument('--format', default='xlsx',
+                        help="comma-separated report formats out of "
+                             f"{', '.join(PROFILE_WRITERS)} (default: %(default)s)")
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                        help="profile every table again and leave the profile cache untouched")
+    parser.add_argument('--interactive', action='store_true',
+                        help="wait for Enter before exiting")
+    args = parser.parse_args()
+
+    formats = [output_format.strip() for output_format in args.format.split(',')]
+    unknown = [output_format for output_format in formats if output_format not in PROFILE_WRITERS]
+    if unknown:
+        parser.error(f"unknown report format(s): {', '.join(unknown)}")
+
     try:
-        main()
+        profile = main(args.data_dir, args.output_dir, args.trace_memory, args.profile_stage,
+                       args.approximate, args.chunk_size, args.workers or None, formats, args.use_cache)
     except Exception as e:
         print(f"\n✗ FATAL ERROR: {e}")
         import traceback
         traceback.print_exc()
-        sys.exit(1)
-    
-    print("\nPress Enter to exit...")
-    input()
\ No newline at end of file
+        profile = None
+
+    if args.interactive:
+        print("\nPress Enter to exit...")
+        input()
+
+    sys.exit(0 if profile is not None else 1)
@@ -0,0 +1,353 @@
+"""
+Fraud Rule Registry
+Purpose: Declare the referral fraud rules once and evaluate them as
+         vectorized boolean masks over the joined referral table
+"""
+
+from dataclasses import dataclass
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+
+
+# Velocity thresholds: a referrer's referrals in the window ending at the
+# referral, the referral itself included (STEP 5b, see velocity.py)
+MAX_REFERRALS_PER_HOUR = 5
+MAX_REFERRALS_PER_DAY = 10
+MAX_REWARDED_PER_DAY = 5
+MAX_REWARD_DAYS_PER_30_DAYS = 150
+# Referrals whose transaction is at one club (transaction_location) in the
+# hour ending at the referral, the referral itself included
+MAX_LOCATION_REFERRALS_PER_HOUR = 20
+
+
+@dataclass(frozen=True)
+class FraudRule:
+    """
+    A single business rule that flags a referral as potential fraud
+
+    Attributes:
+        name: short identifier for the rule
+        reason: text written to the fraud_reason column when the rule fires
+        condition: function taking RuleInputs and returning a boolean mask
+        description: plain-language explanation for the data dictionary
+        action: who reviews a referral flagged by this rule
+        per_referrer: the condition compares a referral with the referrer's
+                      other referrals, so they must all be scored together
+                      (see partitioned.partition_key)
+    """
+    name: str
+    reason: str
+    condition: Callable
+    description: str = ''
+    action: str = ''
+    per_referrer: bool = False
+
+
+def _flag(mask):
+    """Turn a comparison result into a plain boolean array (missing = False)"""
+    return pd.Series(mask).fillna(False).astype(bool).to_numpy()
+
+
+def _is_true(values):
+    """Vectorized TRUE/FALSE parsing: only True or the string 'TRUE' count"""
+    values = pd.Series(values)
+    if pd.api.types.is_bool_dtype(values.dtype):
+        return _flag(values)
+    return _flag(values.astype('string').str.upper() == 'TRUE')
+
+
+class RuleInputs:
+    """
+    Column-level inputs shared by every rule, computed once per table
+
+    Args:
+        df: joined referral DataFrame (after STEP 7 normalization, with
+            the STEP 5b velocity and STEP 5c cluster columns)
+    """
+
+    def __init__(self, df):
+        reward = df['num_reward_days']
+        self.has_reward = _flag(reward > 0)
+        self.no_reward = _flag(reward.isna() | (reward == 0))
+        self.is_success = _flag(df['referral_status'] == 'Berhasil')
+        self.has_transaction = _flag(df['transaction_id'].notna())
+        self.is_paid = _flag(df['transaction_status'] == 'Paid')
+        self.is_deleted = _is_true(df['referrer_is_deleted'])
+        self.is_reward_granted = _is_true(df['is_reward_granted'])
+
+        referral_at = df['referral_at_local']
+        transaction_at = df['transaction_at_local']
+        self.both_dates = _flag(referral_at.notna() & transaction_at.notna())
+        self.transaction_before_referral = _flag(transaction_at < referral_at)
+        self.different_month = self.both_dates & _flag(
+            (referral_at.dt.year != transaction_at.dt.year)
+            | (referral_at.dt.month != transaction_at.dt.month)
+        )
+        self.expired_before_referral = _flag(
+            df['referrer_membership_expired'] <= referral_at
+        )
+
+        self.hourly_burst = _flag(df['referrer_referrals_1h'] >= MAX_REFERRALS_PER_HOUR)
+        self.daily_burst = _flag(df['referrer_referrals_24h'] >= MAX_REFERRALS_PER_DAY)
+        self.daily_rewarded_burst = _flag(df['referrer_rewarded_24h'] >= MAX_REWARDED_PER_DAY)
+        self.monthly_reward_days = _flag(
+            df['referrer_reward_days_30d'] >= MAX_REWARD_DAYS_PER_30_DAYS
+        )
+        self.shared_identity = _flag(df['cluster_size'] > 1)
+        self.location_burst = _flag(
+            df['location_referrals_1h'] >= MAX_LOCATION_REFERRALS_PER_HOUR
+        )
+
+
+def _missing(value):
+    """A missing value: None, NaN, NA or NaT"""
+    return value is None or pd.isna(value)
+
+
+def _at_least(value, threshold):
+    """value >= threshold for one value (missing = False)"""
+    return not _missing(value) and value >= threshold
+
+
+def _is_true_value(value):
+    """_is_true for one value"""
+    if _missing(value):
+        return False
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    return str(value).upper() == 'TRUE'
+
+
+class RecordInputs:
+    """
+    RuleInputs for a single referral, as numpy booleans, so the rule
+    conditions combine them with & and ~ as they do RuleInputs' arrays
+
+    Args:
+        row: dict of one referral's values, with the columns RuleInputs reads
+             (None, NaN or NaT where missing)
+    """
+
+    def __init__(self, row):
+        reward = row['num_reward_days']
+        self.has_reward = np.bool_(not _missing(reward) and reward > 0)
+        self.no_reward = np.bool_(_missing(reward) or reward == 0)
+        self.is_success = np.bool_(row['referral_status'] == 'Berhasil')
+        self.has_transaction = np.bool_(not _missing(row['transaction_id']))
+        self.is_paid = np.bool_(row['transaction_status'] == 'Paid')
+        self.is_deleted = np.bool_(_is_true_value(row['referrer_is_deleted']))
+        self.is_reward_granted = np.bool_(_is_true_value(row['is_reward_granted']))
+
+        referral_at = row['referral_at_local']
+        transaction_at = row['transaction_at_local']
+        self.both_dates = np.bool_(not _missing(referral_at) and not _missing(transaction_at))
+        self.transaction_before_referral = self.both_dates and np.bool_(transaction_at < referral_at)
+        self.different_month = self.both_dates and np.bool_(
+            (referral_at.year, referral_at.month) != (transaction_at.year, transaction_at.month))
+        expired = row['referrer_membership_expired']
+        self.expired_before_referral = np.bool_(
+            not _missing(expired) and not _missing(referral_at) and expired <= referral_at)
+
+        self.hourly_burst = np.bool_(_at_least(row['referrer_referrals_1h'], MAX_REFERRALS_PER_HOUR))
+        self.daily_burst = np.bool_(_at_least(row['referrer_referrals_24h'], MAX_REFERRALS_PER_DAY))
+        self.daily_rewarded_burst = np.bool_(
+            _at_least(row['referrer_rewarded_24h'], MAX_REWARDED_PER_DAY))
+        self.monthly_reward_days = np.bool_(
+            _at_least(row['referrer_reward_days_30d'], MAX_REWARD_DAYS_PER_30_DAYS))
+        self.shared_identity = np.bool_(not _missing(row['cluster_size']) and row['cluster_size'] > 1)
+        self.location_burst = np.bool_(
+            _at_least(row['location_referrals_1h'], MAX_LOCATION_REFERRALS_PER_HOUR))
+
+
+# Ordered registry: when several rules fire, the first one listed is reported
+FRAUD_RULES = [
+    FraudRule('reward_without_success', "Reward > 0 but status not Berhasil",
+              lambda r: r.has_reward & ~r.is_success,
+              'A reward was assigned but the referral status is not "Berhasil" (Successful).',
+              'Review by Compliance team'),
+    FraudRule('reward_without_transaction', "Reward > 0 but no transaction ID",
+              lambda r: r.has_reward & ~r.has_transaction,
+              'A reward was assigned but there is no transaction ID linked to the referral.',
+              'Review by Operations team'),
+    FraudRule('transaction_without_reward', "Paid transaction but reward = 0",
+              lambda r: r.no_reward & r.has_transaction & r.is_paid,
+              'A paid transaction exists but no reward was assigned to the referrer.',
+              'Review by Rewards team'),
+    FraudRule('success_without_reward', "Status Berhasil but reward = 0",
+              lambda r: r.is_success & r.no_reward,
+              'The referral status is "Berhasil" but the reward value is zero or null.',
+              'Review by Rewards team'),
+    FraudRule('transaction_before_referral', "Transaction date earlier than referral date",
+              lambda r: r.both_dates & r.transaction_before_referral,
+              'The transaction date is before the referral creation date (impossible scenario).',
+              'Investigate - Critical issue'),
+    FraudRule('expired_membership', "Membership expired before referral",
+              lambda r: r.has_reward & r.expired_before_referral,
+              "The referrer's membership had expired when the referral was made.",
+              'Review eligibility'),
+    FraudRule('deleted_account', "Referrer account deleted",
+              lambda r: r.has_reward & r.is_deleted,
+              "The referrer's account has been deleted.",
+              'Investigate account status'),
+    FraudRule('different_month', "Transaction & referral in different month",
+              lambda r: r.different_month,
+              'The transaction occurred in a different month than the referral.',
+              'Review reward policy'),
+    FraudRule('reward_not_granted', "Reward not granted but status Berhasil",
+              lambda r: r.has_reward & r.is_success & ~r.is_reward_granted,
+              'The reward has not been granted even though the referral is successful.',
+              'Process reward distribution'),
+    FraudRule('referral_burst_1h',
+              f"Referrer made {MAX_REFERRALS_PER_HOUR}+ referrals within 1 hour",
+              lambda r: r.hourly_burst,
+              f'The referrer made at least {MAX_REFERRALS_PER_HOUR} referrals in the hour '
+              'up to and including this one.',
+              'Investigate referrer activity'),
+    FraudRule('referral_burst_24h',
+              f"Referrer made {MAX_REFERRALS_PER_DAY}+ referrals within 24 hours",
+              lambda r: r.daily_burst,
+              f'The referrer made at least {MAX_REFERRALS_PER_DAY} referrals in the 24 hours '
+              'up to and including this one.',
+              'Investigate referrer activity'),
+    FraudRule('rewarded_burst_24h',
+              f"Referrer earned {MAX_REWARDED_PER_DAY}+ rewards within 24 hours",
+              lambda r: r.has_reward & r.daily_rewarded_burst,
+              f'This rewarded referral is one of at least {MAX_REWARDED_PER_DAY} rewarded '
+              'referrals the referrer made within 24 hours.',
+              'Review by Rewards team'),
+    FraudRule('reward_days_30d',
+              f"Referrer earned {MAX_REWARD_DAYS_PER_30_DAYS}+ reward days within 30 days",
+              lambda r: r.has_reward & r.monthly_reward_days,
+              f'Rewarded referrals made by the referrer within 30 days add up to at least '
+              f'{MAX_REWARD_DAYS_PER_30_DAYS} reward days.',
+              'Review by Rewards team'),
+    FraudRule('shared_identity', "Referee shares a phone or transaction with another account",
+              lambda r: r.shared_identity,
+              "The referee's phone number or transaction also belongs to another referee or "
+              'user, directly or through a chain of shared identifiers (see cluster_id).',
+              'Investigate identity ring'),
+    FraudRule('location_burst_1h',
+              f"{MAX_LOCATION_REFERRALS_PER_HOUR}+ referrals at one transaction location "
+              "within 1 hour",
+              lambda r: r.location_burst,
+              f"At least {MAX_LOCATION_REFERRALS_PER_HOUR} referrals with a transaction at this "
+              "referral's club were made in the hour up to and including this one.",
+              'Investigate club activity'),
+]
+
+
+def evaluate_rule_masks(df, rules=FRAUD_RULES):
+    """
+    Evaluate every rule over the whole table
+
+    Args:
+        df: joined referral DataFrame
+        rules: ordered list of FraudRule
+
+    Returns:
+        List of boolean numpy arrays, one per rule, in registry order
+    """
+    inputs = RuleInputs(df)
+    return [_flag(rule.condition(inputs)) for rule in rules]
+
+
+def _bitmask_dtype(rule_count):
+    """Smallest unsigned integer type with one bit per rule"""
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if rule_count <= np.iinfo(dtype).bits:
+            return dtype
+    raise ValueError(f"Too many fraud rules for a bitmask: {rule_count}")
+
+
+def evaluate_fraud_bitmask(df, rules=FRAUD_RULES):
+    """
+    Record every rule that fires for each referral as an integer bitmask
+
+    Bit i is set when rules[i] fires, so the mask keeps all overlapping
+    reasons from a single pass instead of only the first match.
+
+    Args:
+        df: joined referral DataFrame
+        rules: ordered list of FraudRule
+
+    Returns:
+        Series of unsigned integers aligned to df (0 = no rule fired)
+    """
+    dtype = _bitmask_dtype(len(rules))
+    bitmask = np.zeros(len(df), dtype=dtype)
+
+    for bit, mask in enumerate(evaluate_rule_masks(df, rules)):
+        bitmask |= mask.astype(dtype) << dtype(bit)
+
+    return pd.Series(bitmask, index=df.index)
+
+
+def fraud_reason_from_bitmask(bitmask, rules=FRAUD_RULES):
+    """
+    Derive the first-match fraud reason from the lowest set bit
+
+    Args:
+        bitmask: Series produced by evaluate_fraud_bitmask
+        rules: the same ordered list of FraudRule used to build the mask
+
+    Returns:
+        Series of fraud reasons (None when no rule fired)
+    """
+    values = bitmask.to_numpy()
+    lowest_bit = values & (~values + 1)
+    # frexp(2**i) has exponent i + 1, and frexp(0) has exponent 0
+    _, first_match = np.frexp(lowest_bit.astype(np.float64))
+    reasons = np.array([None] + [rule.reason for rule in rules], dtype=object)
+
+    return pd.Series(reasons[first_match], index=bitmask.index)
+
+
+def evaluate_record(row, rules=FRAUD_RULES):
+    """
+    evaluate_fraud_bitmask and fraud_reason_from_bitmask for one referral
+
+    Args:
+        row: dict of the referral's values (see RecordInputs)
+        rules: ordered list of FraudRule
+
+    Returns:
+        (bitmask as an int, first-match fraud reason or None)
+    """
+    inputs = RecordInputs(row)
+    fired = [bit for bit, rule in enumerate(rules) if rule.condition(inputs)]
+    bitmask = sum(1 << bit for bit in fired)
+    return bitmask, rules[fired[0]].reason if fired else None
+
+
+def summarize_rule_hits(bitmask, rules=FRAUD_RULES):
+    """
+    Count how often each rule fires, straight from the bitmask
+
+    Args:
+        bitmask: Series produced by evaluate_fraud_bitmask
+        rules: the same ordered list of FraudRule used to build the mask
+
+    Returns:
+        DataFrame with one row per rule:
+            Total Hits: referrals where the rule fired
+            Reported Hits: referrals where it is the reported fraud_reason
+            Exclusive Hits: referrals where it is the only rule that fired
+    """
+    values = bitmask.to_numpy()
+    lowest_bit = values & (~values + 1)
+
+    summary = []
+    for bit, rule in enumerate(rules):
+        flag = values.dtype.type(1) << values.dtype.type(bit)
+        summary.append({
+            'Bit': bit,
+            'Rule': rule.name,
+            'Fraud Reason': rule.reason,
+            'Total Hits': int(np.count_nonzero(values & flag)),
+            'Reported Hits': int(np.count_nonzero(lowest_bit == flag)),
+            'Exclusive Hits': int(np.count_nonzero(values == flag)),
+        })
+
+    return pd.DataFrame(summary)
@@ -0,0 +1,132 @@
+"""
+Identifier Codes
+Purpose: Replace the 32-char hex identifiers with compact integer codes from
+         one dictionary shared by every table, so joins and deduplication
+         hash small integers, and turn them back into text for the report
+"""
+
+import numpy as np
+import pandas as pd
+
+from schema import TABLE_SCHEMAS
+
+# Nullable, so a missing identifier stays missing (notna(), joins, dedup)
+CODE_DTYPE = 'Int32'
+
+# Report columns that hold identifier codes until STEP 10
+REPORT_ID_COLUMNS = ['referral_id', 'referrer_id', 'referrer_phone_number',
+                     'referee_id', 'referee_phone', 'transaction_id', 'cluster_id']
+
+
+def id_columns(table_name):
+    """Columns of a table declared with the 'id' kind"""
+    return [name for name, column in TABLE_SCHEMAS[table_name].columns.items()
+            if column.kind == 'id']
+
+
+class IdDictionary:
+    """
+    Append-only mapping between identifier strings and integer codes
+
+    The same string always gets the same code within a run, whichever
+    table or chunk it comes from, so codes can be joined and compared
+    across tables. New identifiers (e.g. in a later streaming chunk) get
+    the next free codes; existing codes never change.
+
+    Lookups go through pieces of the dictionary (consecutive code ranges,
+    largest first), each an Index whose hash table is built once. New
+    identifiers form a new piece, and a piece is merged into the one
+    before it once it is at least half that size, so a lookup probes
+    O(log n) pieces and every identifier is rehashed O(log n) times in
+    total, instead of the whole dictionary on every call.
+    """
+
+    def __init__(self):
+        self.values = pd.Index([], dtype='str')  # code -> identifier
+        self._pieces = []  # (first code, Index of identifiers from that code)
+
+    def __len__(self):
+        return len(self.values)
+
+    def _lookup(self, values):
+        """Codes of known identifiers, -1 for unseen or missing ones"""
+        codes = np.full(len(values), -1, dtype=np.int64)
+        for first, piece in self._pieces:
+            pending = np.flatnonzero(codes < 0)
+            if len(pending) == 0:
+                break
+            found = piece.get_indexer(values.take(pending))
+            hits = found >= 0
+            codes[pending[hits]] = found[hits] + first
+        return codes
+
+    def _append(self, uniques):
+        self._pieces.append((len(self.values), uniques))
+        self.values = self.values.append(uniques)
+        while len(self._pieces) > 1 and 2 * len(self._pieces[-1][1]) >= len(self._pieces[-2][1]):
+            (first, earlier), (_, later) = self._pieces[-2:]
+            self._pieces[-2:] = [(first, earlier.append(later))]
+
+    def encode(self, values):
+        """
+        Codes for identifier strings, adding unseen ones to the dictionary
+
+        Args:
+            values: Series of identifier strings (missing values allowed)
+
+        Returns:
+            Int32 array of codes, <NA> where the identifier is missing
+        """
+        # Only the identifiers the dictionary does not have are factorized;
+        # their uniques (in order of first appearance) get the next free codes
+        values = pd.Series(values, dtype='str').reset_index(drop=True)
+        codes = self._lookup(values)
+        unseen = (codes < 0) & values.notna().to_numpy()
+        if unseen.any():
+            new_codes, uniques = pd.factorize(values[unseen])
+            if len(self.values) + len(uniques) > np.iinfo(np.int32).max:
+                raise OverflowError(f"More than {np.iinfo(np.int32).max} distinct identifiers")
+            codes[unseen] = new_codes + len(self.values)
+            self._append(pd.Index(uniques, dtype='str'))
+        return pd.arrays.IntegerArray(codes.astype(np.int32), codes < 0)
+
+    def encode_table(self, df, table_name):
+        """Copy of df with its 'id' columns replaced by codes"""
+        return self.encode_tables({table_name: df})[table_name]
+
+    def encode_tables(self, tables):
+        """
+        Replace the 'id' columns of every table with codes
+
+        Args:
+            tables: dict of DataFrames keyed by TABLE_SCHEMAS name
+
+        Returns:
+            dict of copies with encoded 'id' columns
+        """
+        columns = [(name, column) for name, df in tables.items()
+                   for column in id_columns(name) if column in df.columns]
+        if not columns:
+            return dict(tables)
+
+        # All columns are encoded in one pass over the dictionary
+        codes = self.encode(pd.concat([tables[name][column] for name, column in columns],
+                                      ignore_index=True))
+        encoded = {name: {} for name in tables}
+        start = 0
+        for name, column in columns:
+            end = start + len(tables[name])
+            encoded[name][column] = codes[start:end]
+            start = end
+        return {name: df.assign(**encoded[name]) for name, df in tables.items()}
+
+    def decode(self, codes):
+        """Identifier strings for a Series of codes (missing codes give NaN)"""
+        positions = codes.fillna(-1).to_numpy(dtype=np.intp)
+        return pd.Series(self.values.take(positions, allow_fill=True, fill_value=np.nan),
+                         index=codes.index)
+
+    def decode_columns(self, df, columns=REPORT_ID_COLUMNS):
+        """Copy of df with the code columns among columns turned back into text"""
+        return df.assign(**{column: self.decode(df[column]) for column in columns
+                            if column in df.columns})
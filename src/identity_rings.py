@@ -0,0 +1,453 @@
+"""
+Identity Ring Detection
+Purpose: Group referrals whose referees share phone numbers or transactions
+         with other accounts into clusters (connected components of the
+         identifier graph), found with an array-backed union-find
+"""
+
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from schema import FACT_TABLE
+
+
+@dataclass(frozen=True)
+class IdentityLink:
+    """Two identifier columns of one table whose values belong to the same party"""
+    table: str  # FACT_TABLE or a dimension name from pipeline_stages.clean_dimensions
+    account: str  # account identifier (user or referee id)
+    identifier: str  # phone hash or transaction id
+
+
+# Edges of the identifier graph. User, referrer and referee ids share one
+# namespace, so a referee who is also a user is one account.
+IDENTITY_LINKS = (
+    IdentityLink('user_logs_clean', 'user_id', 'phone_number'),
+    IdentityLink(FACT_TABLE, 'referee_id', 'referee_phone'),
+    IdentityLink(FACT_TABLE, 'referee_id', 'transaction_id'),
+)
+
+# A referral's cluster is that of the first of these it has
+REFERRAL_NODE_COLUMNS = ['referee_id', 'transaction_id', 'referee_phone']
+
+# user_referrals columns the clusters are built from
+IDENTITY_SOURCE_COLUMNS = ['referee_id', 'referee_phone', 'transaction_id']
+
+
+class UnionFind:
+    """
+    Disjoint sets over the nodes 0..size-1, kept in flat numpy arrays
+
+    union() merges a whole edge list at once. Every round looks up the
+    roots of the unmerged edges, with full path compression (pointer
+    jumping until every node points at its root), and then hooks one root
+    of each edge under the other by rank. The lower (rank, -node) root is
+    hooked, so a round cannot create a cycle. Edges whose hook lost to
+    another edge are retried in the next round. Memory is two arrays over
+    the nodes plus the edge list being merged.
+    """
+
+    def __init__(self, size):
+        dtype = np.int32 if size <= np.iinfo(np.int32).max else np.int64
+        self.parent = np.arange(size, dtype=dtype)
+        self.rank = np.zeros(size, dtype=np.int8)
+
+    def grow(self, size):
+        """Add single-node sets up to size nodes"""
+        added = size - len(self.parent)
+        if added > 0:
+            self.parent = np.append(self.parent, np.arange(len(self.parent), size,
+                                                           dtype=self.parent.dtype))
+            self.rank = np.append(self.rank, np.zeros(added, dtype=np.int8))
+
+    def compress(self):
+        """Point every node straight at its root"""
+        parent = self.parent
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+        self.parent = parent
+
+    def find(self, nodes):
+        """Roots of an array of nodes"""
+        self.compress()
+        return self.parent[nodes]
+
+    def _follow(self, nodes):
+        """Roots of some nodes, found by following parents; the nodes are pointed at them"""
+        roots = self.parent[nodes]
+        while True:
+            up = self.parent[roots]
+            if np.array_equal(up, roots):
+                break
+            roots = up
+        self.parent[nodes] = roots
+        return roots
+
+    def union(self, left, right, few=False):
+        """
+        Merge the sets of left[i] and right[i] for every i
+
+        With few=True, for edge lists much shorter than the node count (a
+        chunk of a larger graph), each round follows only the edges' nodes
+        up to their roots instead of compressing every node; union by rank
+        keeps those paths O(log n) long.
+        """
+        while len(left):
+            if few:
+                a, b = self._follow(left), self._follow(right)
+            else:
+                self.compress()
+                a, b = self.parent[left], self.parent[right]
+            pending = a != b
+            left, right, a, b = left[pending], right[pending], a[pending], b[pending]
+            if not len(left):
+                break
+
+            rank_a, rank_b = self.rank[a], self.rank[b]
+            a_lower = (rank_a < rank_b) | ((rank_a == rank_b) & (a > b))
+            child = np.where(a_lower, a, b)
+            root = np.where(a_lower, b, a)
+            self.parent[child] = root
+            # Several edges may hook the same root; only the hook that took effect counts
+            hooked = self.parent[child] == root
+            np.maximum.at(self.rank, root[hooked], self.rank[child[hooked]] + 1)
+
+
+def _values(frame, column):
+    """Non-missing values of a column as a Series (for factorizing)"""
+    values = frame[column]
+    return values[values.notna().to_numpy()]
+
+
+def _smallest(groups, texts, count):
+    """
+    Position of the smallest of texts in each of count groups
+
+    Args:
+        groups: group number (0..count-1) of each text
+        texts: Index of identifier strings
+
+    Returns:
+        int64 array of positions into texts (-1 for groups without texts)
+    """
+    order = np.asarray(texts.argsort())
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order))
+    best = np.full(count, len(order), dtype=np.int64)
+    np.minimum.at(best, groups, ranks)
+    # Rank len(order) (an empty group) picks the appended -1
+    return np.append(order, -1)[best]
+
+
+class IdentityClusters:
+    """
+    Connected components of the identifier graph (IDENTITY_LINKS)
+
+    A cluster is labelled with its smallest identifier (compared as text),
+    so its cluster_id does not depend on how the table is read, and stays
+    the same when other clusters appear, merge or split. Clusters that
+    merge keep the smaller of their labels.
+
+    Args:
+        referrals: user_referrals rows (all columns or IDENTITY_SOURCE_COLUMNS)
+        dims: dimension tables from pipeline_stages.build_dimensions
+        ids: IdDictionary the identifiers are encoded with (None if they
+             are text); labels are then codes, decoded with the report
+    """
+
+    def __init__(self, referrals, dims, ids=None):
+        self.ids = ids
+        frames = {FACT_TABLE: referrals, **dims}
+        columns = {(link.table, name) for link in IDENTITY_LINKS
+                   for name in (link.account, link.identifier)}
+        _, self.nodes = pd.factorize(pd.concat(
+            [_values(frames[table], name) for table, name in sorted(columns)],
+            ignore_index=True))
+        self.nodes = pd.Index(self.nodes)
+        self.union_find = UnionFind(len(self.nodes))
+
+        for link in IDENTITY_LINKS:
+            frame = frames[link.table]
+            left = self.nodes.get_indexer(frame[link.account])
+            right = self.nodes.get_indexer(frame[link.identifier])
+            linked = (left >= 0) & (right >= 0)
+            self.union_find.union(left[linked], right[linked])
+        roots = self.union_find.find(np.arange(len(self.nodes)))
+
+        accounts = np.unique(np.concatenate([
+            self.nodes.get_indexer(_values(frames[link.table], link.account))
+            for link in IDENTITY_LINKS
+        ]))
+        # Indexed by root; the extra last entry answers root -1 (no identifiers)
+        self.sizes = np.bincount(roots[accounts], minlength=len(self.nodes) + 1)
+
+        # Indexed by root: the node labelling its cluster (-1 answers root -1)
+        self.labels = np.append(_smallest(roots, self._texts(self.nodes), len(self.nodes)), -1)
+
+    def _texts(self, values):
+        """Identifier strings of node values (decoded when they are codes)"""
+        if self.ids is None:
+            return pd.Index(values)
+        return self.ids.values.take(np.asarray(values, dtype=np.intp))
+
+    def node_clusters(self):
+        """
+        Every identifier with its cluster's label and size
+
+        Returns:
+            DataFrame with node, cluster and size columns
+        """
+        roots = self.union_find.find(np.arange(len(self.nodes)))
+        return pd.DataFrame({
+            'node': self.nodes.array,
+            'cluster': self.nodes.array.take(self.labels[roots]),
+            'size': self.sizes[roots].astype(np.int64),
+        })
+
+    def _graph_nodes(self, values):
+        """Root in the graph of each value's node (-1 for values not in the graph)"""
+        nodes = self.nodes.get_indexer(values)
+        return np.where(nodes >= 0, self.union_find.parent[nodes], -1)
+
+    def _roots(self, df, node_ids=None):
+        """Root node of each referral's cluster (-1 when it has no identifiers)"""
+        node_ids = node_ids or self._graph_nodes
+        roots = np.full(len(df), -1, dtype=np.int64)
+        for column in reversed(REFERRAL_NODE_COLUMNS):
+            nodes = node_ids(df[column])
+            found = nodes >= 0
+            roots[found] = nodes[found]
+        return roots
+
+    def _overlay(self, df, added):
+        """
+        Cluster labels and sizes of df's referrals as if the links of the
+        added referrals were in the graph, which is left unchanged
+
+        Only the clusters the added referrals touch are merged, with a
+        small union-find over their roots and the identifiers the graph
+        has not seen (numbered after the graph's nodes).
+        """
+        links = [link for link in IDENTITY_LINKS if link.table == FACT_TABLE]
+        columns = sorted({name for link in links for name in (link.account, link.identifier)}
+                         | set(REFERRAL_NODE_COLUMNS))
+        unseen = pd.Index(pd.unique(pd.concat(
+            [_values(frame, column) for frame in (added, df) for column in columns],
+            ignore_index=True)))
+        unseen = unseen[self.nodes.get_indexer(unseen) < 0]
+
+        def node_ids(values):
+            nodes = unseen.get_indexer(values)
+            return np.where(nodes >= 0, len(self.nodes) + nodes, self._graph_nodes(values))
+
+        edges = [(node_ids(added[link.account]), node_ids(added[link.identifier]))
+                 for link in links]
+        roots = self._roots(df, node_ids)
+        touched = np.unique(np.concatenate([roots] + [ids for edge in edges for ids in edge]))
+        touched = touched[touched >= 0]
+
+        union_find = UnionFind(len(touched))
+        for left, right in edges:
+            linked = (left >= 0) & (right >= 0)
+            union_find.union(np.searchsorted(touched, left[linked]),
+                             np.searchsorted(touched, right[linked]))
+        components = union_find.find(np.arange(len(touched)))
+
+        # A component's accounts: its graph clusters' plus the new referees
+        in_graph = touched < len(self.nodes)
+        new_accounts = np.unique(np.concatenate(
+            [node_ids(_values(added, link.account)) for link in links]))
+        weights = np.where(in_graph, self.sizes[np.where(in_graph, touched, -1)],
+                           np.isin(touched, new_accounts))
+        sizes = np.bincount(components, weights=weights, minlength=len(touched))
+        # Graph clusters (first, as touched is sorted) stand in with their
+        # labels and unseen identifiers with themselves; the smallest wins
+        candidates = self.nodes.take(self.labels[touched[in_graph]]).append(
+            unseen.take(touched[~in_graph] - len(self.nodes)))
+        # The extra last entry answers component -1 (no identifiers)
+        labels = np.append(_smallest(components, self._texts(candidates), len(touched)), -1)
+
+        found = roots >= 0
+        component = np.full(len(df), -1, dtype=np.int64)
+        component[found] = components[np.searchsorted(touched, roots[found])]
+        cluster_ids = candidates.array.take(np.where(found, labels[component], -1), allow_fill=True)
+        cluster_sizes = np.zeros(len(df), dtype=np.int64)
+        cluster_sizes[found] = sizes[component[found]]
+        return cluster_ids, cluster_sizes, ~found
+
+    def record_cluster(self, referral):
+        """
+        STEP 5c for one referral as if its links were in the graph, as
+        assign(df, added=df) gives it for a one-row df, without frames
+
+        Its referee links its phone and transaction, so its cluster
+        merges the graph clusters of all three (or, without a referee, is
+        the cluster of its transaction or phone).
+
+        Args:
+            referral: dict with REFERRAL_NODE_COLUMNS, identifiers as text
+                      (clusters built without ids)
+
+        Returns:
+            (cluster_id, cluster_size), (None, None) without identifiers
+        """
+        present = [referral[column] for column in REFERRAL_NODE_COLUMNS
+                   if not pd.isna(referral[column])]
+        if not present:
+            return None, None
+        referee = referral['referee_id']
+        members = present if not pd.isna(referee) else present[:1]
+
+        # Graph clusters by root, with their labels; unseen identifiers stand for themselves
+        weights, labels = {}, {}
+        for value in members:
+            try:
+                root = int(self.union_find.parent[self.nodes.get_loc(value)])
+            except KeyError:
+                weights[value], labels[value] = int(value == referee), value
+                continue
+            weights[root] = int(self.sizes[root])
+            labels[root] = self.nodes[self.labels[root]]
+        return min(labels.values()), sum(weights.values())
+
+    def assign(self, df, added=None):
+        """
+        STEP 5c: add cluster_id (the cluster's label) and cluster_size
+        (accounts in the cluster)
+
+        Args:
+            df: joined referrals with REFERRAL_NODE_COLUMNS
+            added: user_referrals rows to cluster df with as if they had
+                   been in the graph (see scoring_service.py)
+
+        Returns:
+            df with cluster_id and cluster_size (missing for referrals
+            without a referee, transaction or phone)
+        """
+        if added is not None:
+            cluster_ids, cluster_sizes, missing = self._overlay(df, added)
+            df['cluster_id'] = cluster_ids
+            df['cluster_size'] = pd.arrays.IntegerArray(cluster_sizes, missing)
+            return df
+
+        roots = self._roots(df)
+        missing = roots < 0
+        df['cluster_id'] = self.nodes.array.take(self.labels[roots], allow_fill=True)
+        df['cluster_size'] = pd.arrays.IntegerArray(self.sizes[roots].astype(np.int64), missing)
+        return df
+
+
+def _codes(values):
+    """Identifier codes as int64, -1 where missing"""
+    return values.to_numpy(dtype=np.int64, na_value=-1)
+
+
+class StreamedClusters:
+    """
+    IdentityClusters over tables added a chunk at a time, for tables that
+    need not fit in memory
+
+    The nodes are the codes of an IdDictionary, so there is no node index:
+    the union-find has one entry per code and grows with the dictionary.
+    Each chunk's links are merged when it is added (UnionFind.union with
+    few=True) and then dropped. Memory is the union-find plus two flags
+    (graph node, account) per code. After finish(), assign() gives every
+    referral the cluster_id and cluster_size IdentityClusters would over
+    all the added rows.
+
+    Args:
+        ids: IdDictionary the added tables are encoded with
+    """
+
+    def __init__(self, ids):
+        self.ids = ids
+        self.union_find = UnionFind(0)
+        self.in_graph = np.zeros(0, dtype=bool)
+        self.accounts = np.zeros(0, dtype=bool)
+
+    def _grow(self):
+        """Room for every code of the dictionary (doubling, so chunks grow it rarely)"""
+        size = len(self.ids)
+        if size > len(self.in_graph):
+            size = max(size, 2 * len(self.in_graph))
+            self.union_find.grow(size)
+            self.in_graph = np.append(self.in_graph, np.zeros(size - len(self.in_graph), dtype=bool))
+            self.accounts = np.append(self.accounts, np.zeros(size - len(self.accounts), dtype=bool))
+
+    def add(self, frame, table):
+        """
+        Merge the links of rows of one table
+
+        Args:
+            frame: encoded rows of the table (a chunk or all of it)
+            table: FACT_TABLE or a dimension name, as in IDENTITY_LINKS
+        """
+        self._grow()
+        for link in IDENTITY_LINKS:
+            if link.table != table:
+                continue
+            left, right = _codes(frame[link.account]), _codes(frame[link.identifier])
+            self.in_graph[left[left >= 0]] = True
+            self.in_graph[right[right >= 0]] = True
+            self.accounts[left[left >= 0]] = True
+            linked = (left >= 0) & (right >= 0)
+            self.union_find.union(left[linked], right[linked], few=True)
+
+    def finish(self):
+        """Label and size the clusters (after the last add)"""
+        size = len(self.ids)
+        self._grow()
+        self.roots = self.union_find.find(np.arange(size))
+        self.sizes = np.bincount(self.roots[self.accounts[:size]], minlength=size + 1)
+        nodes = np.flatnonzero(self.in_graph[:size])
+        # The smallest node of each root's cluster; the extra last entry answers root -1
+        best = _smallest(self.roots[nodes], self.ids.values.take(nodes), size)
+        self.labels = np.append(np.append(nodes, -1)[best], -1)
+
+    def assign(self, df):
+        """STEP 5c: add cluster_id (a code) and cluster_size (see IdentityClusters.assign)"""
+        roots = np.full(len(df), -1, dtype=np.int64)
+        for column in reversed(REFERRAL_NODE_COLUMNS):
+            codes = _codes(df[column])
+            found = (codes >= 0) & (codes < len(self.roots))
+            found[found] = self.in_graph[codes[found]]
+            roots[found] = self.roots[codes[found]]
+        missing = roots < 0
+        df['cluster_id'] = pd.arrays.IntegerArray(self.labels[roots].astype(np.int32), missing)
+        df['cluster_size'] = pd.arrays.IntegerArray(self.sizes[roots].astype(np.int64), missing)
+        return df
+
+
+class ClusterLookup:
+    """
+    Cluster labels and sizes looked up per identifier, for clusters kept
+    elsewhere (such as the incremental store); assign() works like
+    IdentityClusters.assign
+
+    Args:
+        nodes: identifiers, as they appear in the referrals to assign
+        clusters: label of each identifier's cluster
+        sizes: accounts in each identifier's cluster
+    """
+
+    def __init__(self, nodes, clusters, sizes):
+        self.nodes = pd.Index(nodes)
+        self.clusters = pd.array(clusters)
+        # The extra last entry answers position -1 (no identifiers)
+        self.sizes = np.append(np.asarray(sizes, dtype=np.int64), 0)
+
+    def assign(self, df):
+        """STEP 5c: add cluster_id and cluster_size (see IdentityClusters.assign)"""
+        positions = np.full(len(df), -1, dtype=np.int64)
+        for column in reversed(REFERRAL_NODE_COLUMNS):
+            found = self.nodes.get_indexer(df[column])
+            positions[found >= 0] = found[found >= 0]
+        missing = positions < 0
+        df['cluster_id'] = self.clusters.take(positions, allow_fill=True)
+        df['cluster_size'] = pd.arrays.IntegerArray(self.sizes[positions], missing)
+        return df
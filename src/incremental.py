@@ -0,0 +1,509 @@
+"""
+Incremental Run Support
+Purpose: Persist updated_at / referral log watermarks and upsert only the
+         referrals that changed since the last run into a keyed report store
+"""
+
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from identity_rings import IDENTITY_SOURCE_COLUMNS, REFERRAL_NODE_COLUMNS, IdentityClusters
+from report_sinks import write_report
+from schema import FACT_TABLE, REPORT_SCHEMA, TABLE_SCHEMAS, read_records
+from time_conversion import parse_utc_timestamps
+
+# Key of the report store; one row per referral
+REPORT_KEY = 'referral_id'
+
+REPORT_TABLE = 'referral_fraud_report'
+STAGING_TABLE = 'referral_fraud_report_staging'
+
+# Input row of every referral seen so far (text ids), so the rows around a
+# change are looked up by key instead of rescanning user_referrals
+INPUTS_TABLE = 'referral_inputs'
+INPUT_COLUMNS = list(TABLE_SCHEMAS[FACT_TABLE].columns)
+# INPUTS_TABLE columns with an index, for finding a referrer's referrals,
+# the referrals that hold an identifier and the referrals made in a time range
+INDEXED_INPUT_COLUMNS = ['referrer_id'] + IDENTITY_SOURCE_COLUMNS + ['referral_at']
+
+# Cluster label of every identifier and size of every cluster (STEP 5c), so
+# a run only rebuilds the clusters its changes touch
+NODES_TABLE = 'identity_nodes'
+CLUSTERS_TABLE = 'identity_clusters'
+NODES_INDEX = f"CREATE INDEX IF NOT EXISTS {NODES_TABLE}_cluster ON {NODES_TABLE} (cluster)"
+
+# Bumped when the state kept between runs or the fraud rules change; a store
+# written by an older version is rebuilt by rescoring every referral
+STORE_VERSION = '3'
+
+# Columns of user_logs that feed the report or the fraud rules
+REFERRER_COLUMNS = ['user_id', 'name', 'phone_number', 'homeclub',
+                    'timezone_homeclub', 'membership_expired_date', 'is_deleted']
+
+
+def open_store(store_path):
+    """
+    Open (and create if needed) the SQLite store holding the report and run state
+
+    Args:
+        store_path: path of the .db file
+
+    Returns:
+        sqlite3.Connection
+    """
+    conn = sqlite3.connect(store_path)
+    conn.execute("CREATE TABLE IF NOT EXISTS pipeline_state (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS referrer_fingerprints "
+                 "(user_id TEXT PRIMARY KEY, fingerprint TEXT)")
+    columns = ', '.join(f'{column} TEXT' for column in INPUT_COLUMNS if column != REPORT_KEY)
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {INPUTS_TABLE} "
+                 f"({REPORT_KEY} TEXT PRIMARY KEY, {columns})")
+    for column in INDEXED_INPUT_COLUMNS:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {INPUTS_TABLE}_{column} "
+                     f"ON {INPUTS_TABLE} ({column})")
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {NODES_TABLE} (node TEXT PRIMARY KEY, cluster TEXT)")
+    conn.execute(NODES_INDEX)
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {CLUSTERS_TABLE} "
+                 "(cluster TEXT PRIMARY KEY, size INTEGER)")
+    conn.commit()
+    return conn
+
+
+def load_watermarks(conn):
+    """
+    Read the high-water marks left by the previous run
+
+    Returns:
+        dict with 'updated_at' and 'referral_logs_created_at' as UTC
+        Timestamps, or None for a mark that was never set (first run) or
+        was set by an older STORE_VERSION
+    """
+    stored = dict(conn.execute("SELECT key, value FROM pipeline_state").fetchall())
+    if stored.get('store_version') != STORE_VERSION:
+        stored = {}
+    return {
+        name: pd.Timestamp(stored[name]) if stored.get(name) else None
+        for name in ('updated_at', 'referral_logs_created_at')
+    }
+
+
+def save_watermarks(conn, watermarks):
+    """Persist the high-water marks (None values are left untouched)"""
+    conn.executemany(
+        "INSERT OR REPLACE INTO pipeline_state (key, value) VALUES (?, ?)",
+        [(name, mark.isoformat()) for name, mark in watermarks.items() if mark is not None]
+        + [('store_version', STORE_VERSION)]
+    )
+    conn.commit()
+
+
+def advance_watermark(current, timestamps):
+    """Return the later of the current mark and the newest parsed timestamp"""
+    newest = parse_utc_timestamps(timestamps).max()
+    if pd.isna(newest):
+        return current
+    return newest if current is None else max(current, newest)
+
+
+def referrals_with_new_logs(user_referral_logs, watermark):
+    """
+    referral_ids that received a referral log after the watermark
+
+    Args:
+        user_referral_logs: cleaned user_referral_logs table
+        watermark: referral_logs_created_at mark (None selects every referral)
+
+    Returns:
+        set of referral ids
+    """
+    logs = user_referral_logs
+    if watermark is not None:
+        logs = logs[(parse_utc_timestamps(logs['created_at']) > watermark).to_numpy()]
+    return set(logs['user_referral_id'].dropna())
+
+
+def changed_referrers(conn, user_logs_clean):
+    """
+    Find referrers whose user_logs row is new or differs from the last run
+
+    A fingerprint of each user's referrer columns is compared with the one
+    stored by the previous run. The new fingerprints are written in the open
+    transaction, so they are committed together with the report upsert.
+
+    Args:
+        conn: store connection from open_store
+        user_logs_clean: deduplicated user_logs table
+
+    Returns:
+        set of user_ids to rescore
+    """
+    referrers = user_logs_clean[REFERRER_COLUMNS]
+    fingerprints = pd.DataFrame({
+        'user_id': referrers['user_id'].astype(str),
+        'fingerprint': pd.util.hash_pandas_object(referrers, index=False).astype(str),
+    })
+
+    previous = pd.read_sql_query("SELECT user_id, fingerprint FROM referrer_fingerprints", conn)
+    merged = fingerprints.merge(previous, on='user_id', how='left', suffixes=('', '_previous'))
+    changed = merged[merged['fingerprint'] != merged['fingerprint_previous']]
+
+    conn.executemany(
+        "INSERT OR REPLACE INTO referrer_fingerprints (user_id, fingerprint) VALUES (?, ?)",
+        changed[['user_id', 'fingerprint']].itertuples(index=False, name=None)
+    )
+    return set(changed['user_id'])
+
+
+def select_changed_referrals(referrals, updated_at_watermark, new_log_referrals, referrers):
+    """
+    Keep the referral rows that have to be rescored in this run
+
+    A row is selected when its updated_at is after the watermark (or cannot
+    be parsed), when it received a new referral log, or when its referrer's
+    user_logs row changed.
+
+    Args:
+        referrals: cleaned user_referrals rows (full table or one chunk)
+        updated_at_watermark: updated_at mark (None selects every row)
+        new_log_referrals: set from referrals_with_new_logs
+        referrers: set from changed_referrers
+
+    Returns:
+        Filtered DataFrame
+    """
+    if updated_at_watermark is None:
+        return referrals
+
+    updated_at = parse_utc_timestamps(referrals['updated_at'])
+    selected = (
+        (updated_at > updated_at_watermark) | updated_at.isna()
+        | referrals['referral_id'].isin(new_log_referrals)
+        | referrals['referrer_id'].isin(referrers)
+    )
+    return referrals[selected.to_numpy()]
+
+
+def _key_table(conn, keys, clear=True):
+    """Fill a temporary one-column table with keys, for joining stored tables against"""
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS wanted_keys (key TEXT PRIMARY KEY)")
+    if clear:
+        conn.execute("DELETE FROM wanted_keys")
+    # Inserting in key order keeps the B-tree writes sequential
+    conn.executemany("INSERT OR IGNORE INTO wanted_keys (key) VALUES (?)",
+                     ((key,) for key in sorted(keys)))
+    return 'temp.wanted_keys'
+
+
+def _as_fields(values):
+    """A typed column as CSV field text (None for missing values)"""
+    if isinstance(values.dtype, pd.DatetimeTZDtype):
+        # ISO 8601 in UTC, with as many digits as each value needs
+        fields = np.datetime_as_string(values.dt.tz_convert(None).to_numpy(), unit='auto')
+        fields = fields.astype(object)
+    else:
+        fields = values.astype(str).to_numpy(dtype=object)
+    fields[values.isna().to_numpy()] = None
+    return fields.tolist()
+
+
+def save_referral_inputs(conn, referrals):
+    """
+    Insert or replace the input rows of referrals in INPUTS_TABLE; written
+    in the open transaction, so they are committed with the report upsert
+
+    Args:
+        referrals: typed user_referrals rows (text ids)
+    """
+    columns = ', '.join(INPUT_COLUMNS)
+    placeholders = ', '.join('?' for _ in INPUT_COLUMNS)
+    referrals = referrals.sort_values(REPORT_KEY, kind='stable')
+    fields = [_as_fields(referrals[column]) for column in INPUT_COLUMNS]
+    conn.executemany(f"INSERT OR REPLACE INTO {INPUTS_TABLE} ({columns}) VALUES ({placeholders})",
+                     zip(*fields))
+
+
+def _load_inputs(conn, column, keys):
+    """
+    Stored input rows whose column holds one of keys
+
+    The rows are typed like a read of the input file (see
+    schema.read_records), so they score as the file's rows would.
+
+    Returns:
+        Typed user_referrals DataFrame (text ids) in store order
+    """
+    table = _key_table(conn, keys)
+    columns = ', '.join(f'r.{name}' for name in INPUT_COLUMNS)
+    stored = pd.read_sql_query(f"SELECT {columns} FROM {INPUTS_TABLE} r "
+                               f"JOIN {table} k ON r.{column} = k.key ORDER BY r.rowid", conn)
+    return read_records(stored.to_dict('records'), FACT_TABLE)
+
+
+def load_inputs_between(conn, starts, ends):
+    """
+    Stored input rows with referral_at in any of the ranges [starts[i], ends[i]],
+    through the referral_at index
+
+    Stored times are ISO 8601 text with only the digits each needs (a
+    midnight is just the date), so the ranges are widened to whole UTC
+    days, whose text order is their time order; the caller picks the rows
+    it needs from the result.
+
+    Args:
+        starts, ends: Series of UTC timestamps (missing ones are skipped)
+
+    Returns:
+        Typed user_referrals DataFrame (text ids, see _load_inputs)
+    """
+    ranges = pd.DataFrame({'start': starts.dt.floor('D').to_numpy(),
+                           'end': (ends.dt.floor('D') + pd.Timedelta(days=1)).to_numpy()})
+    ranges = ranges.dropna().sort_values('start', kind='stable')
+    # Overlapping ranges are merged, so each row is read once
+    merged = (ranges['start'] > ranges['end'].cummax().shift()).cumsum()
+    ranges = ranges.groupby(merged).agg(start=('start', 'min'), end=('end', 'max'))
+
+    columns = ', '.join(INPUT_COLUMNS)
+    stored = [pd.read_sql_query(f"SELECT {columns} FROM {INPUTS_TABLE} "
+                                "WHERE referral_at >= ? AND referral_at < ? ORDER BY rowid", conn,
+                                params=(start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')))
+              for start, end in zip(ranges['start'], ranges['end'])]
+    stored = pd.concat(stored, ignore_index=True) if stored else pd.DataFrame(columns=INPUT_COLUMNS)
+    return read_records(stored.to_dict('records'), FACT_TABLE)
+
+
+def load_referral_inputs(conn, referral_ids):
+    """Stored input rows of referrals, looked up by referral_id (see _load_inputs)"""
+    return _load_inputs(conn, REPORT_KEY, referral_ids)
+
+
+def load_referrer_inputs(conn, referrer_ids):
+    """Stored input rows of every referral by these referrers, through the referrer_id index"""
+    return _load_inputs(conn, 'referrer_id', referrer_ids)
+
+
+def _stored_clusters(conn, table):
+    """node, cluster and size of every identifier in the stored clusters of a key table's nodes"""
+    return pd.read_sql_query(
+        f"SELECT n.node, n.cluster, c.size FROM {NODES_TABLE} n "
+        f"JOIN {CLUSTERS_TABLE} c ON c.cluster = n.cluster "
+        f"WHERE n.cluster IN (SELECT m.cluster FROM {NODES_TABLE} m JOIN {table} k ON m.node = k.key)",
+        conn)
+
+
+def _linked_referrals(conn, table):
+    """referral_id and IDENTITY_SOURCE_COLUMNS of the stored referrals holding a key table's nodes"""
+    columns = ', '.join(f'r.{column}' for column in [REPORT_KEY] + IDENTITY_SOURCE_COLUMNS)
+    # One indexed join per column; UNION drops the referrals found twice
+    return pd.read_sql_query(' UNION '.join(
+        f"SELECT {columns} FROM {INPUTS_TABLE} r JOIN {table} k ON r.{column} = k.key"
+        for column in IDENTITY_SOURCE_COLUMNS), conn)
+
+
+def update_identity_clusters(conn, seeds, user_logs_clean):
+    """
+    Rebuild the stored clusters (STEP 5c) the changed rows touch
+
+    Links only appear or disappear with changed rows, so every other
+    cluster is still as stored. The stored clusters of the seed
+    identifiers are rebuilt from the current links of their identifiers:
+    the stored referral inputs holding them (found through the column
+    indexes) and the user_logs rows. When that reaches identifiers of
+    other stored clusters (a changed row linked them), those clusters are
+    pulled in too, so merges and splits come out as in a full build.
+
+    Args:
+        conn: store connection from open_store; INPUTS_TABLE must already
+              hold the changed referrals' new rows
+        seeds: identifiers of the changed referrals' previous and new rows
+               and of the changed users (text)
+        user_logs_clean: deduplicated user_logs table (text ids)
+
+    Returns:
+        set of referral ids whose cluster_id or cluster_size changed
+    """
+    users = user_logs_clean[['user_id', 'phone_number']]
+    nodes = set(seeds)
+    table = _key_table(conn, nodes)
+    while True:
+        previous = _stored_clusters(conn, table)
+        added = set(previous['node']) - nodes
+        _key_table(conn, added, clear=False)
+        nodes |= added
+
+        referrals = _linked_referrals(conn, table)
+        wanted = pd.Index(list(nodes))
+        linked = users[((wanted.get_indexer(users['user_id']) >= 0)
+                        | (wanted.get_indexer(users['phone_number']) >= 0))]
+        current = set(pd.concat([referrals[column] for column in IDENTITY_SOURCE_COLUMNS]
+                                + [linked[column] for column in linked.columns]).dropna())
+        added = current - nodes
+        if not added:
+            break
+        _key_table(conn, added, clear=False)
+        nodes |= added
+
+    clusters = IdentityClusters(referrals, {'user_logs_clean': linked}).node_clusters()
+    compared = clusters.merge(previous, on='node', how='outer', suffixes=('', '_previous'))
+    # New and dropped identifiers compare unequal against the missing side
+    changed = ((compared['cluster'] != compared['cluster_previous'])
+               | (compared['size'] != compared['size_previous']))
+    changed_nodes = pd.Index(compared.loc[changed.to_numpy(), 'node'])
+    # A referral is in the cluster of the first of REFERRAL_NODE_COLUMNS it has
+    roots = referrals[REFERRAL_NODE_COLUMNS[-1]]
+    for column in reversed(REFERRAL_NODE_COLUMNS[:-1]):
+        roots = referrals[column].where(referrals[column].notna(), roots)
+    affected = set(referrals.loc[changed_nodes.get_indexer(roots) >= 0, REPORT_KEY])
+
+    # A stored cluster's label is one of its nodes, so the key table holds
+    # the labels of every cluster rebuilt here
+    conn.execute(f"DELETE FROM {CLUSTERS_TABLE} WHERE cluster IN (SELECT key FROM {table})")
+    conn.execute(f"DELETE FROM {NODES_TABLE} WHERE node IN (SELECT key FROM {table})")
+    _insert_clusters(conn, clusters)
+    return affected
+
+
+def _insert_clusters(conn, clusters):
+    """Write node_clusters() rows into NODES_TABLE and CLUSTERS_TABLE"""
+    clusters = clusters.sort_values('node')
+    conn.executemany(f"INSERT INTO {NODES_TABLE} (node, cluster) VALUES (?, ?)",
+                     zip(clusters['node'].tolist(), clusters['cluster'].tolist()))
+    sizes = clusters[['cluster', 'size']].drop_duplicates().sort_values('cluster')
+    conn.executemany(f"INSERT INTO {CLUSTERS_TABLE} (cluster, size) VALUES (?, ?)",
+                     zip(sizes['cluster'].tolist(), sizes['size'].tolist()))
+
+
+def replace_identity_clusters(conn, clusters):
+    """
+    Store clusters built from every referral, replacing the stored ones
+    (a first run, which has all referrals at hand)
+
+    Args:
+        conn: store connection from open_store
+        clusters: IdentityClusters.node_clusters() of the whole graph (text ids)
+    """
+    conn.execute(f"DELETE FROM {NODES_TABLE}")
+    conn.execute(f"DELETE FROM {CLUSTERS_TABLE}")
+    # Indexing the nodes afterwards is quicker than updating the index per row
+    conn.execute(f"DROP INDEX IF EXISTS {NODES_TABLE}_cluster")
+    _insert_clusters(conn, clusters)
+    conn.execute(NODES_INDEX)
+
+
+def stored_clusters(conn, referrals):
+    """
+    Stored clusters of referrals' identifiers (see update_identity_clusters)
+
+    Args:
+        conn: store connection from open_store
+        referrals: rows with REFERRAL_NODE_COLUMNS (text ids)
+
+    Returns:
+        DataFrame with node, cluster and size columns
+    """
+    nodes = pd.concat([referrals[column] for column in REFERRAL_NODE_COLUMNS]).dropna()
+    table = _key_table(conn, set(nodes))
+    return pd.read_sql_query(f"SELECT n.node, n.cluster, c.size FROM {NODES_TABLE} n "
+                             f"JOIN {table} k ON n.node = k.key "
+                             f"JOIN {CLUSTERS_TABLE} c ON c.cluster = n.cluster", conn)
+
+
+def referrals_in_windows(changed, previous, referrals, window, key='referrer_id'):
+    """
+    referral_ids whose velocity windows a changed referral enters or leaves
+
+    A referral counts the referrals with the same key (its referrer, or its
+    transaction location) in the window before it (see velocity.py), so
+    every referral with the key up to window after a changed referral's
+    new time, or its time in the previous run, is rescored.
+
+    Args:
+        changed: referrals being rescored, with referral_id, key and
+                 referral_at (text ids)
+        previous: the stored rows of those referrals from the previous
+                  run, with the same columns
+        referrals: every referral with the changed and previous rows'
+                   keys in those windows, with the same columns
+        window: the longest velocity window of the key (Timedelta)
+        key: referrer_id or transaction_location
+
+    Returns:
+        set of referral ids to rescore
+    """
+    columns = [REPORT_KEY, key, 'referral_at']
+
+    def by_time(frame):
+        frame = frame[columns].dropna(subset=[key, 'referral_at'])
+        frame = frame.astype({key: 'str', 'referral_at': 'datetime64[ns, UTC]'})
+        return frame.sort_values('referral_at', kind='stable')
+
+    moves = by_time(pd.concat([changed[columns], previous[columns]], ignore_index=True))
+    moves = moves.rename(columns={'referral_at': 'moved_at'}).drop(columns=REPORT_KEY)
+    # The latest change at or before each referral, with the same key
+    latest = pd.merge_asof(by_time(referrals), moves, left_on='referral_at',
+                           right_on='moved_at', by=key, direction='backward')
+    inside = (latest['referral_at'] - latest['moved_at']) <= window
+    return set(latest.loc[inside.fillna(False).to_numpy(), REPORT_KEY])
+
+
+def upsert_report(conn, report):
+    """
+    Insert or replace report rows keyed on referral_id
+
+    Args:
+        conn: store connection from open_store
+        report: DataFrame in the published report layout
+
+    Returns:
+        Number of rows written
+    """
+    columns = ', '.join(f'"{column}"' for column in report.columns)
+    conn.execute(f'CREATE TABLE IF NOT EXISTS {REPORT_TABLE} ({columns}, '
+                 f'PRIMARY KEY ("{REPORT_KEY}"))')
+    # Stores created before a report column was added get it (empty for old rows)
+    stored = {row[1] for row in conn.execute(f'PRAGMA table_info({REPORT_TABLE})')}
+    for column in report.columns:
+        if column not in stored:
+            conn.execute(f'ALTER TABLE {REPORT_TABLE} ADD COLUMN "{column}"')
+
+    report.to_sql(STAGING_TABLE, conn, if_exists='replace', index=False)
+    conn.execute(f'INSERT OR REPLACE INTO {REPORT_TABLE} ({columns}) '
+                 f'SELECT {columns} FROM {STAGING_TABLE}')
+    conn.execute(f'DROP TABLE {STAGING_TABLE}')
+    conn.commit()
+    return len(report)
+
+
+def read_report(conn):
+    """
+    The whole report store with the report's column types, in store order
+
+    SQLite hands timestamps back as text and booleans as 0/1; they are
+    converted back so the rows can be written like a full run's report.
+    """
+    report = pd.read_sql_query(f'SELECT * FROM {REPORT_TABLE} ORDER BY rowid', conn)
+    for column in REPORT_SCHEMA:
+        if column.name not in report.columns:
+            report[column.name] = None
+        if column.data_type == 'DATETIME':
+            report[column.name] = pd.to_datetime(report[column.name], format='ISO8601')
+        elif column.data_type == 'BOOLEAN':
+            report[column.name] = report[column.name].astype('boolean')
+    return report[[column.name for column in REPORT_SCHEMA]]
+
+
+def export_report(conn, path, output_format='csv', index=True):
+    """
+    Write the whole report store as a report file (see report_sinks.write_report)
+
+    Args:
+        conn: open store connection
+        path: report path (see report_sinks.report_path)
+        output_format: 'csv', 'csv.gz' or 'parquet'
+        index: also write the sidecar index for query_report.py
+
+    Returns:
+        The writer's summary
+    """
+    return write_report(read_report(conn), path, output_format, index)
@@ -0,0 +1,182 @@
+"""
+Run Instrumentation
+Purpose: Record wall and CPU time, memory and row counts for every stage of
+         a pipeline or profiling run, write them as a JSON run report, and
+         optionally cProfile one chosen stage
+"""
+
+import cProfile
+import json
+import os
+import platform
+import re
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # not available on Windows; peak RSS is then omitted
+    resource = None
+
+REPORT_FORMAT_VERSION = 1
+
+
+def peak_rss_bytes():
+    """High-water resident set size of this process, or None if unknown"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def current_rss_bytes():
+    """Resident set size right now (read from /proc on Linux), or None"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def summarize_joins(join_stats):
+    """
+    Combine per-join row counts (e.g. from several chunks) per dimension
+
+    Args:
+        join_stats: list of dicts from pipeline_stages.join_referrals
+
+    Returns:
+        list with one dict per dimension, in first-seen order
+    """
+    totals = {}
+    for join in join_stats:
+        total = totals.setdefault(join['dimension'], {
+            'dimension': join['dimension'], 'method': join.get('method'),
+            'rows_in': 0, 'rows_out': 0, 'unmatched': 0,
+            'duplicate_keys': join.get('duplicate_keys', 0),
+        })
+        total['rows_in'] += join['rows_in']
+        total['rows_out'] += join['rows_out']
+        total['unmatched'] += join.get('unmatched', 0)
+    for total in totals.values():
+        total['fan_out'] = total['rows_out'] / total['rows_in'] if total['rows_in'] else 1.0
+    return list(totals.values())
+
+
+class RunReport:
+    """
+    Collects one record per stage of a run
+
+    Usage:
+        report = RunReport('pipeline')
+        with report.stage('STEP 4 join', rows_in=len(referrals)) as stage:
+            df = join_referrals(referrals, dims)
+            stage['rows_out'] = len(df)
+        report.write('output/pipeline_run_report.json')
+
+    Every record gets seconds, cpu_seconds, the RSS change and the process
+    peak RSS; with trace_memory=True also the tracemalloc peak above the
+    memory traced when the stage started. The stage named profile_stage
+    (e.g. 'STEP 4', matching 'STEP 4 join') runs under cProfile and its
+    stats are dumped to profile_dir.
+    """
+
+    def __init__(self, name, trace_memory=False, profile_stage=None, profile_dir='.'):
+        self.name = name
+        self.trace_memory = trace_memory
+        self.profile_stage = profile_stage
+        self.profile_dir = profile_dir
+        self.details = {}
+        self.stages = []
+        self.started_at = datetime.now()
+        self._started = time.perf_counter()
+        self._owns_tracing = trace_memory and not tracemalloc.is_tracing()
+        if self._owns_tracing:
+            tracemalloc.start()
+
+    def _is_profiled(self, stage_name):
+        if not self.profile_stage:
+            return False
+        wanted = self.profile_stage.lower()
+        name = stage_name.lower()
+        return name == wanted or name.startswith(wanted + ' ')
+
+    def _profile_path(self, stage_name):
+        slug = re.sub(r'[^a-z0-9]+', '_', stage_name.lower()).strip('_')
+        return os.path.join(self.profile_dir, f'{self.name}_{slug}.prof')
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        """Measure the enclosed block; yields the record dict to add fields to"""
+        record = {'stage': name}
+        if rows_in is not None:
+            record['rows_in'] = rows_in
+
+        profiler = cProfile.Profile() if self._is_profiled(name) else None
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            traced_before = tracemalloc.get_traced_memory()[0]
+        rss_before = current_rss_bytes()
+        wall_started = time.perf_counter()
+        cpu_started = time.process_time()
+        if profiler is not None:
+            profiler.enable()
+
+        try:
+            yield record
+        except BaseException as e:
+            record['error'] = repr(e)
+            raise
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            record['seconds'] = time.perf_counter() - wall_started
+            record['cpu_seconds'] = time.process_time() - cpu_started
+            if self.trace_memory:
+                record['peak_traced_bytes'] = tracemalloc.get_traced_memory()[1] - traced_before
+            rss_after = current_rss_bytes()
+            if rss_before is not None and rss_after is not None:
+                record['rss_delta_bytes'] = rss_after - rss_before
+            record['peak_rss_bytes'] = peak_rss_bytes()
+            if profiler is not None:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                record['profile_file'] = self._profile_path(name)
+                profiler.dump_stats(record['profile_file'])
+            self.stages.append(record)
+
+    def close(self):
+        """Stop memory tracing started by this report"""
+        if self._owns_tracing and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self._owns_tracing = False
+
+    def to_dict(self):
+        return {
+            'format_version': REPORT_FORMAT_VERSION,
+            'run': self.name,
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'total_seconds': time.perf_counter() - self._started,
+            'peak_rss_bytes': peak_rss_bytes(),
+            'python': platform.python_version(),
+            'details': self.details,
+            'stages': self.stages,
+        }
+
+    def write(self, path):
+        """Write the report as JSON (and stop memory tracing)"""
+        self.close()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, default=str)
+        return path
+
+    def print_summary(self):
+        for record in self.stages:
+            rows = f" -> {record['rows_out']} rows" if 'rows_out' in record else ''
+            print(f"    - {record['stage']:<34} {record['seconds']:8.3f}s{rows}")
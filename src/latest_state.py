@@ -0,0 +1,176 @@
+"""
+Latest-State Store
+Purpose: Keep the latest row per key of the append-only event logs
+         (user_referral_logs, lead_logs) on disk and bring it up to date from
+         the rows appended since the last run, instead of re-reading and
+         re-sorting the whole history
+"""
+
+import json
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from schema import TABLE_SCHEMAS, input_path, read_csv_appended
+from table_cache import file_content_hash, read_table, schema_fingerprint, source_change
+
+try:
+    from pyarrow import feather
+except ImportError:  # without pyarrow the latest rows are recomputed from the full log
+    feather = None
+
+LATEST_STATE_DIR_NAME = '.latest_state'
+
+# Bump when the stored state changes shape so old entries are rebuilt
+LATEST_STATE_VERSION = 1
+
+
+def latest_rows(table, key, order_by):
+    """
+    Latest row per key: the row with the greatest order_by timestamp
+
+    Selects the same rows as a stable sort on order_by followed by
+    drop_duplicates(key, keep='last'): among equal timestamps the row
+    further down wins, and a missing timestamp counts as later than any
+    other. One hash group-by finds each key's row in linear time, without
+    sorting the table; the rows keep their table order.
+
+    Args:
+        table: DataFrame with a key column and a datetime order_by column
+        key: column to keep one row per value of (missing values form one key)
+        order_by: timestamp column
+
+    Returns:
+        DataFrame with one row per key
+    """
+    if table.empty:
+        return table
+    codes, _ = pd.factorize(table[key], use_na_sentinel=False)
+    stamps = table[order_by]
+    stamps = np.where(stamps.isna().to_numpy(), np.iinfo(np.int64).max, stamps.array.asi8)
+
+    # idxmax keeps the first maximum; run it bottom-up so the last one wins
+    last = pd.Series(stamps[::-1]).groupby(codes[::-1], sort=False).idxmax().to_numpy()
+    keep = np.zeros(len(table), dtype=bool)
+    keep[len(table) - 1 - last] = True
+    return table[keep]
+
+
+def default_state_dir(data_dir):
+    """State location used when none is given: a hidden folder inside data_dir"""
+    return os.path.join(data_dir, LATEST_STATE_DIR_NAME)
+
+
+def _entry_paths(state_dir, table_name):
+    base = os.path.join(state_dir, table_name)
+    return base + '.arrow', base + '.json'
+
+
+def _load_manifest(manifest_path):
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _append_rows(stored, appended):
+    """stored followed by appended, with categories as a full read would give them"""
+    combined = pd.concat([stored, appended], ignore_index=True)
+    for column in stored.columns:
+        if isinstance(stored[column].dtype, pd.CategoricalDtype):
+            combined[column] = union_categoricals([stored[column], appended[column]],
+                                                  sort_categories=True)
+    return combined
+
+
+def _store(state_dir, table_name, latest, manifest):
+    """Save the latest rows (None: only the manifest changed) and their manifest"""
+    arrow_path, manifest_path = _entry_paths(state_dir, table_name)
+    try:
+        os.makedirs(state_dir, exist_ok=True)
+        if latest is not None:
+            tmp_path = f'{arrow_path}.{os.getpid()}.tmp'
+            feather.write_feather(latest.reset_index(drop=True), tmp_path,
+                                  compression='uncompressed')
+            os.replace(tmp_path, arrow_path)
+
+        tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, manifest_path)
+    except OSError as e:
+        warnings.warn(f"Could not write latest state for {table_name}: {e}")
+
+
+def read_latest(data_dir, dedup, state_dir=None, use_cache=True, engine=None, columns=None):
+    """
+    Latest row per key of an event log, from the stored state where possible
+
+    An unchanged log is answered from the stored state alone. When rows
+    were only appended (TableSchema.append_only), just those rows are
+    parsed and combined with the stored latest rows. Otherwise the whole
+    log is read. The state is then saved for the next run.
+
+    Args:
+        data_dir: directory holding the input CSV files
+        dedup: pipeline_stages.DimensionDedup with table, key and order_by
+        state_dir: state location (default: data_dir/.latest_state)
+        use_cache: False to read the whole log and leave the state untouched
+        engine: CSV parser for whole-table reads (see schema.read_csv_table)
+        columns: optional subset of columns to return (the state keeps them all)
+
+    Returns:
+        (DataFrame of latest rows, 'hit' / 'appended' / 'miss', or None
+        when the state is not used)
+    """
+    table_name = dedup.table
+    if not use_cache or feather is None:
+        table = read_table(data_dir, table_name, columns=columns, engine=engine,
+                           use_cache=use_cache)
+        return latest_rows(table, dedup.key, dedup.order_by), None
+
+    state_dir = state_dir or default_state_dir(data_dir)
+    arrow_path, manifest_path = _entry_paths(state_dir, table_name)
+    source = os.path.abspath(input_path(data_dir, table_name))
+    stat = os.stat(source)
+    current = {
+        'version': LATEST_STATE_VERSION,
+        'source': source,
+        'schema': schema_fingerprint(table_name),
+        'key': dedup.key,
+        'order_by': dedup.order_by,
+    }
+
+    manifest = _load_manifest(manifest_path)
+    change = 'changed'
+    if (manifest is not None and os.path.exists(arrow_path)
+            and all(manifest.get(name) == value for name, value in current.items())):
+        change, content_hash = source_change(source, manifest, TABLE_SCHEMAS[table_name].append_only)
+
+    if change == 'same':
+        status = 'hit'
+        latest = feather.read_feather(arrow_path, columns=columns)
+    elif change == 'appended':
+        status = 'appended'
+        appended = read_csv_appended(data_dir, table_name, manifest['size'])
+        latest = latest_rows(_append_rows(feather.read_feather(arrow_path), appended),
+                             dedup.key, dedup.order_by)
+    else:
+        status = 'miss'
+        content_hash = file_content_hash(source)
+        table = read_table(data_dir, table_name, engine=engine)
+        latest = latest_rows(table, dedup.key, dedup.order_by)
+
+    if status != 'hit' or manifest['mtime_ns'] != stat.st_mtime_ns:
+        # A touched but unchanged log only needs its manifest refreshed
+        _store(state_dir, table_name, latest if status != 'hit' else None, {
+            **current, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'content_hash': content_hash,
+        })
+    if columns is not None and status != 'hit':
+        latest = latest[list(columns)]
+    return latest, status
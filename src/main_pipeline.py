@@ -3,310 +3,838 @@ Referral Program Data Pipeline
 Purpose: Process referral data and detect potential fraud with reasons
 Author: Data Engineer Intern
 Company: Springer Capital
+
+Run it from the command line (python src/main_pipeline.py --help) or call
+run_pipeline(PipelineConfig(...)) from Python. Importing this module has no
+side effects; pandas and the pipeline modules are imported on first use so
+--help answers immediately.
 """
 
-import pandas as pd
-import numpy as np
+import argparse
 import os
-from datetime import datetime
-import pytz
 import sys
+from dataclasses import dataclass
+from datetime import datetime
 
-print("=" * 80)
-print("REFERRAL PROGRAM DATA PIPELINE")
-print("=" * 80)
-print(f"Started at: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-print(f"Python version: {sys.version}")
-print(f"Pandas version: {pd.__version__}")
-print(f"Current directory: {os.getcwd()}\n")
-
-# CONFIG
-DATA_DIR = 'data'
-OUTPUT_DIR = 'output'
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-print(f"✓ Output directory: {OUTPUT_DIR}\n")
-
-# STEP 1 — LOAD FILES
-print("STEP 1: Loading CSV files...")
-
-lead_logs = pd.read_csv(os.path.join(DATA_DIR, 'lead_log(in).csv'))
-user_referrals = pd.read_csv(os.path.join(DATA_DIR, 'user_referrals(in).csv'))
-user_referral_logs = pd.read_csv(os.path.join(DATA_DIR, 'user_referral_logs(in).csv'))
-user_logs = pd.read_csv(os.path.join(DATA_DIR, 'user_logs(in).csv'))
-user_referral_statuses = pd.read_csv(os.path.join(DATA_DIR, 'user_referral_statuses(in).csv'))
-referral_rewards = pd.read_csv(os.path.join(DATA_DIR, 'referral_rewards(in).csv'))
-paid_transactions = pd.read_csv(os.path.join(DATA_DIR, 'paid_transactions(in).csv'))
-
-print("  ✓ All files loaded.\n")
-
-# STEP 2 — CLEANING
-print("STEP 2: Cleaning data...")
-
-for df in [lead_logs, user_referrals, user_referral_logs, user_logs,
-           user_referral_statuses, referral_rewards, paid_transactions]:
-    df.replace(['null', ''], np.nan, inplace=True)
-
-user_logs_clean = user_logs.drop_duplicates(subset=['user_id'], keep='first')
-lead_logs_clean = lead_logs.sort_values('created_at').drop_duplicates(subset=['lead_id'], keep='last')
-
-print("  ✓ Cleaned & removed duplicates\n")
-
-# STEP 3 — TIME PROCESSING
-print("STEP 3: Processing data...")
-
-def convert_utc_to_local(utc_time_str, timezone_str):
-    if pd.isna(utc_time_str) or pd.isna(timezone_str):
-        return None
-    try:
-        utc_time = pd.to_datetime(utc_time_str, utc=True)
-        tz = pytz.timezone(timezone_str)
-        return utc_time.astimezone(tz).replace(tzinfo=None)
-    except:
-        return None
-
-paid_transactions['transaction_at_local'] = paid_transactions.apply(
-    lambda r: convert_utc_to_local(r['transaction_at'], r['timezone_transaction']), axis=1
-)
-
-lead_logs_clean['created_at_local'] = lead_logs_clean.apply(
-    lambda r: convert_utc_to_local(r['created_at'], r['timezone_location']), axis=1
-)
-
-referral_rewards['num_reward_days'] = referral_rewards['reward_value'].apply(
-    lambda v: int(str(v).split()[0]) if pd.notna(v) else None
-)
-
-print("  ✓ Time conversion & reward parsing complete\n")
-
-# STEP 4 — JOIN TABLES
-print("STEP 4: Joining tables...")
-
-df = user_referrals.copy()
-
-latest_logs = user_referral_logs.sort_values("created_at").drop_duplicates(
-    subset=["user_referral_id"], keep="last"
-)
-
-df = df.merge(latest_logs, left_on='referral_id', right_on='user_referral_id', how='left')
-df = df.merge(user_referral_statuses[['id', 'description']], 
-              left_on='user_referral_status_id', right_on='id', how='left')
-df.rename(columns={'description': 'referral_status'}, inplace=True)
-
-df = df.merge(referral_rewards[['id', 'num_reward_days']], 
-              left_on='referral_reward_id', right_on='id', how='left')
-
-df = df.merge(
-    paid_transactions[['transaction_id', 'transaction_status', 'transaction_at_local',
-                       'transaction_location', 'transaction_type']],
-    on='transaction_id', how='left'
-)
-
-df = df.merge(
-    user_logs_clean[['user_id', 'name', 'phone_number', 'homeclub',
-                     'timezone_homeclub', 'membership_expired_date', 'is_deleted']],
-    left_on='referrer_id', right_on='user_id', how='left'
-)
-
-df.rename(columns={
-    'name': 'referrer_name',
-    'phone_number': 'referrer_phone_number',
-    'homeclub': 'referrer_homeclub',
-    'timezone_homeclub': 'referrer_timezone',
-    'membership_expired_date': 'referrer_membership_expired',
-    'is_deleted': 'referrer_is_deleted'
-}, inplace=True)
-
-df = df.merge(
-    lead_logs_clean[['lead_id', 'source_category', 'timezone_location']],
-    left_on='referee_id', right_on='lead_id', how='left'
-)
-
-print("  ✓ Joined tables successfully\n")
-
-# STEP 5 — REFERRAL TIMESTAMPS
-print("STEP 5: Adjusting timestamps...")
-
-df['referral_at_local'] = df.apply(
-    lambda r: convert_utc_to_local(
-        r['referral_at'], 
-        r['referrer_timezone'] if pd.notna(r['referrer_timezone']) 
-        else r['timezone_location']
-    ),
-    axis=1
-)
-
-df['updated_at_local'] = df.apply(
-    lambda r: convert_utc_to_local(
-        r['updated_at'], 
-        r['referrer_timezone'] if pd.notna(r['referrer_timezone']) else 'Asia/Jakarta'
-    ),
-    axis=1
-)
-
-df['reward_granted_at'] = df.apply(
-    lambda r: convert_utc_to_local(
-        r['created_at'], 
-        r['referrer_timezone'] if pd.notna(r['referrer_timezone']) else 'Asia/Jakarta'
-    ),
-    axis=1
-)
-
-print("  ✓ Timestamp conversion complete\n")
-
-# STEP 6 — SOURCE CATEGORY
-print("STEP 6: Determining referral source...")
-
-def get_source_category(row):
-    if row['referral_source'] == 'User Sign Up': return 'Online'
-    if row['referral_source'] == 'Draft Transaction': return 'Offline'
-    if row['referral_source'] == 'Lead': return row['source_category']
-    return None
-
-df['referral_source_category'] = df.apply(get_source_category, axis=1)
-
-print("  ✓ Referral source category assigned\n")
-
-# STEP 7 — INITCAP
-print("STEP 7: Normalizing text...")
-
-for col in ['referrer_name', 'referee_name', 'referral_status',
-            'transaction_status', 'transaction_type',
-            'referral_source', 'referral_source_category']:
-    df[col] = df[col].apply(lambda v: str(v).title() if pd.notna(v) else v)
-
-print("  ✓ String normalization done\n")
-
-# STEP 8 — FRAUD DETECTION + REASON
-print("STEP 8: Running fraud detection rules...")
-
-df['referrer_membership_expired'] = pd.to_datetime(
-    df['referrer_membership_expired'], errors='coerce'
-)
-
-def fraud_reason(row):
-    reward = row['num_reward_days']
-    status = row['referral_status']
-    tid = row['transaction_id']
-    tstatus = row['transaction_status']
-    ttype = row['transaction_type']
-    ra = row['referral_at_local']
-    ta = row['transaction_at_local']
-    exp = row['referrer_membership_expired']
-    deleted = str(row['referrer_is_deleted']).upper() == "TRUE"
-    granted = str(row['is_reward_granted']).upper() == "TRUE"
-
-    if pd.notna(reward) and reward > 0 and status != 'Berhasil':
-        return "Reward > 0 but status not Berhasil"
-    if pd.notna(reward) and reward > 0 and pd.isna(tid):
-        return "Reward > 0 but no transaction ID"
-    if (pd.isna(reward) or reward == 0) and pd.notna(tid) and tstatus == "Paid":
-        return "Paid transaction but reward = 0"
-    if pd.notna(ra) and pd.notna(ta) and ta < ra:
-        return "Transaction before referral"
-    if pd.notna(exp) and pd.notna(ra) and exp <= ra:
-        return "Membership expired before referral"
-    if pd.notna(reward) and reward > 0 and deleted:
-        return "Account deleted but reward given"
-    if pd.notna(reward) and reward > 0 and pd.notna(ra) and pd.notna(ta):
-        if ra.month != ta.month or ra.year != ta.year:
-            return "Transaction month does not match referral month"
-    if status == 'Berhasil' and (pd.isna(reward) or reward == 0):
-        return "Successful status but no reward"
-    if pd.notna(reward) and reward > 0 and status == 'Berhasil' and not granted:
-        return "Reward not granted but status Berhasil"
-
+RUN_MODES = ('full', 'incremental')
+CSV_ENGINES = ('auto', 'pyarrow', 'c')
+# STEP 10 report formats (see report_sinks.py); 'parquet' is partitioned by month and validity
+OUTPUT_FORMATS = ('csv', 'csv.gz', 'parquet')
+
+# Rows per read when incremental mode scans user_referrals for changes
+INCREMENTAL_READ_SIZE = 1_000_000
+
+STORE_FILE_NAME = 'referral_fraud_detection.db'
+RUN_REPORT_FILE_NAME = 'pipeline_run_report.json'
+
+
+@dataclass(frozen=True)
+class PipelineConfig:
+    """Settings for one pipeline run"""
+    data_dir: str = 'data'
+    output_dir: str = 'output'
+    # 'full' rewrites the report; 'incremental' upserts only changed referrals
+    mode: str = 'full'
+    # Stream user_referrals in chunks of this many rows (None: whole table)
+    chunk_size: int | None = None
+    # CSV parser for whole-table reads; 'auto' uses pyarrow when installed
+    engine: str = 'auto'
+    use_cache: bool = True
+    # Processes scoring hash partitions of user_referrals in full runs (0: one per CPU)
+    workers: int = 1
+    # Report format in full runs, and whether it is written on a background
+    # thread and gets the sidecar index query_report.py reads
+    output_format: str = 'csv'
+    background_write: bool = False
+    write_index: bool = True
+    # Incremental runs: also write the whole store to output_file (in output_format)
+    export: bool = False
+    # Peak memory target in bytes: tables are downcast to their smallest
+    # dtypes and the run reports its peak RSS against it (None: off)
+    memory_budget: int | None = None
+    # Record tracemalloc peaks per stage (slows Python-level stages down)
+    trace_memory: bool = False
+    # Stage to run under cProfile, e.g. 'STEP 4' (stats go to output_dir)
+    profile_stage: str | None = None
+
+    @property
+    def output_file(self):
+        from report_sinks import report_path
+
+        return report_path(self.output_dir, self.output_format)
+
+    @property
+    def store_file(self):
+        return os.path.join(self.output_dir, STORE_FILE_NAME)
+
+    @property
+    def run_report_file(self):
+        return os.path.join(self.output_dir, RUN_REPORT_FILE_NAME)
+
+    @property
+    def worker_count(self):
+        return self.workers or os.cpu_count() or 1
+
+    @property
+    def read_options(self):
+        """Keyword arguments for table_cache.read_table / read_tables"""
+        return {
+            'engine': None if self.engine == 'auto' else self.engine,
+            'use_cache': self.use_cache,
+        }
+
+
+def print_rule_hits(rule_hits):
+    for _, hit in rule_hits[rule_hits['Total Hits'] > 0].iterrows():
+        print(f"    - bit {hit['Bit']} {hit['Rule']}: {hit['Total Hits']} hits "
+              f"({hit['Reported Hits']} reported, {hit['Exclusive Hits']} exclusive)")
+
+
+def print_fan_out(joins):
+    for join in joins:
+        if join['rows_out'] != join['rows_in']:
+            print(f"  ⚠ {join['dimension']} has {join['duplicate_keys']} duplicate keys: "
+                  f"{join['rows_in']} rows became {join['rows_out']} (fan-out x{join['fan_out']:.3f})")
+
+
+def open_report_sink(config):
+    """STEP 10 writer for config.output_file (see report_sinks.open_sink)"""
+    from report_sinks import open_sink
+
+    return open_sink(config.output_file, config.output_format,
+                     index=config.write_index, background=config.background_write)
+
+
+def print_saved(summary):
+    index = f" (index: {summary['index']})" if summary['index'] else ''
+    print(f"  ✓ Report saved to: {summary['path']}{index}")
+    print(f"  - {summary['rows']} rows in {summary['blocks']} blocks, "
+          f"{summary['bytes'] / 2**20:.1f} MiB ({summary['format']})")
+
+
+def print_memory_budget(budget):
+    """Peak memory of the run against its budget (see memory_budget.budget_summary)"""
+    from memory_budget import format_bytes
+
+    if budget['peak_rss_bytes'] is None:
+        print("  ⚠ Peak memory is not available on this platform")
+        return
+    peak = format_bytes(budget['peak_rss_bytes'])
+    limit = format_bytes(budget['budget_bytes'])
+    if budget['within_budget']:
+        print(f"  ✓ Peak memory {peak} within the {limit} budget")
+    else:
+        print(f"  ⚠ Peak memory {peak} exceeded the {limit} budget; stream "
+              f"user_referrals with a (smaller) --chunk-size")
+
+
+def new_run_report(config):
+    """RunReport for a pipeline run with the given settings"""
+    from instrumentation import RunReport
+
+    return RunReport('pipeline', trace_memory=config.trace_memory,
+                     profile_stage=config.profile_stage, profile_dir=config.output_dir)
+
+
+def load_tables(config, report=None, ids=None):
+    """
+    STEP 1: load the input tables with their schema types
+
+    In streaming and incremental mode the fact table is read chunk by chunk
+    later, so it is skipped here. Outside incremental mode (which needs
+    every log row for its watermarks), the event logs deduplicated by
+    timestamp hold only their latest row per key, kept up to date in the
+    latest-state store (see latest_state.py). With an IdDictionary, the
+    identifier columns are replaced by its integer codes. Only the columns
+    the pipeline uses are read (pipeline_stages.PIPELINE_COLUMNS); with a
+    memory budget they are also downcast (see memory_budget.py).
+
+    Returns:
+        dict of typed DataFrames keyed by TABLE_SCHEMAS name
+    """
+    import time
+
+    from latest_state import read_latest
+    from memory_budget import downcast_tables, format_bytes, release_memory
+    from pipeline_stages import DIMENSION_DEDUPS, PIPELINE_COLUMNS
+    from schema import FACT_TABLE, TABLE_SCHEMAS
+    from table_cache import read_tables
+
+    report = report or new_run_report(config)
+    print("STEP 1: Loading CSV files...")
+
+    read_fact_in_chunks = config.chunk_size is not None or config.mode == 'incremental'
+    event_logs = {} if config.mode == 'incremental' else {
+        dedup.table: dedup for dedup in DIMENSION_DEDUPS if dedup.order_by is not None
+    }
+    table_names = [name for name in TABLE_SCHEMAS
+                   if (name != FACT_TABLE or not read_fact_in_chunks) and name not in event_logs]
+    with report.stage('STEP 1 load') as stage:
+        tables, load_seconds = read_tables(config.data_dir, table_names,
+                                           columns=PIPELINE_COLUMNS, **config.read_options)
+        stage['rows_out'] = sum(len(df) for df in tables.values())
+        stage['tables'] = {name: {'rows': len(tables[name]), 'seconds': seconds}
+                           for name, seconds in load_seconds.items()}
+
+    for name, seconds in load_seconds.items():
+        print(f"  - {name}: {len(tables[name])} rows in {seconds:.3f}s")
+
+    if event_logs:
+        with report.stage('STEP 1 latest state') as stage:
+            stage['tables'] = {}
+            for name, dedup in event_logs.items():
+                started = time.perf_counter()
+                tables[name], status = read_latest(config.data_dir, dedup,
+                                                   columns=PIPELINE_COLUMNS.get(name),
+                                                   **config.read_options)
+                seconds = time.perf_counter() - started
+                stage['tables'][name] = {'rows': len(tables[name]), 'seconds': seconds,
+                                         'state': status}
+                state = f" (state: {status})" if status is not None else ''
+                print(f"  - {name}: {len(tables[name])} latest rows in {seconds:.3f}s{state}")
+            stage['rows_out'] = sum(len(tables[name]) for name in event_logs)
+        tables = {name: tables[name] for name in TABLE_SCHEMAS if name in tables}
+
+    if ids is not None:
+        with report.stage('STEP 1 encode ids') as stage:
+            tables = ids.encode_tables(tables)
+            stage['distinct_ids'] = len(ids)
+        print(f"  - Encoded {len(ids)} distinct identifiers")
+    if config.memory_budget is not None:
+        with report.stage('STEP 1 downcast') as stage:
+            tables, stage['bytes_in'], stage['bytes_out'] = downcast_tables(tables)
+            release_memory()
+        print(f"  - Downcast columns: {format_bytes(stage['bytes_in'])} -> "
+              f"{format_bytes(stage['bytes_out'])}")
+    print("  ✓ All files loaded with schema types.\n")
+    return tables
+
+
+def prepare_dimensions(tables, report=None):
+    """
+    STEP 2-3: deduplicate the dimension tables and convert their timestamps
+
+    Returns:
+        dict of dimension DataFrames (see pipeline_stages.clean_dimensions)
+    """
+    from instrumentation import RunReport
+    from pipeline_stages import clean_dimensions, process_dimensions
+
+    report = report or RunReport('pipeline')
+
+    # STEP 2 — CLEANING
+    print("STEP 2: Cleaning data...")
+    with report.stage('STEP 2 clean', rows_in=sum(len(df) for df in tables.values())) as stage:
+        dims = clean_dimensions(tables)
+        stage['rows_out'] = sum(len(df) for df in dims.values())
+    print("  ✓ Removed duplicates\n")
+
+    # STEP 3 — TIME PROCESSING
+    print("STEP 3: Processing data...")
+    with report.stage('STEP 3 process dimensions'):
+        dims = process_dimensions(dims)
+    print("  ✓ Time conversion & reward parsing complete\n")
+    return dims
+
+
+def run_batch(tables, dims, config, report=None, ids=None):
+    """
+    STEP 4-10 over the whole referral table
+
+    ids is the IdDictionary the tables were encoded with (None if they
+    were not); identifiers are decoded only for the saved report.
+
+    Returns:
+        The final report DataFrame (also written to config.output_file)
+    """
+    from fraud_rules import summarize_rule_hits
+    from instrumentation import summarize_joins
+    from pipeline_stages import (
+        adjust_referral_timestamps, assign_source_category, build_report, detect_fraud,
+        join_referrals, normalize_text, referrer_history
+    )
+    from identity_rings import IdentityClusters
+    from memory_budget import release_memory
+    from schema import FACT_TABLE
+    from velocity import add_velocity_features
+
+    report = report or new_run_report(config)
+    referrals = tables[FACT_TABLE]
+
+    # STEP 4 — JOIN TABLES
+    print("STEP 4: Joining tables...")
+    with report.stage('STEP 4 join', rows_in=len(referrals)) as stage:
+        join_stats = []
+        df = join_referrals(referrals, dims, join_stats)
+        stage['rows_out'] = len(df)
+        stage['joins'] = summarize_joins(join_stats)
+    print_fan_out(stage['joins'])
+    print("  ✓ Joined tables successfully\n")
+
+    # STEP 5 — REFERRAL TIMESTAMPS
+    print("STEP 5: Adjusting timestamps...")
+    with report.stage('STEP 5 referral timestamps', rows_in=len(df)):
+        df = adjust_referral_timestamps(df)
+    print("  ✓ Timestamp conversion complete\n")
+
+    # STEP 5b — REFERRER VELOCITY
+    print("STEP 5b: Counting referrals per referrer and time window...")
+    with report.stage('STEP 5b referrer velocity', rows_in=len(df)):
+        df = add_velocity_features(df, referrer_history(referrals, dims))
+    print("  ✓ Referrer velocity features added\n")
+
+    # STEP 5c — IDENTITY CLUSTERS
+    print("STEP 5c: Clustering shared phones and transactions...")
+    with report.stage('STEP 5c identity clusters', rows_in=len(df)) as stage:
+        df = IdentityClusters(referrals, dims, ids).assign(df)
+        shared = df['cluster_size'] > 1
+        stage['shared_rows'] = int(shared.sum())
+        stage['shared_clusters'] = int(df.loc[shared, 'cluster_id'].nunique())
+    print(f"  ✓ {stage['shared_rows']} referrals in {stage['shared_clusters']} "
+          f"clusters shared by several accounts\n")
+
+    # STEP 6 — SOURCE CATEGORY
+    print("STEP 6: Determining referral source...")
+    with report.stage('STEP 6 source category', rows_in=len(df)):
+        df = assign_source_category(df)
+    print("  ✓ Referral source category assigned\n")
+
+    # STEP 7 — INITCAP
+    print("STEP 7: Normalizing text...")
+    with report.stage('STEP 7 normalize text', rows_in=len(df)):
+        df = normalize_text(df)
+    print("  ✓ String normalization done\n")
+
+    # STEP 8 — FRAUD DETECTION + REASON
+    print("STEP 8: Running fraud detection rules...")
+    with report.stage('STEP 8 fraud detection', rows_in=len(df)) as stage:
+        df = detect_fraud(df)
+        stage['invalid_rows'] = int((~df['is_business_logic_valid']).sum())
+    print(f"  ✓ Valid referrals: {df['is_business_logic_valid'].sum()}")
+    print(f"  ✓ Invalid referrals: {(~df['is_business_logic_valid']).sum()}")
+    print_rule_hits(summarize_rule_hits(df['fraud_rule_bitmask']))
+    print()
+
+    # STEP 9 — FINAL OUTPUT
+    print("STEP 9: Preparing final output...")
+    with report.stage('STEP 9 build report', rows_in=len(df)) as stage:
+        final_df = build_report(df)
+        stage['rows_out'] = len(final_df)
+    print(f"  ✓ Final dataset rows: {len(final_df)}\n")
+    # The working columns are not needed past STEP 9
+    del df
+    if config.memory_budget is not None:
+        release_memory()
+
+    # STEP 10 — SAVE OUTPUT
+    print("STEP 10: Saving output report...")
+    with report.stage('STEP 10 save', rows_in=len(final_df)) as stage:
+        if ids is not None:
+            final_df = ids.decode_columns(final_df)
+        with open_report_sink(config) as sink:
+            sink.write(final_df)
+        stage['output'] = sink.summary
+    print_saved(sink.summary)
+    return final_df
+
+
+def run_partitioned(tables, dims, config, report=None, ids=None):
+    """
+    STEP 4-10 with STEP 4-9 spread over config.worker_count processes
+
+    user_referrals is hash-partitioned (see partitioned.py); the report
+    rows come back in the same order as from run_batch.
+
+    Returns:
+        The final report DataFrame (also written to config.output_file)
+    """
+    from fraud_rules import summarize_rule_hits
+    from instrumentation import summarize_joins
+    from partitioned import partition_key, score_partitioned
+    from schema import FACT_TABLE
+
+    report = report or new_run_report(config)
+    referrals = tables[FACT_TABLE]
+    workers = config.worker_count
+
+    # STEP 4-9 — JOIN, CONVERT, SCORE AND SELECT PER PARTITION
+    print(f"STEP 4-9: Scoring {FACT_TABLE} in {workers} processes "
+          f"(partitioned by {partition_key()})...")
+    with report.stage('STEP 4-9 partitioned', rows_in=len(referrals)) as stage:
+        final_df, bitmask, join_stats, partitions = score_partitioned(referrals, dims, workers, ids=ids)
+        stage['workers'] = workers
+        stage['partitions'] = partitions
+        stage['rows_out'] = len(final_df)
+        stage['invalid_rows'] = int((~final_df['is_business_logic_valid']).sum())
+        stage['joins'] = summarize_joins(join_stats)
+    for number, partition in enumerate(partitions, start=1):
+        print(f"  - Partition {number}: {partition['rows']} rows in {partition['seconds']:.3f}s")
+    print_fan_out(stage['joins'])
+    print(f"  ✓ Valid referrals: {final_df['is_business_logic_valid'].sum()}")
+    print(f"  ✓ Invalid referrals: {(~final_df['is_business_logic_valid']).sum()}")
+    print_rule_hits(summarize_rule_hits(bitmask))
+    print(f"  ✓ Final dataset rows: {len(final_df)}\n")
+
+    # STEP 10 — SAVE OUTPUT
+    print("STEP 10: Saving output report...")
+    with report.stage('STEP 10 save', rows_in=len(final_df)) as stage:
+        if ids is not None:
+            final_df = ids.decode_columns(final_df)
+        with open_report_sink(config) as sink:
+            sink.write(final_df)
+        stage['output'] = sink.summary
+    print_saved(sink.summary)
+    return final_df
+
+
+def run_streaming(dims, config, report=None, ids=None):
+    """
+    STEP 4-10 one user_referrals chunk at a time
+
+    Only one chunk of referrals (plus the dimensions and the id dictionary)
+    is in memory at a time, so the report is appended to config.output_file
+    and not returned. STEP 5b-5c need every referral, so the table is read
+    twice: first for the referral context, which is kept in files under
+    config.output_dir until the run ends, then for scoring.
+
+    Returns:
+        None
+    """
+    import tempfile
+
+    from fraud_rules import summarize_rule_hits
+    from id_codes import IdDictionary
+    from instrumentation import summarize_joins
+    from memory_budget import downcast_frame
+    from pipeline_stages import (
+        build_report, index_dimensions, load_referral_context, process_referrals, read_fact_chunks
+    )
+    from schema import FACT_TABLE
+
+    report = report or new_run_report(config)
+    # The context is kept over identifier codes
+    ids = ids if ids is not None else IdDictionary()
+    print(f"STEP 4-10: Streaming {FACT_TABLE} in chunks of {config.chunk_size} rows...")
+
+    total_rows = 0
+    valid_rows = 0
+    rule_hits = None
+    join_stats = []
+
+    with (tempfile.TemporaryDirectory(prefix='.context-', dir=config.output_dir) as directory,
+          report.stage('STEP 4-10 streaming') as stage, open_report_sink(config) as sink):
+        # Index the dimensions once; every chunk is joined against the same indexes
+        indexes = index_dimensions(dims)
+        # Window counts and clusters need every referral, so STEP 5b-5c use all of them
+        context = load_referral_context(config.data_dir, dims, ids, directory, config.chunk_size,
+                                        indexes, **config.read_options)
+        for chunk_number, chunk in enumerate(read_fact_chunks(config.data_dir, config.chunk_size), start=1):
+            chunk = ids.encode_table(chunk, FACT_TABLE)
+            if config.memory_budget is not None:
+                chunk = downcast_frame(chunk)
+            df = process_referrals(chunk, dims, join_stats, indexes, context)
+            chunk_report = ids.decode_columns(build_report(df))
+            # With background_write, the chunk is written while the next one is scored
+            sink.write(chunk_report)
+
+            chunk_hits = summarize_rule_hits(df['fraud_rule_bitmask'])
+            if rule_hits is None:
+                rule_hits = chunk_hits
+            else:
+                for column in ['Total Hits', 'Reported Hits', 'Exclusive Hits']:
+                    rule_hits[column] += chunk_hits[column]
+
+            total_rows += len(df)
+            valid_rows += int(df['is_business_logic_valid'].sum())
+            print(f"  - Chunk {chunk_number}: {len(df)} rows (total {total_rows})")
+
+        stage['chunks'] = chunk_number if total_rows else 0
+        stage['rows_out'] = total_rows
+        stage['invalid_rows'] = total_rows - valid_rows
+        stage['joins'] = summarize_joins(join_stats)
+    stage['output'] = sink.summary
+
+    print_fan_out(stage['joins'])
+    print(f"  ✓ Valid referrals: {valid_rows}")
+    print(f"  ✓ Invalid referrals: {total_rows - valid_rows}")
+    if rule_hits is not None:
+        print_rule_hits(rule_hits)
+    print(f"  ✓ Final dataset rows: {total_rows}\n")
+    print_saved(sink.summary)
     return None
 
-df['fraud_reason'] = df.apply(fraud_reason, axis=1)
-df['is_business_logic_valid'] = df['fraud_reason'].isna()
-
-print(f"  ✓ Valid referrals: {df['is_business_logic_valid'].sum()}")
-print(f"  ✓ Invalid referrals: {(~df['is_business_logic_valid']).sum()}\n")
-
-def get_fraud_reason(row):
-    reward_value = row['num_reward_days']
-    referral_status = row['referral_status']
-    transaction_id = row['transaction_id']
-    transaction_status = row['transaction_status']
-    transaction_type = row['transaction_type']
-    referral_at = row['referral_at_local']
-    transaction_at = row['transaction_at_local']
-    membership_expired = row['referrer_membership_expired']
-    is_deleted = row['referrer_is_deleted']
-    is_reward_granted = row['is_reward_granted']
-
-    # Convert boolean-like strings
-    if isinstance(is_deleted, str):
-        is_deleted = is_deleted.upper() == 'TRUE'
-    if isinstance(is_reward_granted, str):
-        is_reward_granted = is_reward_granted.upper() == 'TRUE'
-
-    # -------- FRAUD RULES ---------
 
-    if pd.notna(reward_value) and reward_value > 0 and referral_status != 'Berhasil':
-        return "Reward > 0 but status not Berhasil"
-
-    if pd.notna(reward_value) and reward_value > 0 and pd.isna(transaction_id):
-        return "Reward > 0 but no transaction ID"
-
-    if (pd.isna(reward_value) or reward_value == 0) and pd.notna(transaction_id) and transaction_status == 'Paid':
-        return "Paid transaction but reward = 0"
-
-    if referral_status == 'Berhasil' and (pd.isna(reward_value) or reward_value == 0):
-        return "Status Berhasil but reward = 0"
-
-    if pd.notna(referral_at) and pd.notna(transaction_at) and transaction_at < referral_at:
-        return "Transaction date earlier than referral date"
-
-    if pd.notna(reward_value) and reward_value > 0 and pd.notna(membership_expired) and membership_expired <= referral_at:
-        return "Membership expired before referral"
-
-    if pd.notna(reward_value) and reward_value > 0 and is_deleted:
-        return "Referrer account deleted"
-
-    if (pd.notna(referral_at) and pd.notna(transaction_at) and
-        (referral_at.month != transaction_at.month or referral_at.year != transaction_at.year)):
-        return "Transaction & referral in different month"
-
-    if (pd.notna(reward_value) and reward_value > 0 and 
-        referral_status == 'Berhasil' and not is_reward_granted):
-        return "Reward not granted but status Berhasil"
-
-    return None  # Means valid
-df['fraud_reason'] = df.apply(get_fraud_reason, axis=1)
-
-
-# STEP 9 — FINAL OUTPUT
-print("STEP 9: Preparing final output...")
-
-final_df = df[[
-    'id', 'referral_id', 'referral_source', 'referral_source_category',
-    'referral_at_local', 'referrer_id', 'referrer_name', 'referrer_phone_number',
-    'referrer_homeclub', 'referee_id', 'referee_name', 'referee_phone',
-    'referral_status', 'num_reward_days', 'transaction_id', 'transaction_status',
-    'transaction_at_local', 'transaction_location', 'transaction_type',
-    'updated_at_local', 'reward_granted_at', 'is_business_logic_valid',
-    'fraud_reason'
-]].copy()
-
-
-final_df.rename(columns={
-    'id': 'referral_details_id',
-    'referral_at_local': 'referral_at',
-    'transaction_at_local': 'transaction_at',
-    'updated_at_local': 'updated_at'
-}, inplace=True)
-
-
-print(f"  ✓ Final dataset rows: {len(final_df)}\n")
-
-# STEP 10 — SAVE OUTPUT
-print("STEP 10: Saving output report...")
+def run_incremental(tables, dims, config, report=None, ids=None):
+    """
+    STEP 4-10 for the referrals changed since the stored watermarks, and
+    the referrals whose clusters or velocity windows (by referrer or by
+    transaction location) they change
+
+    Returns:
+        The rescored report rows upserted into config.store_file
+    """
+    import pandas as pd
+
+    from fraud_rules import summarize_rule_hits
+    from id_codes import REPORT_ID_COLUMNS
+    from identity_rings import IDENTITY_SOURCE_COLUMNS, ClusterLookup, IdentityClusters
+    from instrumentation import summarize_joins
+    from incremental import (
+        REPORT_KEY, advance_watermark, changed_referrers, export_report, load_inputs_between,
+        load_referral_inputs, load_referrer_inputs, load_watermarks, open_store,
+        referrals_in_windows, referrals_with_new_logs, replace_identity_clusters,
+        save_referral_inputs, save_watermarks, select_changed_referrals, stored_clusters,
+        update_identity_clusters, upsert_report
+    )
+    from pipeline_stages import (
+        ReferralContext, build_report, process_referrals, read_fact_chunks, referrer_history
+    )
+    from schema import FACT_TABLE
+    from velocity import LOCATION_WINDOWS, VELOCITY_WINDOWS
+
+    def as_text(df, columns=REPORT_ID_COLUMNS):
+        # The store keeps text ids; chunks and context may hold codes
+        return df if ids is None else ids.decode_columns(df, columns)
+
+    locations = as_text(dims['paid_transactions'][['transaction_id', 'transaction_location']],
+                        ['transaction_id'])
+
+    def with_locations(df):
+        return df.merge(locations, how='left', on='transaction_id')
+
+    report = report or new_run_report(config)
+    print("STEP 4-10: Selecting referrals changed since the last run...")
+
+    store = open_store(config.store_file)
+    try:
+        watermarks = load_watermarks(store)
+        print(f"  - updated_at watermark: {watermarks['updated_at']}")
+        print(f"  - referral log watermark: {watermarks['referral_logs_created_at']}")
+
+        new_log_referrals = referrals_with_new_logs(tables['user_referral_logs'],
+                                                    watermarks['referral_logs_created_at'])
+        user_logs_clean = dims['user_logs_clean']
+        if ids is not None:
+            # Fingerprints and clusters are kept between runs, so they are taken over the text ids
+            user_logs_clean = ids.decode_columns(user_logs_clean, ['user_id', 'phone_number'])
+        changed_users = changed_referrers(store, user_logs_clean)
+        referrers = changed_users
+        if ids is not None:
+            referrers = set(ids.encode(pd.Series(sorted(referrers), dtype='str')).dropna())
+        print(f"  - Referrals with new logs: {len(new_log_referrals)}")
+        print(f"  - Referrers with changed user_logs rows: {len(referrers)}")
+
+        new_updated_at = watermarks['updated_at']
+        changed = []
+        with report.stage('STEP 4 select changed referrals') as stage:
+            scanned = 0
+            for chunk in read_fact_chunks(config.data_dir, config.chunk_size or INCREMENTAL_READ_SIZE):
+                if ids is not None:
+                    chunk = ids.encode_table(chunk, FACT_TABLE)
+                changed.append(select_changed_referrals(chunk, watermarks['updated_at'],
+                                                        new_log_referrals, referrers))
+                new_updated_at = advance_watermark(new_updated_at, chunk['updated_at'])
+                scanned += len(chunk)
+            changed = pd.concat(changed, ignore_index=True)
+            stage['rows_in'] = scanned
+            stage['rows_out'] = len(changed)
+
+        with report.stage('STEP 5c update identity clusters', rows_in=len(changed)) as stage:
+            changed_text = as_text(changed)
+            previous = load_referral_inputs(store, changed_text[REPORT_KEY].dropna())
+            save_referral_inputs(store, changed_text)
+            graph = None
+            cluster_changes = set()
+            if watermarks['updated_at'] is None:
+                # Every referral is in this run, so the graph is built in one go
+                graph = IdentityClusters(changed, {'user_logs_clean': dims['user_logs_clean']}, ids)
+                replace_identity_clusters(store, as_text(graph.node_clusters(), ['node', 'cluster']))
+            else:
+                # Every identifier whose links may have changed
+                users = user_logs_clean[user_logs_clean['user_id'].isin(changed_users).to_numpy()]
+                seeds = pd.concat([frame[column] for frame in (previous, changed_text)
+                                   for column in IDENTITY_SOURCE_COLUMNS]
+                                  + [users['user_id'], users['phone_number']]).dropna()
+                cluster_changes = update_identity_clusters(store, set(seeds), user_logs_clean)
+            stage['rows_out'] = len(cluster_changes)
+
+        with report.stage('STEP 4 widen to affected referrals', rows_in=len(changed)) as stage:
+            if watermarks['updated_at'] is None:
+                # changed holds every referral
+                history = referrer_history(changed, dims)
+            else:
+                # Clusters and velocity windows reach past the changed rows; the
+                # referrers' other referrals come from the store, by the referrer_id index
+                print(f"  - Referrals with changed clusters: {len(cluster_changes)}")
+                referrers = set(pd.concat([previous['referrer_id'],
+                                           changed_text['referrer_id']]).dropna())
+                neighbours = load_referrer_inputs(store, referrers)
+                in_windows = referrals_in_windows(changed_text, previous, neighbours,
+                                                  max(VELOCITY_WINDOWS.values()))
+                print(f"  - Referrals in changed velocity windows: {len(in_windows)}")
+                # Location windows hold other referrers' referrals, found through
+                # the referral_at index around the changed times
+                location_window = max(LOCATION_WINDOWS.values())
+                moved = pd.concat([changed_text['referral_at'], previous['referral_at']])
+                around = load_inputs_between(store, moved, moved + location_window)
+                at_locations = referrals_in_windows(
+                    with_locations(changed_text), with_locations(previous),
+                    with_locations(around), location_window, key='transaction_location')
+                print(f"  - Referrals in changed location windows: {len(at_locations)}")
+
+                affected = ((cluster_changes | in_windows | at_locations)
+                            - set(changed_text[REPORT_KEY]))
+                if affected:
+                    extra = load_referral_inputs(store, affected)
+                    changed_text = pd.concat([changed_text, extra], ignore_index=True)
+                    changed = pd.concat([changed, extra if ids is None
+                                         else ids.encode_table(extra, FACT_TABLE)],
+                                        ignore_index=True)
+                # Window counts need every referral of the referrers being scored
+                missing = set(changed_text['referrer_id'].dropna()) - referrers
+                if missing:
+                    neighbours = pd.concat([neighbours, load_referrer_inputs(store, missing)],
+                                           ignore_index=True)
+                # and every referral in the location windows before them
+                nearby = load_inputs_between(store, changed_text['referral_at'] - location_window,
+                                             changed_text['referral_at'])
+                nearby = nearby[~nearby[REPORT_KEY].isin(neighbours[REPORT_KEY]).to_numpy()]
+                neighbours = pd.concat([neighbours, nearby], ignore_index=True)
+                if ids is not None:
+                    neighbours = ids.encode_table(neighbours, FACT_TABLE)
+                history = referrer_history(neighbours, dims)
+
+            if graph is None:
+                clusters = stored_clusters(store, changed_text)
+                if ids is not None:
+                    clusters = clusters.assign(node=ids.encode(clusters['node']),
+                                               cluster=ids.encode(clusters['cluster']))
+                graph = ClusterLookup(clusters['node'], clusters['cluster'], clusters['size'])
+            context = ReferralContext(history, graph)
+            stage['rows_out'] = len(changed)
+
+        with report.stage('STEP 4-9 score changed referrals', rows_in=len(changed)) as stage:
+            join_stats = []
+            df = process_referrals(changed, dims, join_stats, context=context)
+            final_df = build_report(df)
+            stage['rows_out'] = len(final_df)
+            stage['invalid_rows'] = int((~df['is_business_logic_valid']).sum())
+            stage['joins'] = summarize_joins(join_stats)
+        print_fan_out(stage['joins'])
+
+        with report.stage('STEP 10 upsert', rows_in=len(final_df)):
+            final_df = as_text(final_df)
+            upserted = upsert_report(store, final_df)
+
+        save_watermarks(store, {
+            'updated_at': new_updated_at,
+            'referral_logs_created_at': advance_watermark(
+                watermarks['referral_logs_created_at'],
+                tables['user_referral_logs']['created_at']
+            ),
+        })
+
+        exported = None
+        if config.export:
+            with report.stage('STEP 10 export') as stage:
+                exported = export_report(store, config.output_file, config.output_format,
+                                         index=config.write_index)
+                stage['rows_out'] = exported['rows']
+                stage['output'] = exported
+    finally:
+        store.close()
+
+    print(f"  ✓ Valid referrals: {df['is_business_logic_valid'].sum()}")
+    print(f"  ✓ Invalid referrals: {(~df['is_business_logic_valid']).sum()}")
+    print_rule_hits(summarize_rule_hits(df['fraud_rule_bitmask']))
+    print(f"  ✓ Upserted rows: {upserted}\n")
+    print(f"  ✓ Report saved to: {config.store_file}")
+    if exported is not None:
+        print_saved(exported)
+    return final_df
+
+
+def run_pipeline(config=None):
+    """
+    Run the whole pipeline: load, clean, join, score and save the report
+
+    Args:
+        config: PipelineConfig (default: PipelineConfig())
+
+    Returns:
+        The final report DataFrame; rows upserted in incremental mode;
+        None in streaming mode, where the report only exists on disk
+    """
+    import pandas as pd
+
+    from id_codes import IdDictionary
+    from memory_budget import budget_summary, downcast_tables, release_memory
+    from schema import FACT_TABLE
+
+    config = config or PipelineConfig()
+    if config.mode not in RUN_MODES:
+        raise ValueError(f"Unknown run mode {config.mode!r}; expected one of {RUN_MODES}")
+    if config.engine not in CSV_ENGINES:
+        raise ValueError(f"Unknown CSV engine {config.engine!r}; expected one of {CSV_ENGINES}")
+    if config.workers != 1 and (config.mode != 'full' or config.chunk_size is not None):
+        raise ValueError("workers only applies to full runs without chunk_size")
+    if config.output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format {config.output_format!r}; "
+                         f"expected one of {OUTPUT_FORMATS}")
+    if config.export and config.mode != 'incremental':
+        raise ValueError("export only applies to incremental runs; full runs write the report")
+    if config.memory_budget is not None and config.memory_budget <= 0:
+        raise ValueError("memory_budget must be a positive number of bytes")
+
+    print("=" * 80)
+    print("REFERRAL PROGRAM DATA PIPELINE")
+    print("=" * 80)
+    print(f"Started at: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    print(f"Python version: {sys.version}")
+    print(f"Pandas version: {pd.__version__}")
+    print(f"Current directory: {os.getcwd()}\n")
+
+    os.makedirs(config.output_dir, exist_ok=True)
+    print(f"✓ Output directory: {config.output_dir}\n")
+
+    report = new_run_report(config)
+    report.details['config'] = vars(config)
+    try:
+        # Identifiers are joined as integer codes and decoded in STEP 10
+        ids = IdDictionary()
+        tables = load_tables(config, report, ids)
+        dims = prepare_dimensions(tables, report)
+        if config.memory_budget is not None:
+            # STEP 3 adds the local times and reward days
+            dims, _, _ = downcast_tables(dims)
+        # Only the fact table (incremental mode: the referral log, for its
+        # watermark) is used past STEP 3; the raw dimension tables are dropped
+        kept = 'user_referral_logs' if config.mode == 'incremental' else FACT_TABLE
+        tables = {name: df for name, df in tables.items() if name == kept}
+        if config.memory_budget is not None:
+            release_memory()
+
+        if config.mode == 'incremental':
+            final_df = run_incremental(tables, dims, config, report, ids)
+        elif config.chunk_size is None and config.worker_count > 1:
+            final_df = run_partitioned(tables, dims, config, report, ids)
+        elif config.chunk_size is None:
+            final_df = run_batch(tables, dims, config, report, ids)
+        else:
+            final_df = run_streaming(dims, config, report, ids)
+    finally:
+        if config.memory_budget is not None:
+            report.details['memory_budget'] = budget_summary(config.memory_budget)
+        # Written on failure too, so a failed run still shows where time went
+        report.write(config.run_report_file)
+
+    print("\n  Stage timings:")
+    report.print_summary()
+    if config.memory_budget is not None:
+        print_memory_budget(report.details['memory_budget'])
+    print(f"  ✓ Run report saved to: {config.run_report_file}")
+    print("\nPipeline Completed Successfully!")
+    print("=" * 80)
+    return final_df
+
+
+def parse_args(argv=None):
+    """Build a PipelineConfig from command-line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Build the referral fraud detection report from the input CSV files."
+    )
+    parser.add_argument('--data-dir', default='data',
+                        help="directory holding the input CSV files (default: %(default)s)")
+    parser.add_argument('--output-dir', default='output',
+                        help="directory for the report and run state (default: %(default)s)")
+    parser.add_argument('--mode', choices=RUN_MODES,
+                        default=os.environ.get('REFERRAL_RUN_MODE', 'full'),
+                        help="'full' rewrites the report, 'incremental' upserts only "
+                             "changed referrals (default: %(default)s)")
+    parser.add_argument('--chunk-size', type=int,
+                        default=int(os.environ.get('REFERRAL_CHUNK_SIZE') or 0) or None,
+                        help="stream user_referrals in chunks of this many rows")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="score user_referrals in this many processes, each taking a "
+                             "hash partition (0: one per CPU; full runs only; default: %(default)s)")
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default='csv',
+                        help="report format; 'parquet' writes a directory partitioned by "
+                             "referral month and validity (full runs; default: %(default)s)")
+    parser.add_argument('--export', action='store_true',
+                        help="in incremental mode, also write the whole report store to "
+                             "the report file in --output-format")
+    parser.add_argument('--background-write', action='store_true',
+                        help="write the report on a background thread, overlapping "
+                             "with scoring the next chunk")
+    parser.add_argument('--no-index', dest='write_index', action='store_false',
+                        help="skip the sidecar index of referral and referrer ids "
+                             "that query_report.py reads")
+    parser.add_argument('--memory-budget', metavar='SIZE',
+                        help="peak memory target such as 512M or 2G: downcast the tables "
+                             "to their smallest dtypes and report peak memory against it")
+    parser.add_argument('--engine', choices=CSV_ENGINES, default='auto',
+                        help="CSV parser for whole-table reads (default: %(default)s)")
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                        default=os.environ.get('REFERRAL_TABLE_CACHE', '1') != '0',
+                        help="always parse the CSV files instead of the Arrow table cache")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="record tracemalloc peaks per stage in the run report")
+    parser.add_argument('--profile-stage', metavar='STAGE',
+                        help="run one stage under cProfile, e.g. 'STEP 4' "
+                             "(stats are written next to the run report)")
+    parser.add_argument('--interactive', action='store_true',
+                        help="wait for Enter before exiting")
+    args = parser.parse_args(argv)
+
+    if args.chunk_size is not None and args.chunk_size <= 0:
+        parser.error("--chunk-size must be a positive number of rows")
+    if args.workers < 0:
+        parser.error("--workers must be 0 or a positive number of processes")
+    if args.workers != 1 and (args.mode != 'full' or args.chunk_size is not None):
+        parser.error("--workers only applies to full runs without --chunk-size")
+    if args.mode != 'full' and args.background_write:
+        parser.error("--background-write only applies to full runs")
+    if args.mode == 'incremental' and args.output_format != 'csv' and not args.export:
+        parser.error("--output-format only applies to full runs and --export")
+    if args.export and args.mode != 'incremental':
+        parser.error("--export only applies to --mode incremental")
+    memory_budget = None
+    if args.memory_budget is not None:
+        from memory_budget import parse_memory_size
+
+        try:
+            memory_budget = parse_memory_size(args.memory_budget)
+        except ValueError as e:
+            parser.error(f"--memory-budget: {e}")
+
+    config = PipelineConfig(
+        data_dir=args.data_dir,
+        output_dir=args.output_dir,
+        mode=args.mode,
+        chunk_size=args.chunk_size,
+        engine=args.engine,
+        use_cache=args.use_cache,
+        workers=args.workers,
+        output_format=args.output_format,
+        background_write=args.background_write,
+        export=args.export,
+        write_index=args.write_index,
+        memory_budget=memory_budget,
+        trace_memory=args.trace_memory,
+        profile_stage=args.profile_stage,
+    )
+    return config, args.interactive
+
+
+def main(argv=None):
+    config, interactive = parse_args(argv)
+    try:
+        run_pipeline(config)
+    finally:
+        if interactive:
+            input("Press Enter to exit...")
+    return 0
 
-output_file = os.path.join(OUTPUT_DIR, 'referral_fraud_detection_report.csv')
-final_df.to_csv(output_file, index=False)
 
-print(f"  ✓ Report saved to: {output_file}")
-print("\nPipeline Completed Successfully!")
-print("=" * 80)
-input("Press Enter to exit...")
+if __name__ == "__main__":
+    sys.exit(main())
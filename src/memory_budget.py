@@ -0,0 +1,160 @@
+"""
+Memory Budget Helpers
+Purpose: Shrink the pipeline's in-memory tables (smallest integer and float
+         types that hold their values, categoricals for repetitive text)
+         and compare a run's peak memory against a --memory-budget
+"""
+
+import re
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import peak_rss_bytes
+
+try:
+    import pyarrow as pa
+except ImportError:  # without pyarrow there is no Arrow memory pool to trim
+    pa = None
+
+# Text columns become categoricals when they have at most this many
+# distinct values per row; below that the codes plus categories are smaller
+CATEGORY_MAX_RATIO = 0.5
+
+# Integer widths tried in order, smallest first
+INTEGER_BITS = (8, 16, 32, 64)
+
+# Size suffixes (case-insensitive, optional 'i' and 'B': 512M, 2GiB, 1.5gb)
+SIZE_UNITS = {'': 1, 'k': 2**10, 'm': 2**20, 'g': 2**30, 't': 2**40}
+SIZE_PATTERN = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)(?:i?b)?\s*$', re.IGNORECASE)
+
+
+def parse_memory_size(text):
+    """
+    Bytes in a size such as '512M', '2G', '1.5GiB' or '1000000'
+
+    Units are binary (1K = 1024 bytes).
+
+    Raises:
+        ValueError: for anything else, or a size of zero
+    """
+    match = SIZE_PATTERN.match(str(text))
+    if match is None:
+        raise ValueError(f"Invalid memory size {text!r}; expected e.g. 512M or 2G")
+    size = int(float(match.group(1)) * SIZE_UNITS[match.group(2).lower()])
+    if size <= 0:
+        raise ValueError(f"Memory size must be positive, got {text!r}")
+    return size
+
+
+def format_bytes(size):
+    """'1.5 GiB'-style text for a byte count"""
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(size) < 1024 or unit == 'GiB':
+            break
+        size /= 1024
+    return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+
+
+def _smallest_integer(values):
+    """Narrowest integer dtype (same nullability) holding every value, or None"""
+    nullable = isinstance(values.dtype, pd.api.extensions.ExtensionDtype)
+    present = values.dropna()
+    if present.empty:
+        low = high = 0
+    else:
+        low, high = int(present.min()), int(present.max())
+    for bits in INTEGER_BITS:
+        limits = np.iinfo(f'int{bits}')
+        if limits.min <= low and high <= limits.max:
+            dtype = f'Int{bits}' if nullable else f'int{bits}'
+            return None if values.dtype == dtype else dtype
+    return None
+
+
+def _narrower_dtype(values):
+    """Smaller dtype with the same values for one column, or None to keep it"""
+    dtype = values.dtype
+    if pd.api.types.is_bool_dtype(dtype) or isinstance(dtype, pd.CategoricalDtype):
+        return None
+    if pd.api.types.is_integer_dtype(dtype):
+        return _smallest_integer(values)
+    if dtype == np.float64:
+        # Only when every value survives the round trip (integer-valued
+        # floats such as reward ids and days do), so the report is unchanged
+        array = values.to_numpy()
+        narrowed = array.astype(np.float32)
+        if np.array_equal(narrowed.astype(np.float64), array, equal_nan=True):
+            return 'float32'
+        return None
+    if pd.api.types.is_string_dtype(dtype) and len(values):
+        if values.nunique() <= CATEGORY_MAX_RATIO * len(values):
+            return 'category'
+    return None
+
+
+def downcast_frame(df):
+    """
+    Copy of df with each column in the smallest dtype that holds its values
+
+    Integers (including identifier codes) get the narrowest signed width,
+    lossless float64 columns become float32 and repetitive text becomes
+    categorical. Booleans, timestamps and categoricals are kept.
+
+    Returns:
+        DataFrame with the same values, columns and index
+    """
+    narrowed = {}
+    for column, values in df.items():
+        dtype = _narrower_dtype(values)
+        if dtype is not None:
+            narrowed[column] = values.astype(dtype)
+    return df.assign(**narrowed) if narrowed else df
+
+
+def frame_bytes(df):
+    """Memory held by a DataFrame's columns (text counted in full)"""
+    return int(df.memory_usage(index=False, deep=True).sum())
+
+
+def downcast_tables(tables):
+    """
+    downcast_frame for every table of a dict
+
+    Returns:
+        (dict of downcast tables, bytes before, bytes after)
+    """
+    before = sum(frame_bytes(df) for df in tables.values())
+    tables = {name: downcast_frame(df) for name, df in tables.items()}
+    return tables, before, sum(frame_bytes(df) for df in tables.values())
+
+
+def release_memory():
+    """
+    Hand memory freed by dropped frames back to the operating system
+
+    Arrow's allocator keeps freed blocks for reuse, so after the string
+    columns of a large table are dropped the process stays as large as
+    before and the next non-Arrow allocation (numpy, Python) adds to it.
+    """
+    if pa is not None:
+        pa.default_memory_pool().release_unused()
+
+
+def budget_summary(budget):
+    """
+    This process's peak memory so far against a budget
+
+    Args:
+        budget: bytes
+
+    Returns:
+        dict with budget_bytes, peak_rss_bytes (None if unknown) and
+        within_budget (None if unknown)
+    """
+    peak = peak_rss_bytes()
+    return {
+        'budget_bytes': budget,
+        'peak_rss_bytes': peak,
+        'within_budget': None if peak is None else peak <= budget,
+    }
@@ -0,0 +1,40 @@
+"""
+Value Normalization
+Purpose: Apply a per-value rule (title case, lookups, cleanup) to a column
+         once per distinct value instead of once per row, then map the
+         results back onto the rows
+"""
+
+import pandas as pd
+from pandas.api.extensions import take
+
+
+def map_unique(values, func):
+    """
+    Apply func to every distinct value of a Series and broadcast the results
+
+    Text columns repeat a handful of values over millions of rows, so the
+    column is factorized and func runs once per distinct value. For a
+    categorical column only the categories are mapped. Missing values stay
+    missing and are never passed to func.
+
+    Args:
+        values: Series to normalize
+        func: function of one non-missing value
+
+    Returns:
+        Series aligned to values (categorical if values is categorical and
+        func keeps the categories distinct)
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.map(func, na_action='ignore')
+
+    codes, uniques = pd.factorize(values)
+    mapped = pd.Series([func(value) for value in uniques])
+    return pd.Series(take(mapped.array, codes, allow_fill=True), index=values.index,
+                     name=values.name)
+
+
+def title_case(value):
+    """InitCap as str.title: 'tidak berhasil' -> 'Tidak Berhasil'"""
+    return str(value).title()
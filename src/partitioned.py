@@ -0,0 +1,114 @@
+"""
+Partitioned Execution
+Purpose: Run STEP 4-9 on hash partitions of user_referrals in a process pool
+         and put the report rows back in their original order
+"""
+
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from fraud_rules import FRAUD_RULES
+from pipeline_stages import build_report, index_dimensions, process_referrals, referral_context
+
+# Carries each referral's position in user_referrals through STEP 4-9
+SOURCE_ROW_COLUMN = '_source_row'
+
+# Filled in each worker process by _init_worker
+_worker_state = {}
+
+
+def partition_key(rules=FRAUD_RULES):
+    """
+    Column user_referrals is hash-partitioned on
+
+    referral_id spreads the rows most evenly. When a rule compares a
+    referral with the referrer's other referrals (FraudRule.per_referrer),
+    all of a referrer's rows have to land in the same partition.
+    """
+    return 'referrer_id' if any(rule.per_referrer for rule in rules) else 'referral_id'
+
+
+def hash_partitions(keys, partitions):
+    """
+    Split row positions by a hash of their key
+
+    Args:
+        keys: Series of partition keys, one per row
+        partitions: number of partitions
+
+    Returns:
+        list of `partitions` ascending position arrays; rows with equal keys
+        (missing keys included) share a partition
+    """
+    hashes = pd.util.hash_pandas_object(keys, index=False).to_numpy()
+    buckets = (hashes % np.uint64(partitions)).astype(np.intp)
+    order = np.argsort(buckets, kind='stable')
+    bounds = np.cumsum(np.bincount(buckets, minlength=partitions))[:-1]
+    return np.split(order, bounds)
+
+
+def _init_worker(referrals, dims, context):
+    _worker_state['referrals'] = referrals
+    _worker_state['dims'] = dims
+    _worker_state['indexes'] = index_dimensions(dims)
+    _worker_state['context'] = context
+
+
+def _score_partition(positions):
+    """STEP 4-9 for the referrals at these positions, in a worker process"""
+    started = time.perf_counter()
+    part = _worker_state['referrals'].take(positions)
+    part[SOURCE_ROW_COLUMN] = positions
+    join_stats = []
+    df = process_referrals(part, _worker_state['dims'], join_stats, _worker_state['indexes'],
+                           _worker_state['context'])
+    return {
+        'source_rows': df[SOURCE_ROW_COLUMN].to_numpy(),
+        'report': build_report(df),
+        'bitmask': df['fraud_rule_bitmask'].to_numpy(),
+        'join_stats': join_stats,
+        'rows': len(positions),
+        'seconds': time.perf_counter() - started,
+    }
+
+
+def score_partitioned(referrals, dims, workers, rules=FRAUD_RULES, ids=None):
+    """
+    STEP 4-9 on `workers` hash partitions of the referral table at once
+
+    Each worker process gets the referral and dimension tables and the
+    STEP 5b-5c referral context once, when it starts (inherited without a
+    copy where processes are forked), builds its own dimension indexes,
+    and is then sent only the row positions of its partition. The results are put back in referral
+    order; rows a duplicate dimension key fanned out stay together.
+
+    Args:
+        referrals: cleaned user_referrals rows
+        dims: dimension tables from build_dimensions
+        workers: number of processes (and partitions)
+        rules: fraud rules in use, to pick the partition key
+        ids: IdDictionary the tables are encoded with (None if they are not)
+
+    Returns:
+        (report DataFrame as from build_report, fraud_rule_bitmask Series,
+         list of join stats, list with rows and seconds per partition)
+    """
+    partitions = [positions for positions in hash_partitions(referrals[partition_key(rules)], workers)
+                  if len(positions)] or [np.arange(0)]
+
+    # Built once here rather than in every worker
+    context = referral_context(referrals, dims, ids)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(referrals, dims, context)) as pool:
+        results = list(pool.map(_score_partition, partitions))
+
+    order = np.argsort(np.concatenate([result['source_rows'] for result in results]), kind='stable')
+    report = pd.concat([result['report'] for result in results], ignore_index=True)
+    report = report.take(order).reset_index(drop=True)
+    bitmask = pd.Series(np.concatenate([result['bitmask'] for result in results])[order])
+    join_stats = [stats for result in results for stats in result['join_stats']]
+    partition_stats = [{'rows': result['rows'], 'seconds': result['seconds']} for result in results]
+    return report, bitmask, join_stats, partition_stats
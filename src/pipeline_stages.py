@@ -0,0 +1,516 @@
+"""
+Referral Pipeline Stages
+Purpose: Reusable building blocks for main_pipeline.py, so the same join,
+         conversion and scoring logic runs on the full referral table or on
+         one chunk of it at a time
+"""
+
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+from pandas.api.extensions import take
+
+from fraud_rules import evaluate_fraud_bitmask, evaluate_record, fraud_reason_from_bitmask
+from identity_rings import IDENTITY_LINKS, IDENTITY_SOURCE_COLUMNS, IdentityClusters, StreamedClusters
+from latest_state import latest_rows
+from normalization import map_unique, title_case
+from schema import FACT_TABLE, REPORT_SCHEMA
+from table_cache import read_table
+from time_conversion import DEFAULT_TIMEZONE, coalesce_timezones, convert_utc_to_local, utc_to_local
+from velocity import HISTORY_COLUMNS, ReferrerHistory, SpilledReferrerHistory, add_velocity_features
+
+# Report columns and the names they are published under
+REPORT_COLUMNS = [column.source for column in REPORT_SCHEMA]
+REPORT_RENAMES = {column.source: column.name for column in REPORT_SCHEMA
+                  if column.source != column.name}
+
+# referral_source -> referral_source_category; Lead referrals take the lead's own category
+SOURCE_CATEGORIES = {'User Sign Up': 'Online', 'Draft Transaction': 'Offline'}
+LEAD_SOURCE = 'Lead'
+
+# user_referrals columns STEP 5b counts over (see referrer_history)
+VELOCITY_SOURCE_COLUMNS = ['referrer_id', 'referral_at', 'referral_reward_id', 'transaction_id']
+
+# user_referrals columns STEP 5b-5c need from the whole table (see referral_context)
+CONTEXT_COLUMNS = VELOCITY_SOURCE_COLUMNS + [column for column in IDENTITY_SOURCE_COLUMNS
+                                             if column not in VELOCITY_SOURCE_COLUMNS]
+
+# Input columns the pipeline reads; tables not listed are read whole.
+# The rest (row numbers, audit timestamps, lead status...) are never used.
+PIPELINE_COLUMNS = {
+    'lead_logs': ['lead_id', 'source_category', 'created_at', 'timezone_location'],
+    'user_referral_logs': ['user_referral_id', 'created_at', 'is_reward_granted'],
+    'user_logs': ['user_id', 'name', 'phone_number', 'homeclub', 'timezone_homeclub',
+                  'membership_expired_date', 'is_deleted'],
+    'user_referral_statuses': ['id', 'description'],
+    'referral_rewards': ['id', 'reward_value'],
+}
+
+TEXT_COLUMNS = ['referrer_name', 'referee_name', 'referral_status',
+                'transaction_status', 'transaction_type',
+                'referral_source', 'referral_source_category']
+
+
+@dataclass(frozen=True)
+class DimensionDedup:
+    """How STEP 2 keeps one row per key of a dimension table"""
+    dimension: str
+    table: str
+    key: str
+    keep: str  # 'first' or 'last' row per key
+    # With order_by, keep the latest row per key by this timestamp instead
+    # (see latest_state.latest_rows); event logs are deduplicated this way
+    order_by: str | None = None
+
+
+# Dimensions that are deduplicated; the others are used as loaded
+DIMENSION_DEDUPS = (
+    DimensionDedup('user_logs_clean', 'user_logs', 'user_id', 'first'),
+    DimensionDedup('lead_logs_clean', 'lead_logs', 'lead_id', 'last', order_by='created_at'),
+    DimensionDedup('latest_logs', 'user_referral_logs', 'user_referral_id', 'last',
+                   order_by='created_at'),
+)
+
+# Dimensions joined as loaded
+PLAIN_DIMENSIONS = ('user_referral_statuses', 'referral_rewards', 'paid_transactions')
+
+
+@dataclass(frozen=True)
+class ReferralContext:
+    """Whole-table state every batch of referrals is scored against"""
+    history: ReferrerHistory  # STEP 5b window counts (or a SpilledReferrerHistory)
+    clusters: IdentityClusters  # STEP 5c identity clusters (or StreamedClusters)
+
+
+@dataclass(frozen=True)
+class DimensionJoin:
+    """How STEP 4 attaches one dimension table to the referral rows"""
+    dimension: str
+    fact_key: str
+    key: str
+    columns: dict  # dimension column -> name on the joined rows
+
+
+# In join order. 'id' of referral_rewards is published as referral_details_id.
+DIMENSION_JOINS = (
+    DimensionJoin('latest_logs', 'referral_id', 'user_referral_id',
+                  {'created_at': 'created_at', 'is_reward_granted': 'is_reward_granted'}),
+    DimensionJoin('user_referral_statuses', 'user_referral_status_id', 'id',
+                  {'description': 'referral_status'}),
+    DimensionJoin('referral_rewards', 'referral_reward_id', 'id',
+                  {'id': 'id', 'num_reward_days': 'num_reward_days'}),
+    DimensionJoin('paid_transactions', 'transaction_id', 'transaction_id',
+                  {'transaction_status': 'transaction_status',
+                   'transaction_at_local': 'transaction_at_local',
+                   'transaction_location': 'transaction_location',
+                   'transaction_type': 'transaction_type'}),
+    DimensionJoin('user_logs_clean', 'referrer_id', 'user_id',
+                  {'name': 'referrer_name',
+                   'phone_number': 'referrer_phone_number',
+                   'homeclub': 'referrer_homeclub',
+                   'timezone_homeclub': 'referrer_timezone',
+                   'membership_expired_date': 'referrer_membership_expired',
+                   'is_deleted': 'referrer_is_deleted'}),
+    DimensionJoin('lead_logs_clean', 'referee_id', 'lead_id',
+                  {'source_category': 'source_category',
+                   'timezone_location': 'timezone_location'}),
+)
+
+
+def read_fact_chunks(data_dir, chunk_size):
+    """Iterate over typed user_referrals chunks of chunk_size rows"""
+    return read_table(data_dir, FACT_TABLE, chunksize=chunk_size)
+
+
+def clean_dimensions(tables):
+    """
+    STEP 2 for the dimension tables: keep one row per join key
+
+    Args:
+        tables: dict of typed input DataFrames keyed by TABLE_SCHEMAS name
+                (the fact table is not needed)
+
+    Returns:
+        dict with 'user_referral_statuses', 'referral_rewards',
+        'paid_transactions', 'user_logs_clean', 'lead_logs_clean' and
+        'latest_logs'
+    """
+    dims = {name: tables[name] for name in PLAIN_DIMENSIONS}
+    for dedup in DIMENSION_DEDUPS:
+        table = tables[dedup.table]
+        if dedup.order_by is not None:
+            dims[dedup.dimension] = latest_rows(table, dedup.key, dedup.order_by)
+        else:
+            dims[dedup.dimension] = table.drop_duplicates(subset=[dedup.key], keep=dedup.keep)
+    return dims
+
+
+def process_dimensions(dims):
+    """
+    STEP 3 for the dimension tables: local times and reward days
+
+    Args:
+        dims: dict from clean_dimensions
+
+    Returns:
+        The same dict, ready to be joined onto referrals
+    """
+    paid_transactions = dims['paid_transactions']
+    paid_transactions['transaction_at_local'] = convert_utc_to_local(
+        paid_transactions['transaction_at'], paid_transactions['timezone_transaction']
+    )
+
+    lead_logs_clean = dims['lead_logs_clean']
+    lead_logs_clean['created_at_local'] = convert_utc_to_local(
+        lead_logs_clean['created_at'], lead_logs_clean['timezone_location']
+    )
+
+    referral_rewards = dims['referral_rewards']
+    referral_rewards['num_reward_days'] = referral_rewards['reward_value'].apply(
+        lambda v: int(str(v).split()[0]) if pd.notna(v) else None
+    )
+    # float64 so the report formats these the same whether or not every
+    # referral in a batch (or chunk) matched a reward
+    referral_rewards['id'] = referral_rewards['id'].astype('float64')
+    referral_rewards['num_reward_days'] = referral_rewards['num_reward_days'].astype('float64')
+
+    return dims
+
+
+def build_dimensions(tables):
+    """STEP 2-3 in one call: clean_dimensions followed by process_dimensions"""
+    return process_dimensions(clean_dimensions(tables))
+
+
+class DimensionIndex:
+    """
+    Key index over one dimension table, built once and reused for every batch
+
+    With unique keys, joined columns are gathered by position (the key's
+    row in the dimension) instead of merging whole frames. Missing and
+    unmatched keys give missing values, and a null key matches a null
+    dimension key, as in a left merge. With duplicate keys a left merge is
+    used instead, so the fan-out (one output row per matching dimension
+    row) stays as it was, and it is reported in the join stats.
+    """
+
+    def __init__(self, join, frame):
+        self.join = join
+        self.keys = frame[join.key]
+        self.values = {name: frame[column].array for column, name in join.columns.items()}
+        self.duplicate_keys = int(self.keys.duplicated().sum())
+        self.index = pd.Index(self.keys) if self.duplicate_keys == 0 else None
+
+    def attach(self, df):
+        """
+        Add the dimension's columns to df
+
+        Returns:
+            (joined DataFrame, dict of join stats)
+        """
+        fact_keys = df[self.join.fact_key]
+        if self.index is not None:
+            positions = self.index.get_indexer(fact_keys)
+            joined = df.assign(**{
+                name: take(values, positions, allow_fill=True)
+                for name, values in self.values.items()
+            })
+            unmatched = int((positions < 0).sum())
+        else:
+            right = pd.DataFrame({'_dimension_key': self.keys.array, **self.values})
+            joined = df.merge(right, how='left', left_on=self.join.fact_key,
+                              right_on='_dimension_key').drop(columns='_dimension_key')
+            unmatched = int((~fact_keys.isin(self.keys)).sum())
+
+        return joined, {
+            'dimension': self.join.dimension,
+            'method': 'index' if self.index is not None else 'merge',
+            'rows_in': len(df),
+            'rows_out': len(joined),
+            'fan_out': len(joined) / len(df) if len(df) else 1.0,
+            'unmatched': unmatched,
+            'duplicate_keys': self.duplicate_keys,
+        }
+
+    def lookup(self, key):
+        """
+        The dimension's columns for one fact key, as attach adds them to
+        a row (missing values where the key does not match); the index
+        must have unique keys
+
+        Returns:
+            dict of joined column name -> value
+        """
+        if pd.isna(key):
+            # A missing key matches a missing dimension key, as in attach
+            positions = np.flatnonzero(self.keys.isna().to_numpy())
+            position = positions[0] if len(positions) else None
+        else:
+            try:
+                position = self.index.get_loc(key)
+            except KeyError:
+                position = None
+        if position is None:
+            return dict.fromkeys(self.values)
+        return {name: values[position] for name, values in self.values.items()}
+
+
+def index_dimensions(dims):
+    """
+    Build the STEP 4 key indexes over the processed dimension tables
+
+    Args:
+        dims: dict from build_dimensions
+
+    Returns:
+        list of DimensionIndex, in join order
+    """
+    return [DimensionIndex(join, dims[join.dimension]) for join in DIMENSION_JOINS]
+
+
+def join_referrals(referrals, dims, join_stats=None, indexes=None):
+    """
+    STEP 4: attach every dimension to the referral rows
+
+    Only the columns listed in DIMENSION_JOINS are added; the dimension
+    keys are not carried along.
+
+    Args:
+        referrals: cleaned user_referrals rows
+        dims: dimension tables from build_dimensions
+        join_stats: optional list; one dict of row counts, fan-out
+                    (rows out / rows in), unmatched rows and duplicate
+                    dimension keys is appended per dimension
+        indexes: result of index_dimensions(dims), to reuse across batches
+
+    Returns:
+        Joined DataFrame (with a fresh 0..n-1 index)
+    """
+    if indexes is None:
+        indexes = index_dimensions(dims)
+
+    df = referrals.reset_index(drop=True)
+    for index in indexes:
+        df, stats = index.attach(df)
+        if join_stats is not None:
+            join_stats.append(stats)
+    return df
+
+
+def adjust_referral_timestamps(df):
+    """STEP 5: convert referral, update and reward timestamps to local time"""
+    df['referral_at_local'] = convert_utc_to_local(
+        df['referral_at'],
+        coalesce_timezones(df['referrer_timezone'], df['timezone_location'])
+    )
+
+    referrer_timezone = coalesce_timezones(df['referrer_timezone'], DEFAULT_TIMEZONE)
+    df['updated_at_local'] = convert_utc_to_local(df['updated_at'], referrer_timezone)
+    df['reward_granted_at'] = convert_utc_to_local(df['created_at'], referrer_timezone)
+    return df
+
+
+def referrer_history(referrals, dims, indexes=None):
+    """
+    STEP 5b input: every referral's referrer, transaction location, time
+    and reward days, sorted once
+
+    Built from the whole referral table, so the window counts of a chunk,
+    a partition or an incremental batch include the referrer's (and the
+    location's) referrals outside it. Only VELOCITY_SOURCE_COLUMNS of
+    referrals are used.
+
+    Args:
+        referrals: user_referrals rows (all columns or VELOCITY_SOURCE_COLUMNS)
+        dims: dimension tables from build_dimensions
+        indexes: result of index_dimensions(dims), to reuse its reward and
+                 transaction indexes
+
+    Returns:
+        velocity.ReferrerHistory
+    """
+    return ReferrerHistory(_history_rows(referrals, dims, indexes))
+
+
+def _history_rows(referrals, dims, indexes=None):
+    """HISTORY_COLUMNS of referrals: joined with their reward days and transaction location"""
+    rows = referrals[VELOCITY_SOURCE_COLUMNS]
+    for dimension in ('referral_rewards', 'paid_transactions'):
+        join = next(join for join in DIMENSION_JOINS if join.dimension == dimension)
+        index = next((index for index in indexes or () if index.join == join), None)
+        index = index or DimensionIndex(join, dims[join.dimension])
+        rows, _ = index.attach(rows)
+    return rows[HISTORY_COLUMNS]
+
+
+def referral_context(referrals, dims, ids=None):
+    """
+    STEP 5b-5c inputs built from the whole referral table
+
+    Args:
+        referrals: user_referrals rows (all columns or CONTEXT_COLUMNS)
+        dims: dimension tables from build_dimensions
+        ids: IdDictionary the tables are encoded with (None if they are not)
+
+    Returns:
+        ReferralContext
+    """
+    return ReferralContext(referrer_history(referrals, dims),
+                           IdentityClusters(referrals[IDENTITY_SOURCE_COLUMNS], dims, ids))
+
+
+def load_referral_context(data_dir, dims, ids, directory, chunk_size, indexes=None,
+                          **read_options):
+    """
+    STEP 5b-5c inputs for runs that stream the fact table, built from
+    user_referrals read in chunks of chunk_size rows (CONTEXT_COLUMNS only)
+
+    The referrer history is spilled to files in directory and the clusters
+    are merged over identifier codes, a chunk at a time, so memory is
+    bounded by the chunk size and the id dictionary, not the table size
+    (see velocity.SpilledReferrerHistory and identity_rings.StreamedClusters).
+
+    Args:
+        ids: IdDictionary the chunks are encoded with (the scored chunks too)
+        directory: where the history files are written (the caller removes them)
+        indexes: result of index_dimensions(dims), to reuse its reward index
+        read_options: passed to table_cache.read_table
+
+    Returns:
+        ReferralContext
+    """
+    history = SpilledReferrerHistory(directory, chunk_size)
+    clusters = StreamedClusters(ids)
+    for table in sorted({link.table for link in IDENTITY_LINKS} - {FACT_TABLE}):
+        clusters.add(dims[table], table)
+    for chunk in read_table(data_dir, FACT_TABLE, columns=CONTEXT_COLUMNS,
+                            chunksize=chunk_size, **read_options):
+        chunk = ids.encode_table(chunk, FACT_TABLE)
+        history.add(_history_rows(chunk, dims, indexes))
+        clusters.add(chunk, FACT_TABLE)
+    history.finish()
+    clusters.finish()
+    return ReferralContext(history, clusters)
+
+
+def assign_source_category(df):
+    """STEP 6: derive the referral source category (missing for unknown sources)"""
+    source = df['referral_source']
+    conditions = [(source == name).to_numpy() for name in SOURCE_CATEGORIES]
+    choices = list(SOURCE_CATEGORIES.values())
+    conditions.append((source == LEAD_SOURCE).to_numpy())
+    choices.append(df['source_category'].to_numpy(dtype=object))
+    category = np.select(conditions, choices, default=None)
+    df['referral_source_category'] = pd.Series(category, index=df.index, dtype=str)
+    return df
+
+
+def normalize_text(df):
+    """STEP 7: InitCap the descriptive text columns"""
+    for col in TEXT_COLUMNS:
+        df[col] = map_unique(df[col], title_case)
+    return df
+
+
+def detect_fraud(df):
+    """STEP 8: score every referral against the fraud rule registry"""
+    df['fraud_rule_bitmask'] = evaluate_fraud_bitmask(df)
+    df['fraud_reason'] = fraud_reason_from_bitmask(df['fraud_rule_bitmask'])
+    df['is_business_logic_valid'] = df['fraud_reason'].isna()
+    return df
+
+
+def build_report(df):
+    """STEP 9: select and rename the published report columns"""
+    return df[REPORT_COLUMNS].rename(columns=REPORT_RENAMES)
+
+
+def _present(value):
+    """value, or None where it is missing (NaN, NA or NaT)"""
+    return None if value is None or pd.isna(value) else value
+
+
+def join_record(referral, indexes):
+    """
+    STEP 4 for one referral, with a key lookup per dimension
+
+    Args:
+        referral: dict of typed user_referrals values (see schema.read_record)
+        indexes: result of index_dimensions, every one with unique keys
+                 (a duplicate key fans a referral out into several rows,
+                 which only join_referrals does), or objects with the same
+                 join and lookup (such as caches in front of them)
+
+    Returns:
+        dict of the referral's and the joined columns' values
+    """
+    row = dict(referral)
+    for index in indexes:
+        row.update(index.lookup(referral[index.join.fact_key]))
+    return row
+
+
+def adjust_record_timestamps(row):
+    """STEP 5 for one joined referral (see adjust_referral_timestamps)"""
+    referrer_timezone = _present(row['referrer_timezone'])
+    row['referral_at_local'] = utc_to_local(
+        row['referral_at'], referrer_timezone or _present(row['timezone_location']))
+
+    referrer_timezone = referrer_timezone or DEFAULT_TIMEZONE
+    row['updated_at_local'] = utc_to_local(row['updated_at'], referrer_timezone)
+    row['reward_granted_at'] = utc_to_local(row['created_at'], referrer_timezone)
+    return row
+
+
+def assign_record_source_category(row):
+    """STEP 6 for one referral (see assign_source_category)"""
+    source = _present(row['referral_source'])
+    category = _present(row['source_category']) if source == LEAD_SOURCE else None
+    row['referral_source_category'] = SOURCE_CATEGORIES.get(source, category)
+    return row
+
+
+def normalize_record_text(row):
+    """STEP 7 for one referral (see normalize_text)"""
+    for col in TEXT_COLUMNS:
+        value = _present(row[col])
+        row[col] = title_case(value) if value is not None else None
+    return row
+
+
+def detect_record_fraud(row):
+    """STEP 8 for one referral (see detect_fraud)"""
+    row['fraud_rule_bitmask'], row['fraud_reason'] = evaluate_record(row)
+    row['is_business_logic_valid'] = row['fraud_reason'] is None
+    return row
+
+
+def build_record_report(row):
+    """STEP 9 for one referral: its report row as a dict (see build_report)"""
+    return {REPORT_RENAMES.get(column, column): row[column] for column in REPORT_COLUMNS}
+
+
+def process_referrals(referrals, dims, join_stats=None, indexes=None, context=None):
+    """
+    Run STEP 4-8 on a batch of referrals (the full table or one chunk)
+
+    Args:
+        referrals: cleaned user_referrals rows
+        dims: dimension tables from build_dimensions
+        join_stats: optional list collecting per-join row counts (see join_referrals)
+        indexes: result of index_dimensions(dims), to reuse across batches
+        context: referral_context over the whole referral table (default:
+                 built from this batch, which must then hold every referral)
+
+    Returns:
+        Joined, converted and scored DataFrame (one row per referral)
+    """
+    df = join_referrals(referrals, dims, join_stats, indexes)
+    df = adjust_referral_timestamps(df)
+    context = context or referral_context(referrals, dims)
+    df = add_velocity_features(df, context.history)
+    df = context.clusters.assign(df)
+    df = assign_source_category(df)
+    df = normalize_text(df)
+    return detect_fraud(df)
@@ -0,0 +1,132 @@
+"""
+Profile Cache
+Purpose: Keep each table's profiler state together with a fingerprint of the
+         CSV it was built from, so unchanged tables are not profiled again
+         and append-only tables are profiled for their new rows only
+"""
+
+import json
+import os
+import pickle
+import warnings
+from dataclasses import dataclass
+
+from schema import TABLE_SCHEMAS, input_path
+from table_cache import file_content_hash, schema_fingerprint, source_change
+
+PROFILE_CACHE_DIR_NAME = '.profile_cache'
+
+# Bump when the stored state changes shape so old entries are ignored
+PROFILE_CACHE_VERSION = 1
+
+
+@dataclass
+class CachedProfile:
+    """
+    Result of a cache lookup for one table
+
+    status is 'hit' (profiler is up to date), 'appended' (profiler covers
+    the file up to byte appended_from; the rows after it are new) or 'miss'
+    (profile the whole file). fingerprint describes the file as it is now
+    and is stored with the updated profiler.
+    """
+    status: str
+    fingerprint: dict
+    profiler: object = None
+    appended_from: int = None
+
+
+def default_cache_dir(data_dir):
+    """Cache location used when none is given: a hidden folder inside data_dir"""
+    return os.path.join(data_dir, PROFILE_CACHE_DIR_NAME)
+
+
+def _entry_paths(cache_dir, table_name, approximate):
+    base = os.path.join(cache_dir, f"{table_name}_{'approximate' if approximate else 'exact'}")
+    return base + '.pkl', base + '.json'
+
+
+def _fingerprint(source, stat, content_hash, table_name, approximate):
+    return {
+        'version': PROFILE_CACHE_VERSION,
+        'source': source,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'content_hash': content_hash,
+        'schema': schema_fingerprint(table_name),
+        'approximate': approximate,
+    }
+
+
+def _load_profiler(state_path):
+    try:
+        with open(state_path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        return None
+
+
+def lookup(data_dir, table_name, approximate=False, cache_dir=None):
+    """
+    Find the stored profiler state for a table and decide what to re-profile
+
+    The entry is current when the file has the same path, size and mtime,
+    or the same content hash. For append-only tables (see TableSchema), a
+    file whose first bytes still hash to the stored content hash only had
+    rows appended, and just those rows need profiling.
+
+    Returns:
+        CachedProfile
+    """
+    cache_dir = cache_dir or default_cache_dir(data_dir)
+    source = os.path.abspath(input_path(data_dir, table_name))
+    state_path, manifest_path = _entry_paths(cache_dir, table_name, approximate)
+    stat = os.stat(source)
+
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = None
+
+    current = _fingerprint(source, stat, None, table_name, approximate)
+    comparable = ('version', 'source', 'schema', 'approximate')
+    if manifest is None or any(manifest.get(key) != current[key] for key in comparable):
+        current['content_hash'] = file_content_hash(source)
+        return CachedProfile('miss', current)
+
+    change, current['content_hash'] = source_change(source, manifest,
+                                                    TABLE_SCHEMAS[table_name].append_only)
+    if change == 'changed':
+        return CachedProfile('miss', current)
+    status = 'hit' if change == 'same' else 'appended'
+    appended_from = manifest['size'] if change == 'appended' else None
+
+    profiler = _load_profiler(state_path)
+    if profiler is None:
+        return CachedProfile('miss', current)
+    return CachedProfile(status, current, profiler, appended_from)
+
+
+def store(data_dir, table_name, fingerprint, profiler, cache_dir=None):
+    """
+    Save a table's profiler state with the fingerprint from lookup()
+
+    A cache that cannot be written only costs a full profile next time, so
+    errors are reported as warnings.
+    """
+    cache_dir = cache_dir or default_cache_dir(data_dir)
+    state_path, manifest_path = _entry_paths(cache_dir, table_name, fingerprint['approximate'])
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f'{state_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(profiler, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, state_path)
+
+        tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(fingerprint, f, indent=2)
+        os.replace(tmp_path, manifest_path)
+    except OSError as e:
+        warnings.warn(f"Could not write profile cache for {table_name}: {e}")
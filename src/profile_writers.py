@@ -0,0 +1,86 @@
+"""
+Profile Report Writers
+Purpose: Write the combined data profile as XLSX (one sheet per table,
+         streamed with openpyxl's write-only mode), CSV, Parquet or JSON
+"""
+
+import os
+
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+
+from schema import HAS_PYARROW
+
+REPORT_BASE_NAME = 'data_profiling_report'
+
+# Sheet holding every table's columns; each table also gets its own sheet
+ALL_TABLES_SHEET = 'All Tables Profile'
+
+
+def _sheet_rows(worksheet, profile):
+    header = []
+    for column in profile.columns:
+        cell = WriteOnlyCell(worksheet, value=column)
+        cell.font = Font(bold=True)
+        header.append(cell)
+    worksheet.append(header)
+    # Missing values become empty cells, as with DataFrame.to_excel
+    values = profile.astype(object).where(profile.notna(), None)
+    for row in values.itertuples(index=False, name=None):
+        worksheet.append(row)
+
+
+def write_xlsx(profile, path):
+    """
+    One 'All Tables Profile' sheet plus one sheet per table
+
+    Rows are streamed into a write-only workbook, and each table's rows
+    are taken from a single groupby rather than a filtered copy per sheet.
+    """
+    workbook = Workbook(write_only=True)
+    _sheet_rows(workbook.create_sheet(ALL_TABLES_SHEET), profile)
+    for table_name, table_profile in profile.groupby('Table Name', sort=False):
+        _sheet_rows(workbook.create_sheet(table_name[:31]), table_profile)  # Excel sheet name limit
+    workbook.save(path)
+
+
+def write_csv(profile, path):
+    profile.to_csv(path, index=False)
+
+
+def write_parquet(profile, path):
+    if not HAS_PYARROW:
+        raise RuntimeError("Writing Parquet needs pyarrow (pip install pyarrow)")
+    profile.to_parquet(path, index=False)
+
+
+def write_json(profile, path):
+    """One JSON object per profiled column"""
+    profile.to_json(path, orient='records', indent=2)
+
+
+# Output format -> writer(profile, path); the format is also the file extension
+PROFILE_WRITERS = {
+    'xlsx': write_xlsx,
+    'csv': write_csv,
+    'parquet': write_parquet,
+    'json': write_json,
+}
+
+
+def write_profile(profile, output_dir, output_format):
+    """
+    Write the combined profile in one format
+
+    Args:
+        profile: combined profile DataFrame
+        output_dir: directory for the report
+        output_format: key in PROFILE_WRITERS
+
+    Returns:
+        Path of the written file
+    """
+    path = os.path.join(output_dir, f'{REPORT_BASE_NAME}.{output_format}')
+    PROFILE_WRITERS[output_format](profile, path)
+    return path
@@ -0,0 +1,194 @@
+"""
+Report Query CLI
+Purpose: Answer lookups on the fraud detection report (by referral or
+         referrer id, referral month and validity) from its sidecar index,
+         reading only the report blocks that can hold matching rows
+
+    python src/query_report.py --referrer-id 2c71c5d66c7e12a0b3c200ba6ed3b78e
+    python src/query_report.py --month 2024-05 --invalid --output may_flags.csv
+"""
+
+import argparse
+import gzip
+import io
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+from report_sinks import INDEX_VERSION, REPORT_FILE_NAMES, UNKNOWN_MONTH, index_path
+
+
+def find_report(output_dir):
+    """The most recently written report in output_dir that has an index, or None"""
+    indexed = [path for path in (os.path.join(output_dir, name)
+                                 for name in REPORT_FILE_NAMES.values())
+               if os.path.isdir(index_path(path))]
+    return max(indexed, key=lambda path: os.path.getmtime(index_path(path)), default=None)
+
+
+class ReportIndex:
+    """
+    A report's sidecar index: its blocks (with the months and validity
+    values each holds) and the referral and referrer id of every row
+
+    Args:
+        path: report file or Parquet directory written by report_sinks
+    """
+
+    def __init__(self, path):
+        directory = index_path(path)
+        if not os.path.isdir(directory):
+            raise FileNotFoundError(f"{path} has no index ({directory}); "
+                                    f"rerun the pipeline without --no-index")
+        with open(os.path.join(directory, 'blocks.json')) as f:
+            manifest = json.load(f)
+        if manifest['version'] != INDEX_VERSION:
+            raise ValueError(f"{directory} is index version {manifest['version']}; "
+                             f"expected {INDEX_VERSION}")
+        self.path = path
+        self.format = manifest['format']
+        self.columns = manifest['columns']
+        self.blocks = manifest['blocks']
+        self.keys = feather.read_table(os.path.join(directory, 'keys.arrow'), memory_map=True)
+
+    def candidate_blocks(self, months=None, valid=None):
+        """Blocks that can hold rows of the given months and validity (partition pruning)"""
+        return [number for number, block in enumerate(self.blocks)
+                if (months is None or not months.isdisjoint(block['months']))
+                and (valid is None or valid in block['valid'])]
+
+    def rows_with_ids(self, referral_ids=None, referrer_ids=None):
+        """Rows (block -> row numbers within it) matching every given id list"""
+        mask = None
+        for key, values in (('referral_id', referral_ids), ('referrer_id', referrer_ids)):
+            if values is not None:
+                matched = pc.is_in(self.keys[key], value_set=pa.array(list(values), pa.string()))
+                mask = matched if mask is None else pc.and_(mask, matched)
+        if mask is None:
+            return None
+        found = self.keys.filter(pc.fill_null(mask, False))
+        blocks = found['block'].to_numpy()
+        rows = found['row'].to_numpy()
+        return {int(block): np.sort(rows[blocks == block]) for block in np.unique(blocks)}
+
+    def read_block(self, number):
+        """One block's rows (CSV blocks as text, as written; Parquet blocks typed)"""
+        block = self.blocks[number]
+        if self.format == 'parquet':
+            return pq.read_table(os.path.join(self.path, block['file'])).to_pandas()
+
+        with open(self.path, 'rb') as f:
+            f.seek(block['offset'])
+            data = f.read(block['length'])
+        if self.format == 'csv.gz':
+            data = gzip.decompress(data)
+        return pd.read_csv(io.BytesIO(data), names=self.columns, header=None,
+                           dtype=str, keep_default_na=False)
+
+
+def _row_months(rows):
+    referral_at = rows['referral_at']
+    if pd.api.types.is_datetime64_any_dtype(referral_at.dtype):
+        return referral_at.dt.strftime('%Y-%m').fillna(UNKNOWN_MONTH)
+    return referral_at.str[:7].replace('', UNKNOWN_MONTH)
+
+
+def _row_valid(rows):
+    valid = rows['is_business_logic_valid']
+    if pd.api.types.is_bool_dtype(valid.dtype):
+        return valid
+    return valid == 'True'
+
+
+def query_report(path, referral_ids=None, referrer_ids=None, months=None, valid=None):
+    """
+    Report rows matching every given filter (each list matches any of its values)
+
+    Args:
+        path: report written by report_sinks (with its index)
+        referral_ids, referrer_ids: ids to look up in the index
+        months: 'YYYY-MM' referral months (local time)
+        valid: True or False to select on is_business_logic_valid
+
+    Returns:
+        (DataFrame of matching rows in report order, dict with the number
+        of blocks read and in the report)
+    """
+    index = ReportIndex(path)
+    months = set(months) if months else None
+    blocks = index.candidate_blocks(months, valid)
+    rows_by_block = index.rows_with_ids(referral_ids, referrer_ids)
+    if rows_by_block is not None:
+        blocks = [number for number in blocks if number in rows_by_block]
+
+    matches = []
+    for number in blocks:
+        rows = index.read_block(number)
+        if rows_by_block is not None:
+            rows = rows.iloc[rows_by_block[number]]
+        keep = np.ones(len(rows), dtype=bool)
+        if months is not None:
+            keep &= _row_months(rows).isin(months).to_numpy()
+        if valid is not None:
+            keep &= (_row_valid(rows) == valid).to_numpy()
+        matches.append(rows[keep])
+
+    result = (pd.concat(matches, ignore_index=True) if matches
+              else pd.DataFrame(columns=index.columns))
+    return result, {'blocks_read': len(blocks), 'blocks': len(index.blocks)}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Look up rows of the referral fraud detection report through its index."
+    )
+    parser.add_argument('--report',
+                        help="report file or Parquet directory (default: the newest indexed "
+                             "report in --output-dir)")
+    parser.add_argument('--output-dir', default='output',
+                        help="directory the pipeline wrote the report to (default: %(default)s)")
+    parser.add_argument('--referral-id', action='append', dest='referral_ids',
+                        help="referral id to look up (repeatable)")
+    parser.add_argument('--referrer-id', action='append', dest='referrer_ids',
+                        help="referrer id to look up (repeatable)")
+    parser.add_argument('--month', action='append', dest='months', metavar='YYYY-MM',
+                        help="referral month, local time (repeatable)")
+    validity = parser.add_mutually_exclusive_group()
+    validity.add_argument('--valid', dest='valid', action='store_const', const=True,
+                          help="only referrals that passed every fraud rule")
+    validity.add_argument('--invalid', dest='valid', action='store_const', const=False,
+                          help="only referrals flagged by a fraud rule")
+    parser.add_argument('--output', help="write the rows to this CSV file instead of stdout")
+    args = parser.parse_args(argv)
+
+    if not (args.referral_ids or args.referrer_ids or args.months or args.valid is not None):
+        parser.error("give at least one of --referral-id, --referrer-id, --month, "
+                     "--valid or --invalid")
+    if args.report is None:
+        args.report = find_report(args.output_dir)
+        if args.report is None:
+            parser.error(f"no indexed report in {args.output_dir}; run the pipeline first")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    started = time.perf_counter()
+    rows, stats = query_report(args.report, args.referral_ids, args.referrer_ids,
+                               args.months, args.valid)
+    rows.to_csv(args.output or sys.stdout, index=False)
+    print(f"  ✓ {len(rows)} rows from {stats['blocks_read']} of {stats['blocks']} blocks "
+          f"of {args.report} in {time.perf_counter() - started:.3f}s", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,388 @@
+"""
+Report Output Sinks
+Purpose: Write the STEP 10 report as flat CSV, gzip-compressed CSV or Parquet
+         partitioned by referral month and validity, block by block and
+         optionally on a background thread, with a sidecar index of
+         referral and referrer ids that query_report.py answers lookups from
+"""
+
+import gzip
+import json
+import os
+import queue
+import shutil
+import threading
+
+import numpy as np
+import pandas as pd
+
+from schema import REPORT_SCHEMA
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet output and the sidecar index need pyarrow
+    pa = feather = pq = None
+HAS_PYARROW = pa is not None
+
+# Output format -> report file (or, for Parquet, directory) name
+REPORT_FILE_NAMES = {
+    'csv': 'referral_fraud_detection_report.csv',
+    'csv.gz': 'referral_fraud_detection_report.csv.gz',
+    'parquet': 'referral_fraud_detection_report',
+}
+
+# Rows per block, the unit a lookup reads: a byte range of the CSV, one
+# gzip member, or one Parquet file per partition
+BLOCK_ROWS = 100_000
+# The report's hex ids compress nearly as well at level 1 as at zlib's
+# default 6, in a third of the time
+GZIP_LEVEL = 1
+
+# The index sits next to the report: <report>.index/{blocks.json,keys.arrow}
+INDEX_SUFFIX = '.index'
+INDEX_VERSION = 1
+INDEX_KEYS = ['referral_id', 'referrer_id']
+# referral_month of rows without a referral time
+UNKNOWN_MONTH = 'unknown'
+
+if HAS_PYARROW:
+    ARROW_TYPES = {'TEXT': pa.string(), 'INTEGER': pa.int64(),
+                   'DATETIME': pa.timestamp('us'), 'BOOLEAN': pa.bool_()}
+
+
+def report_path(output_dir, output_format):
+    """Where the report of an output format is written"""
+    return os.path.join(output_dir, REPORT_FILE_NAMES[output_format])
+
+
+def index_path(path):
+    """Sidecar index directory of a report file or Parquet directory"""
+    return path + INDEX_SUFFIX
+
+
+def referral_months(report):
+    """'YYYY-MM' of each row's (local) referral time, UNKNOWN_MONTH when missing"""
+    referral_at = report['referral_at']
+    numbers = (referral_at.dt.year * 100 + referral_at.dt.month).fillna(0).astype(np.int64)
+    # Only the few distinct months are formatted
+    distinct, positions = np.unique(numbers.to_numpy(), return_inverse=True)
+    labels = np.array([f'{number // 100:04d}-{number % 100:02d}' if number else UNKNOWN_MONTH
+                       for number in distinct], dtype=object)
+    return pd.Series(labels[positions], index=report.index)
+
+
+def _replace(temp, path):
+    """Move a finished file or directory into place, replacing what was there"""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(temp, path)
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+class ReportWriter:
+    """
+    write() report chunks, then close() to publish the output
+
+    As a context manager, the output is published when the block exits
+    normally and discarded (the previous report is kept) on an error.
+    """
+
+    summary = None
+
+    def write(self, chunk):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def abort(self):
+        raise NotImplementedError
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+class ReportSink(ReportWriter):
+    """
+    Splits chunks into blocks of at most BLOCK_ROWS rows and records each
+    block and the ids of its rows for the sidecar index
+
+    Everything is written under temporary names and moved into place by
+    close(), so readers never see a half-written report.
+
+    Args:
+        path: report file, or directory for partitioned output
+        index: also write the sidecar index (needs pyarrow)
+    """
+
+    format = None
+
+    def __init__(self, path, index=True):
+        self.path = path
+        self.index = index and HAS_PYARROW
+        self.columns = [column.name for column in REPORT_SCHEMA]
+        self.blocks = []
+        self.rows = 0
+        self._keys = {key: [] for key in INDEX_KEYS}
+        self._locations = []  # (block numbers, rows within the block) per block
+        self._temp = f'{path}.tmp-{os.getpid()}'
+
+    def write(self, chunk):
+        for start in range(0, len(chunk), BLOCK_ROWS):
+            block = chunk.iloc[start:start + BLOCK_ROWS]
+            self._write_block(block, referral_months(block))
+            self.rows += len(block)
+
+    def _write_block(self, block, months):
+        raise NotImplementedError
+
+    def _add_block(self, rows, entry):
+        """Record a written block and the index keys of its rows (positions in rows)"""
+        number = len(self.blocks)
+        self.blocks.append(entry)
+        if self.index:
+            for key, values in self._keys.items():
+                values.append(rows[key].to_numpy(dtype=object))
+            self._locations.append((np.full(len(rows), number, dtype=np.int32),
+                                    np.arange(len(rows), dtype=np.int32)))
+
+    def _finish(self):
+        """Flush and close the temporary output"""
+
+    def _output_bytes(self):
+        return os.path.getsize(self.path)
+
+    def _write_index(self, directory):
+        os.makedirs(directory)
+        manifest = {
+            'version': INDEX_VERSION,
+            'format': self.format,
+            'report': os.path.basename(self.path),
+            'columns': self.columns,
+            'rows': self.rows,
+            'blocks': self.blocks,
+        }
+        with open(os.path.join(directory, 'blocks.json'), 'w') as f:
+            json.dump(manifest, f, indent=1)
+
+        def column(parts, dtype):
+            return np.concatenate(parts) if parts else np.array([], dtype=dtype)
+
+        keys = pa.table({
+            **{key: pa.array(column(parts, object), type=pa.string(), from_pandas=True)
+               for key, parts in self._keys.items()},
+            'block': column([blocks for blocks, _ in self._locations], np.int32),
+            'row': column([rows for _, rows in self._locations], np.int32),
+        })
+        # Uncompressed, so lookups can memory-map it
+        feather.write_feather(keys, os.path.join(directory, 'keys.arrow'),
+                              compression='uncompressed')
+
+    def close(self):
+        self._finish()
+        sidecar = index_path(self.path)
+        temp_index = f'{sidecar}.tmp-{os.getpid()}'
+        try:
+            if self.index:
+                _remove(temp_index)
+                self._write_index(temp_index)
+            _replace(self._temp, self.path)
+            if self.index:
+                _replace(temp_index, sidecar)
+            else:
+                # An index of the previous report would point at the wrong rows
+                _remove(sidecar)
+        except BaseException:
+            _remove(temp_index)
+            _remove(self._temp)
+            raise
+        self.summary = {'format': self.format, 'path': self.path, 'rows': self.rows,
+                        'blocks': len(self.blocks), 'bytes': self._output_bytes(),
+                        'index': sidecar if self.index else None}
+        return self.summary
+
+    def abort(self):
+        self._finish()
+        _remove(self._temp)
+
+
+class CsvSink(ReportSink):
+    """
+    CSV report, the header followed by each block's rows
+
+    With compress, the header and every block are separate gzip members.
+    Concatenated members are one valid gzip file for any reader, and a
+    lookup decompresses only the member it needs.
+    """
+
+    def __init__(self, path, index=True, compress=False):
+        super().__init__(path, index)
+        self.compress = compress
+        self.format = 'csv.gz' if compress else 'csv'
+        self._file = open(self._temp, 'wb')
+        self._put(pd.DataFrame(columns=self.columns).to_csv(index=False))
+
+    def _put(self, text):
+        data = text.encode('utf-8')
+        if self.compress:
+            data = gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+        offset = self._file.tell()
+        self._file.write(data)
+        return offset, len(data)
+
+    def _write_block(self, block, months):
+        # Formatted straight into the file, a few thousand rows at a time,
+        # rather than into one string for the whole block
+        offset = self._file.tell()
+        if self.compress:
+            with gzip.GzipFile(filename='', mode='wb', fileobj=self._file,
+                               compresslevel=GZIP_LEVEL, mtime=0) as member:
+                block.to_csv(member, index=False, header=False)
+        else:
+            block.to_csv(self._file, index=False, header=False)
+        length = self._file.tell() - offset
+        valid = block['is_business_logic_valid']
+        self._add_block(block, {
+            'offset': offset,
+            'length': length,
+            'rows': len(block),
+            'months': sorted(months.unique()),
+            'valid': sorted(bool(value) for value in valid.dropna().unique()),
+        })
+
+    def _finish(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+class ParquetSink(ReportSink):
+    """
+    Parquet report partitioned by referral month and validity
+
+    Every block writes one file per partition it has rows in, under
+    referral_month=YYYY-MM/is_valid=true|false/ (hive-style, so Parquet
+    readers can prune on the directory names). The files hold every
+    report column with its declared type.
+    """
+
+    format = 'parquet'
+
+    def __init__(self, path, index=True):
+        if not HAS_PYARROW:
+            raise RuntimeError("Parquet output needs pyarrow (pip install pyarrow)")
+        super().__init__(path, index)
+        self.schema = pa.schema([(column.name, ARROW_TYPES[column.data_type])
+                                 for column in REPORT_SCHEMA])
+        os.makedirs(self._temp)
+
+    def _write_block(self, block, months):
+        valid = block['is_business_logic_valid'].fillna(False).astype(bool)
+        block_number = len(self.blocks)
+        partitions = pd.Series(np.arange(len(block))).groupby(
+            [months.to_numpy(), valid.to_numpy()], sort=True)
+        for (month, is_valid), positions in partitions:
+            rows = block.iloc[positions.to_numpy()]
+            directory = f'referral_month={month}/is_valid={str(is_valid).lower()}'
+            name = f'{directory}/part-{block_number:05d}.parquet'
+            os.makedirs(os.path.join(self._temp, directory), exist_ok=True)
+            table = pa.Table.from_pandas(rows, schema=self.schema, preserve_index=False, safe=False)
+            pq.write_table(table, os.path.join(self._temp, name))
+            self._add_block(rows, {'file': name, 'rows': len(rows), 'months': [month],
+                                   'valid': [bool(is_valid)]})
+
+    def _output_bytes(self):
+        return sum(os.path.getsize(os.path.join(directory, name))
+                   for directory, _, names in os.walk(self.path) for name in names)
+
+
+class BackgroundWriter(ReportWriter):
+    """
+    Runs a sink's writes on a thread, so the next chunk is computed while
+    the last one is formatted, compressed and written
+
+    At most max_pending chunks wait for the thread; write() blocks beyond
+    that, which bounds the memory held by unwritten chunks. An error on
+    the thread is raised by the next write() or by close().
+    """
+
+    def __init__(self, sink, max_pending=2):
+        self.sink = sink
+        self._queue = queue.Queue(max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='report-writer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while (chunk := self._queue.get()) is not None:
+            if self._error is None:
+                try:
+                    self.sink.write(chunk)
+                except BaseException as e:
+                    self._error = e
+
+    def _stop(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def write(self, chunk):
+        if self._error is not None:
+            raise self._error
+        self._queue.put(chunk)
+
+    def close(self):
+        self._stop()
+        if self._error is not None:
+            self.sink.abort()
+            raise self._error
+        self.summary = {**self.sink.close(), 'background': True}
+        return self.summary
+
+    def abort(self):
+        self._stop()
+        self.sink.abort()
+
+
+def open_sink(path, output_format, index=True, background=False):
+    """
+    Writer for a report in one of REPORT_FILE_NAMES' formats
+
+    Args:
+        path: output path (see report_path)
+        output_format: 'csv', 'csv.gz' or 'parquet'
+        index: write the sidecar index for query_report.py
+        background: write on a background thread (see BackgroundWriter)
+
+    Returns:
+        ReportWriter
+    """
+    if output_format == 'parquet':
+        sink = ParquetSink(path, index)
+    elif output_format in ('csv', 'csv.gz'):
+        sink = CsvSink(path, index, compress=output_format == 'csv.gz')
+    else:
+        raise ValueError(f"Unknown output format {output_format!r}; "
+                         f"expected one of {tuple(REPORT_FILE_NAMES)}")
+    return BackgroundWriter(sink) if background else sink
+
+
+def write_report(report, path, output_format, index=True):
+    """Write a whole report DataFrame; returns the writer's summary"""
+    with open_sink(path, output_format, index) as sink:
+        sink.write(report)
+    return sink.summary
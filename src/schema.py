@@ -0,0 +1,538 @@
+"""
+Schema Registry
+Purpose: Single declaration of every input table and of the published report.
+         Used for typed CSV loading (pipeline and profiler) and to generate
+         the data dictionary.
+"""
+
+import io
+import os
+import re
+from dataclasses import dataclass
+
+import pandas as pd
+
+from time_conversion import parse_utc_timestamp, parse_utc_timestamps
+
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+except ImportError:  # pyarrow's CSV reader is multi-threaded; the C parser is the fallback
+    pa = None
+HAS_PYARROW = pa is not None
+
+# Markers treated as missing on top of pandas' defaults
+NA_VALUES = ['null', '']
+
+# pandas' default missing-value markers, applied explicitly when pyarrow parses
+PANDAS_NA_VALUES = ['#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan',
+                    '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None',
+                    'n/a', 'nan']
+
+# Field values that are missing, whoever parses them
+MISSING_TEXT = frozenset(NA_VALUES + PANDAS_NA_VALUES)
+
+# Numbers read_record converts itself; others go through read_records. Only
+# whole numbers, which every float parser reads exactly.
+RECORD_NUMBERS = {
+    'integer': (re.compile(r'-?\d{1,18}'), int),
+    'float': (re.compile(r'-?\d{1,15}(\.0*)?'), float),
+}
+
+# Column kinds and how each one is read
+#   id        32-char hex identifier, kept as text
+#   text      free text
+#   category  low-cardinality text (statuses, sources, locations, timezones)
+#   integer   nullable integer
+#   float     nullable float
+#   timestamp UTC timestamp, parsed to a timezone-aware datetime
+#   date      local calendar date such as 9/2/2024
+#   boolean   TRUE / FALSE flag (nullable)
+READ_DTYPES = {
+    'id': str,
+    'text': str,
+    'category': 'category',
+    'integer': 'Int64',
+    'float': 'float64',
+    'timestamp': str,
+    'date': str,
+    'boolean': str,
+}
+
+
+@dataclass(frozen=True)
+class Column:
+    """One input column: its kind (see READ_DTYPES) and what it holds"""
+    kind: str
+    description: str
+
+
+@dataclass(frozen=True)
+class TableSchema:
+    """One input table: its CSV file name and ordered columns"""
+    file_name: str
+    description: str
+    columns: dict
+    # New rows are only ever appended to the file (see profile_cache.py)
+    append_only: bool = False
+
+
+@dataclass(frozen=True)
+class ReportColumn:
+    """One column of referral_fraud_detection_report.csv"""
+    name: str
+    source: str
+    data_type: str
+    description: str
+    business_rules: str
+    example_values: str
+    used_by: str
+
+
+TABLE_SCHEMAS = {
+    'lead_logs': TableSchema(
+        'lead_log(in).csv',
+        'Marketing leads and their status history',
+        {
+            'id': Column('integer', 'Row number of the lead log entry'),
+            'lead_id': Column('id', 'Lead identifier; referee_id of Lead referrals'),
+            'source_category': Column('category', 'Lead channel: Online or Offline'),
+            'created_at': Column('timestamp', 'When the lead entry was logged (UTC)'),
+            'preferred_location': Column('category', 'Club the lead is interested in'),
+            'timezone_location': Column('category', 'Timezone of the preferred club'),
+            'current_status': Column('category', 'Sales status of the lead'),
+        },
+        append_only=True
+    ),
+    'user_referrals': TableSchema(
+        'user_referrals(in).csv',
+        'One row per referral (the fact table)',
+        {
+            'referral_at': Column('timestamp', 'When the referral was made (UTC)'),
+            'referral_id': Column('id', 'Referral identifier'),
+            'referee_id': Column('id', 'Referred person (lead or user)'),
+            'referee_name': Column('text', 'Hashed name of the referred person'),
+            'referee_phone': Column('id', 'Hashed phone of the referred person'),
+            'referral_reward_id': Column('float', 'Reward assigned to the referral'),
+            'referral_source': Column('category', 'User Sign Up, Draft Transaction or Lead'),
+            'referrer_id': Column('id', 'Member who made the referral'),
+            'transaction_id': Column('id', 'Transaction linked to the referral'),
+            'updated_at': Column('timestamp', 'Last update of the referral (UTC)'),
+            'user_referral_status_id': Column('integer', 'Current referral status'),
+        }
+    ),
+    'user_referral_logs': TableSchema(
+        'user_referral_logs(in).csv',
+        'Event log of referral updates and reward grants',
+        {
+            'id': Column('integer', 'Log entry number'),
+            'user_referral_id': Column('id', 'Referral the entry belongs to'),
+            'source_transaction_id': Column('id', 'Transaction that triggered the entry'),
+            'created_at': Column('timestamp', 'When the entry was logged (UTC)'),
+            'is_reward_granted': Column('boolean', 'Whether the reward was granted'),
+        },
+        append_only=True
+    ),
+    'user_logs': TableSchema(
+        'user_logs(in).csv',
+        'Member profiles',
+        {
+            'id': Column('integer', 'Row number of the profile entry'),
+            'user_id': Column('id', 'Member identifier; referrer_id of referrals'),
+            'name': Column('text', 'Hashed member name'),
+            'phone_number': Column('id', 'Hashed member phone'),
+            'homeclub': Column('category', 'Club the member belongs to'),
+            'timezone_homeclub': Column('category', 'Timezone of the home club'),
+            'membership_expired_date': Column('date', 'Membership expiry date'),
+            'is_deleted': Column('boolean', 'Whether the account was deleted'),
+        }
+    ),
+    'user_referral_statuses': TableSchema(
+        'user_referral_statuses(in).csv',
+        'Referral status lookup',
+        {
+            'id': Column('integer', 'Status identifier'),
+            'description': Column('category', 'Berhasil, Menunggu or Tidak Berhasil'),
+            'created_at': Column('timestamp', 'When the status was created (UTC)'),
+        }
+    ),
+    'referral_rewards': TableSchema(
+        'referral_rewards(in).csv',
+        'Reward lookup',
+        {
+            'id': Column('integer', 'Reward identifier'),
+            'reward_value': Column('category', 'Reward size such as "10 days"'),
+            'created_at': Column('timestamp', 'When the reward was created (UTC)'),
+            'reward_type': Column('category', 'Reward type code'),
+        }
+    ),
+    'paid_transactions': TableSchema(
+        'paid_transactions(in).csv',
+        'Membership payments',
+        {
+            'transaction_id': Column('id', 'Transaction identifier'),
+            'transaction_status': Column('category', 'Payment status, e.g. PAID'),
+            'transaction_at': Column('timestamp', 'When the payment happened (UTC)'),
+            'transaction_location': Column('category', 'Club where the payment happened'),
+            'timezone_transaction': Column('category', 'Timezone of that club'),
+            'transaction_type': Column('category', 'NEW or REJOIN'),
+        },
+        append_only=True
+    ),
+}
+
+# The fact table; everything else is a small dimension table
+FACT_TABLE = 'user_referrals'
+
+REPORT_SCHEMA = [
+    ReportColumn(
+        'referral_details_id', 'id', 'INTEGER',
+        'Unique identifier for each referral detail record. This is an auto-generated number.',
+        'Always unique. System-generated.',
+        '1, 2, 3, 4...',
+        'System tracking and reporting'),
+    ReportColumn(
+        'referral_id', 'referral_id', 'TEXT',
+        'Unique code assigned to each referral. This is the main identifier for tracking a referral.',
+        'Always unique. Cannot be null.',
+        '9331c8f144dad5a3b8e4a10467b4343a',
+        'Customer service, Operations team'),
+    ReportColumn(
+        'referral_source', 'referral_source', 'TEXT',
+        'How the referral was made. Values: "User Sign Up" (online), "Draft Transaction" (in-store), or "Lead" (marketing campaign).',
+        'Must be one of three values: User Sign Up, Draft Transaction, or Lead.',
+        'User Sign Up, Draft Transaction, Lead',
+        'Marketing team for campaign analysis'),
+    ReportColumn(
+        'referral_source_category', 'referral_source_category', 'TEXT',
+        'Simplified category of referral source. Values: "Online" or "Offline".',
+        'Derived from referral_source. Either Online or Offline.',
+        'Online, Offline',
+        'Marketing team for channel analysis'),
+    ReportColumn(
+        'referral_at', 'referral_at_local', 'DATETIME',
+        'The exact date and time when the referral was created (in local timezone).',
+        'Cannot be null. Must be a valid date/time.',
+        '2024-05-15 14:35:00',
+        'Operations team for timeline tracking'),
+    ReportColumn(
+        'referrer_id', 'referrer_id', 'TEXT',
+        'Unique identifier of the person who referred the new user.',
+        'Must exist in user system. Can be null for some transaction types.',
+        '2c71c5d66c7e12a0b3c200ba6ed3b78e',
+        'Customer service, Rewards team'),
+    ReportColumn(
+        'referrer_name', 'referrer_name', 'TEXT',
+        'Full name of the person who referred the new user.',
+        'Formatted in Title Case (First Letter Capitalized).',
+        'John Doe, Jane Smith',
+        'Customer service for contact'),
+    ReportColumn(
+        'referrer_phone_number', 'referrer_phone_number', 'TEXT',
+        'Contact phone number of the person who made the referral.',
+        'Valid phone number format.',
+        '123-456-7890, 987-654-3210',
+        'Customer service for contact'),
+    ReportColumn(
+        'referrer_homeclub', 'referrer_homeclub', 'TEXT',
+        'The gym location where the referrer is a member.',
+        'Must be a valid gym location. UPPERCASE format preserved.',
+        'PERMATA HIJAU, BENHIL, BLOK M',
+        'Operations team for location analysis'),
+    ReportColumn(
+        'referee_id', 'referee_id', 'TEXT',
+        'Unique identifier of the person who was referred (new user).',
+        'Can be null if referral source is not "Lead".',
+        'f12348hbsdkjkfhkjdf',
+        'Customer service, Operations team'),
+    ReportColumn(
+        'referee_name', 'referee_name', 'TEXT',
+        'Full name of the person who was referred.',
+        'Formatted in Title Case.',
+        'Michael Johnson, Sarah Williams',
+        'Customer service for contact'),
+    ReportColumn(
+        'referee_phone', 'referee_phone', 'TEXT',
+        'Contact phone number of the person who was referred.',
+        'Valid phone number format.',
+        '555-123-4567',
+        'Customer service for contact'),
+    ReportColumn(
+        'referral_status', 'referral_status', 'TEXT',
+        'Current status of the referral. Values: "Berhasil" (Successful), "Menunggu" (Pending), "Tidak Berhasil" (Failed).',
+        'Must be one of: Berhasil, Menunggu, or Tidak Berhasil.',
+        'Berhasil, Menunggu, Tidak Berhasil',
+        'Rewards team for approval workflow'),
+    ReportColumn(
+        'num_reward_days', 'num_reward_days', 'INTEGER',
+        'Number of days awarded as reward. For example, 10 means 10 days free membership.',
+        'Zero or positive integer. Zero means no reward.',
+        '0, 10, 15, 20',
+        'Rewards team for reward distribution'),
+    ReportColumn(
+        'transaction_id', 'transaction_id', 'TEXT',
+        'Unique code of the transaction linked to this referral.',
+        'Can be null if transaction has not occurred yet.',
+        '1d1eb8a9e864a1cccb2d850398461807',
+        'Finance team for payment tracking'),
+    ReportColumn(
+        'transaction_status', 'transaction_status', 'TEXT',
+        'Payment status of the transaction. Value: "Paid" or "No Transaction".',
+        'Either "Paid" or "No Transaction".',
+        'Paid, No Transaction',
+        'Finance team for payment verification'),
+    ReportColumn(
+        'transaction_at', 'transaction_at_local', 'DATETIME',
+        'The exact date and time when the transaction was completed (in local timezone).',
+        'Can be null if no transaction yet. Must be after referral_at.',
+        '2024-05-20 10:00:00',
+        'Finance team for transaction tracking'),
+    ReportColumn(
+        'transaction_location', 'transaction_location', 'TEXT',
+        'The gym location where the transaction took place.',
+        'Must be a valid gym location.',
+        'BENHIL, ARTERI PONDOK INDAH',
+        'Operations team for location analysis'),
+    ReportColumn(
+        'transaction_type', 'transaction_type', 'TEXT',
+        'Type of transaction. Values: "New" (new membership) or "Rejoin" (returning member).',
+        'Either "New" or "Rejoin" or "No Transaction".',
+        'New, Rejoin, No Transaction',
+        'Operations team for membership type'),
+    ReportColumn(
+        'updated_at', 'updated_at_local', 'DATETIME',
+        'The date and time when the referral record was last updated.',
+        'Must be same or after referral_at.',
+        '2024-05-21 12:00:00',
+        'System audit and tracking'),
+    ReportColumn(
+        'reward_granted_at', 'reward_granted_at', 'DATETIME',
+        'The date and time when the reward was actually given to the referee.',
+        'Only filled when reward is actually granted.',
+        '2024-05-30 14:00:00',
+        'Rewards team for fulfillment tracking'),
+    ReportColumn(
+        'is_business_logic_valid', 'is_business_logic_valid', 'BOOLEAN',
+        'Indicates if this referral passed all fraud detection checks. TRUE = Valid referral, FALSE = Potential fraud detected.',
+        'TRUE if all fraud checks passed, FALSE otherwise.',
+        'TRUE, FALSE',
+        'Fraud detection team, Compliance team'),
+    ReportColumn(
+        'fraud_reason', 'fraud_reason', 'TEXT',
+        'The first fraud check this referral failed, in the order of the Fraud Detection Rules sheet.',
+        'Empty when is_business_logic_valid is TRUE.',
+        'Paid transaction but reward = 0',
+        'Fraud detection team, Compliance team'),
+    ReportColumn(
+        'fraud_rule_bitmask', 'fraud_rule_bitmask', 'INTEGER',
+        'Every fraud check this referral failed, one bit per rule (see the Bit column of the Fraud Detection Rules sheet).',
+        'Zero when no check failed. The lowest set bit is the fraud_reason.',
+        '0, 4, 17',
+        'Fraud detection team for overlap analysis'),
+    ReportColumn(
+        'cluster_id', 'cluster_id', 'TEXT',
+        'Group of referrals whose referees are linked by shared phone numbers or transactions. Labelled with the smallest account id, phone hash or transaction id in the group.',
+        'Empty when the referral has no referee, transaction or phone. Stays the same while that identifier is in the group; merged groups keep the smaller label.',
+        '0a1b2c3d4e5f60718293a4b5c6d7e8f9',
+        'Fraud detection team for ring investigation'),
+    ReportColumn(
+        'cluster_size', 'cluster_size', 'INTEGER',
+        'Number of accounts (referees and users) in the cluster. More than 1 means an identity is shared.',
+        'Zero or positive integer. Empty when cluster_id is empty.',
+        '1, 2, 4',
+        'Fraud detection team for ring investigation'),
+]
+
+
+def input_path(data_dir, table_name):
+    """Path of the CSV file for a table"""
+    return os.path.join(data_dir, TABLE_SCHEMAS[table_name].file_name)
+
+
+def apply_types(df, table_name):
+    """
+    Convert the columns read as text into their declared kinds
+
+    Args:
+        df: DataFrame (or chunk) read with read_csv_kwargs
+        table_name: key in TABLE_SCHEMAS
+
+    Returns:
+        The same DataFrame with timestamp, date and boolean columns converted
+    """
+    for name, column in TABLE_SCHEMAS[table_name].columns.items():
+        if name not in df.columns:
+            continue
+        if column.kind == 'timestamp':
+            df[name] = parse_utc_timestamps(df[name])
+        elif column.kind == 'date':
+            df[name] = pd.to_datetime(df[name], errors='coerce')
+        elif column.kind == 'boolean':
+            df[name] = df[name].astype('string').str.upper().map({'TRUE': True, 'FALSE': False}).astype('boolean')
+    return df
+
+
+def read_csv_kwargs(table_name, columns=None):
+    """
+    read_csv arguments for a table: declared dtypes and null markers
+
+    Args:
+        table_name: key in TABLE_SCHEMAS
+        columns: optional subset of columns to read
+
+    Returns:
+        dict of keyword arguments for pd.read_csv
+    """
+    declared = TABLE_SCHEMAS[table_name].columns
+    wanted = list(declared) if columns is None else list(columns)
+    return {
+        'dtype': {name: READ_DTYPES[declared[name].kind] for name in wanted},
+        'usecols': wanted,
+        'na_values': NA_VALUES,
+    }
+
+
+def _read_csv_pyarrow(path, table_name, columns=None):
+    """
+    Whole-table read with pyarrow's multi-threaded CSV parser
+
+    Every column is parsed as text and then cast to its read dtype, which
+    gives the same frame as the C parser. (Through pandas' engine='pyarrow',
+    pyarrow infers timestamps that pandas then formats back into strings,
+    which is slower than the C parser.)
+    """
+    kwargs = read_csv_kwargs(table_name, columns)
+    wanted = [name for name in TABLE_SCHEMAS[table_name].columns if name in kwargs['usecols']]
+    table = pa_csv.read_csv(path, convert_options=pa_csv.ConvertOptions(
+        include_columns=wanted,
+        column_types={name: pa.string() for name in wanted},
+        null_values=NA_VALUES + PANDAS_NA_VALUES,
+        strings_can_be_null=True,
+    ))
+    return table.to_pandas().astype(kwargs['dtype'])
+
+
+def read_csv_appended(data_dir, table_name, offset, columns=None, chunksize=None):
+    """
+    Parse only the rows appended to an input CSV after a byte offset
+
+    Args:
+        data_dir: directory holding the input CSV files
+        table_name: key in TABLE_SCHEMAS
+        offset: file size when it was last read (must end a line)
+        columns: optional subset of columns to read
+        chunksize: if set, return an iterator of typed chunks instead
+
+    Returns:
+        Typed DataFrame, or an iterator of typed DataFrames
+    """
+    with open(input_path(data_dir, table_name), 'rb') as f:
+        header = f.readline()
+        f.seek(offset)
+        rows = f.read()
+
+    buffer = io.BytesIO(header + rows)
+    if chunksize is not None:
+        reader = pd.read_csv(buffer, chunksize=chunksize, **read_csv_kwargs(table_name, columns))
+        return (apply_types(chunk, table_name) for chunk in reader)
+    return apply_types(pd.read_csv(buffer, **read_csv_kwargs(table_name, columns)), table_name)
+
+
+def read_records(records, table_name):
+    """
+    Typed DataFrame from records of CSV field values (such as a JSON request)
+
+    The records are written out as CSV and parsed like an input file, so
+    their values get exactly the types a file read would give them.
+
+    Args:
+        records: list of dicts keyed by column name; missing keys and None
+                 are missing values, other keys are ignored
+        table_name: key in TABLE_SCHEMAS
+
+    Returns:
+        Typed DataFrame with every column of the table
+    """
+    columns = list(TABLE_SCHEMAS[table_name].columns)
+    buffer = io.StringIO()
+    pd.DataFrame.from_records(records, columns=columns).to_csv(buffer, index=False)
+    buffer.seek(0)
+    return apply_types(pd.read_csv(buffer, **read_csv_kwargs(table_name)), table_name)
+
+
+def read_record(record, table_name):
+    """
+    Typed values of one record of CSV field values, for scoring a single
+    referral without building a DataFrame
+
+    Text, identifiers, categories, timestamps and whole numbers are
+    converted directly; a record with any other value (a float, a flag, a
+    date...) goes through read_records, so every value gets the type, or
+    the error, a file read would give it.
+
+    Args:
+        record: dict keyed by column name (see read_records)
+        table_name: key in TABLE_SCHEMAS
+
+    Returns:
+        dict of every column of the table to its typed value (None, NaN
+        or NaT where missing)
+
+    Raises:
+        ValueError: a value does not convert to its column's type
+    """
+    row = {}
+    for name, column in TABLE_SCHEMAS[table_name].columns.items():
+        value = record.get(name)
+        if isinstance(value, int) and not isinstance(value, bool):
+            value = str(value)
+        if not isinstance(value, (str, type(None))):
+            break
+        if value is None or value in MISSING_TEXT:
+            row[name] = pd.NaT if column.kind == 'timestamp' else None
+        elif column.kind in ('id', 'text', 'category'):
+            row[name] = value
+        elif column.kind == 'timestamp':
+            row[name] = parse_utc_timestamp(value)
+        elif column.kind in RECORD_NUMBERS and RECORD_NUMBERS[column.kind][0].fullmatch(value):
+            row[name] = RECORD_NUMBERS[column.kind][1](value)
+        else:
+            break
+    else:
+        return row
+    return read_records([record], table_name).iloc[0].to_dict()
+
+
+def read_csv_table(data_dir, table_name, columns=None, chunksize=None, engine=None):
+    """
+    Parse an input CSV with its declared types (no cache; see table_cache.read_table)
+
+    Whole-table reads use pyarrow's multi-threaded CSV parser when it is
+    installed; chunked reads need the C parser.
+
+    Args:
+        data_dir: directory holding the input CSV files
+        table_name: key in TABLE_SCHEMAS
+        columns: optional subset of columns to read
+        chunksize: if set, return an iterator of typed chunks instead
+        engine: 'pyarrow' or 'c' for whole-table reads (default: pyarrow if installed)
+
+    Returns:
+        Typed DataFrame, or an iterator of typed DataFrames
+    """
+    path = input_path(data_dir, table_name)
+
+    if chunksize is not None:
+        reader = pd.read_csv(path, chunksize=chunksize, **read_csv_kwargs(table_name, columns))
+        return (apply_types(chunk, table_name) for chunk in reader)
+
+    if engine is None:
+        engine = 'pyarrow' if HAS_PYARROW else 'c'
+    if engine == 'pyarrow':
+        if not HAS_PYARROW:
+            raise RuntimeError("The pyarrow CSV engine needs pyarrow (pip install pyarrow); "
+                               "use engine 'c' without it")
+        df = _read_csv_pyarrow(path, table_name, columns)
+    else:
+        df = pd.read_csv(path, **read_csv_kwargs(table_name, columns))
+    return apply_types(df, table_name)
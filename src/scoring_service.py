@@ -0,0 +1,620 @@
+"""
+Online Referral Scoring Service
+Purpose: Score a single referral or a micro-batch in milliseconds against
+         dimension tables held in memory, with the batch pipeline's joins,
+         timezone conversion and fraud rules, from Python or over HTTP
+
+A single referral is scored without DataFrames: dict lookups into the
+dimension indexes, scalar timezone conversion, binary searches into the
+referrer history and the rules evaluated on one row. Micro-batches go
+through the batch pipeline's stages.
+
+Python:
+    service = ScoringService('data')
+    service.score({'referral_id': 'r1', 'referrer_id': 'u1', ...})['fraud_reason']
+
+HTTP (python src/scoring_service.py --help):
+    POST /score    one user_referrals record (JSON object) or a list of them
+    POST /refresh  reload the tables whose CSV files changed
+    GET  /health   snapshot and verdict cache statistics
+
+Importing this module has no side effects; the tables are loaded when a
+ScoringService is created.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+from latest_state import read_latest
+from pipeline_stages import (CONTEXT_COLUMNS, DIMENSION_DEDUPS, VELOCITY_SOURCE_COLUMNS,
+                             ReferralContext, adjust_record_timestamps,
+                             adjust_referral_timestamps, assign_record_source_category,
+                             assign_source_category, build_dimensions, build_record_report,
+                             build_report, detect_fraud, detect_record_fraud, index_dimensions,
+                             join_record, join_referrals, normalize_record_text, normalize_text,
+                             process_referrals, referral_context, referrer_history)
+from schema import FACT_TABLE, TABLE_SCHEMAS, input_path, read_record, read_records
+from table_cache import CACHE_ENABLED, read_table, read_tables
+from velocity import add_record_velocity_features, add_velocity_features
+
+# Verdicts kept for repeated requests (least recently used are evicted)
+DEFAULT_CACHE_SIZE = 10_000
+# Joined rows kept per dimension table for single referrals (see DimensionCache)
+DEFAULT_DIMENSION_CACHE_SIZE = 50_000
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+# Largest request body the HTTP front end accepts
+MAX_BODY_BYTES = 1 << 20
+# Referrals per micro-batch when --check scores the file in batches
+CHECK_BATCH_SIZE = 50
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+                405: 'Method Not Allowed', 413: 'Payload Too Large',
+                500: 'Internal Server Error'}
+
+
+class RecordError(ValueError):
+    """A request record whose values cannot be read as a user_referrals row"""
+
+
+class LRUCache:
+    """
+    Mapping bounded to max_size entries; the least recently used goes first
+
+    Safe to share between the event loop and a refresh thread.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Cached value for key, or None"""
+        with self._lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {'entries': len(self.entries), 'max_size': self.max_size, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+
+class DimensionCache:
+    """
+    One dimension's joined columns by key, for single referrals: looked up
+    in its key index (pipeline_stages.DimensionIndex.lookup) and kept in
+    an LRU cache, so the keys of recent and busy referrers, leads,
+    statuses, rewards, transactions and referral logs are answered
+    without touching the tables
+
+    Args:
+        index: DimensionIndex with unique keys
+        max_size: joined rows to keep
+    """
+
+    def __init__(self, index, max_size):
+        self.join = index.join
+        self.index = index
+        self.rows = LRUCache(max_size)
+
+    def lookup(self, key):
+        """Joined columns for one fact key (see DimensionIndex.lookup); do not modify them"""
+        key = None if pd.isna(key) else key
+        row = self.rows.get(key)
+        if row is None:
+            row = self.index.lookup(key)
+            self.rows.put(key, row)
+        return row
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    """Everything a referral is scored against, loaded from one set of input files"""
+    dims: dict  # from pipeline_stages.build_dimensions
+    indexes: list  # from pipeline_stages.index_dimensions
+    dimensions: list  # a DimensionCache per index (empty without unique keys)
+    context: ReferralContext  # over the user_referrals file
+    referrals: pd.DataFrame  # referral_id + CONTEXT_COLUMNS of the user_referrals file
+    referral_ids: pd.Index  # referrals['referral_id'], hashed once for lookups
+    history_values: dict  # VELOCITY_SOURCE_COLUMNS of referrals as arrays (see score_record)
+    fingerprints: dict  # table name -> (size, mtime) of its CSV file
+    loaded_at: float = field(default_factory=time.time)
+
+    @property
+    def unique_keys(self):
+        """Every dimension has unique keys, so a referral joins to one row (see score_record)"""
+        return bool(self.dimensions)
+
+
+def file_fingerprints(data_dir):
+    """(size, modification time) of every input CSV, to notice changed files cheaply"""
+    fingerprints = {}
+    for name in TABLE_SCHEMAS:
+        status = os.stat(input_path(data_dir, name))
+        fingerprints[name] = (status.st_size, status.st_mtime_ns)
+    return fingerprints
+
+
+def load_snapshot(data_dir, use_cache=CACHE_ENABLED,
+                  dimension_cache_size=DEFAULT_DIMENSION_CACHE_SIZE):
+    """
+    STEP 1-3 and the whole-table STEP 5b-5c context, held for scoring
+
+    Tables come through the Arrow table cache, and the event logs through
+    the latest-state store, so a refresh after a small append is cheap.
+    Identifiers stay strings: requests carry them as strings.
+
+    Args:
+        dimension_cache_size: joined rows cached per dimension (see DimensionCache)
+
+    Returns:
+        Snapshot
+    """
+    fingerprints = file_fingerprints(data_dir)
+    event_logs = {dedup.table: dedup for dedup in DIMENSION_DEDUPS if dedup.order_by is not None}
+    table_names = [name for name in TABLE_SCHEMAS
+                   if name != FACT_TABLE and name not in event_logs]
+    tables, _ = read_tables(data_dir, table_names, use_cache=use_cache)
+    for name, dedup in event_logs.items():
+        tables[name], _ = read_latest(data_dir, dedup, use_cache=use_cache)
+
+    dims = build_dimensions(tables)
+    referrals = read_table(data_dir, FACT_TABLE, columns=['referral_id'] + CONTEXT_COLUMNS,
+                           use_cache=use_cache)
+    indexes = index_dimensions(dims)
+    unique_keys = all(index.index is not None for index in indexes)
+    return Snapshot(dims=dims, indexes=indexes,
+                    dimensions=[DimensionCache(index, dimension_cache_size)
+                                for index in indexes] if unique_keys else [],
+                    context=referral_context(referrals, dims), referrals=referrals,
+                    referral_ids=pd.Index(referrals['referral_id']),
+                    history_values={column: referrals[column].array
+                                    for column in VELOCITY_SOURCE_COLUMNS},
+                    fingerprints=fingerprints)
+
+
+def score_referrals(snapshot, referrals):
+    """
+    STEP 4-9 for a few referrals, against a snapshot
+
+    The whole-table features see the snapshot as if these referrals were
+    in it: a referral already in the file replaces its stored version in
+    the referrer's velocity windows, and new referrals' phones and
+    transactions link to the snapshot's identity clusters. (Links a stored
+    referral loses by being replaced are still counted.)
+
+    Args:
+        snapshot: Snapshot from load_snapshot
+        referrals: typed user_referrals rows (see schema.read_records)
+
+    Returns:
+        Report DataFrame (one row per referral, more if a dimension has
+        duplicate keys)
+    """
+    dims, indexes = snapshot.dims, snapshot.indexes
+    df = join_referrals(referrals, dims, indexes=indexes)
+    df = adjust_referral_timestamps(df)
+
+    positions, _ = snapshot.referral_ids.get_indexer_non_unique(referrals['referral_id'])
+    positions = positions[positions >= 0]
+    removed = (referrer_history(snapshot.referrals.take(positions), dims, indexes)
+               if len(positions) else None)
+    df = add_velocity_features(df, snapshot.context.history,
+                               added=referrer_history(referrals, dims, indexes), removed=removed)
+    df = snapshot.context.clusters.assign(df, added=referrals)
+
+    df = assign_source_category(df)
+    df = normalize_text(df)
+    return build_report(detect_fraud(df))
+
+
+def _stored_history(snapshot, referral_id):
+    """History rows (dicts with HISTORY_COLUMNS) of the file's referrals with this id"""
+    if pd.isna(referral_id):
+        positions = np.flatnonzero(snapshot.referral_ids.isna())
+    else:
+        try:
+            found = snapshot.referral_ids.get_loc(referral_id)
+        except KeyError:
+            return []
+        # One position, a slice (sorted duplicates) or a mask (other duplicates)
+        if isinstance(found, slice):
+            positions = range(len(snapshot.referral_ids))[found]
+        elif isinstance(found, np.ndarray):
+            positions = np.flatnonzero(found)
+        else:
+            positions = [found]
+    dimensions = [dimension for dimension in snapshot.dimensions
+                  if dimension.join.dimension in ('referral_rewards', 'paid_transactions')]
+    return [join_record({column: values[position]
+                         for column, values in snapshot.history_values.items()}, dimensions)
+            for position in positions]
+
+
+def score_record(snapshot, referral):
+    """
+    STEP 4-9 for one referral, without DataFrames
+
+    Gives the report row score_referrals gives a batch of this referral
+    alone: its velocity windows and identity cluster include it, in place
+    of its stored version.
+
+    Args:
+        snapshot: Snapshot from load_snapshot, with unique_keys
+        referral: dict of typed user_referrals values (see schema.read_record)
+
+    Returns:
+        Report row (dict of report column -> value)
+    """
+    row = adjust_record_timestamps(join_record(referral, snapshot.dimensions))
+    row = add_record_velocity_features(row, snapshot.context.history, added=[row],
+                                       removed=_stored_history(snapshot, referral['referral_id']))
+    row['cluster_id'], row['cluster_size'] = snapshot.context.clusters.record_cluster(row)
+
+    row = assign_record_source_category(row)
+    row = normalize_record_text(row)
+    return build_record_report(detect_record_fraud(row))
+
+
+def _json_value(value):
+    """A report value as JSON: timestamps as ISO text (fractional seconds kept), missing values as None"""
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat(sep=' ')
+    if value is None or pd.isna(value):
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def report_record(row):
+    """A report row (dict) as a JSON-ready dict"""
+    return {name: _json_value(value) for name, value in row.items()}
+
+
+def report_records(report):
+    """Report rows as JSON-ready dicts"""
+    return [report_record(row) for row in report.to_dict('records')]
+
+
+class ScoringService:
+    """
+    In-process referral scoring with cached, indexed dimension tables
+
+    The dimension tables, their key indexes, LRU caches of their joined
+    rows and the whole-table context are loaded once into an immutable
+    Snapshot. refresh() loads a new one when an input file has changed and
+    swaps it in, so requests being scored keep the snapshot they started
+    with. Verdicts are cached per request in an LRU cache that a refresh
+    clears.
+
+    Args:
+        data_dir: directory holding the input CSV files
+        cache_size: verdicts to keep for repeated requests (0 disables)
+        use_cache: False to parse the CSV files instead of the table cache
+        dimension_cache_size: joined rows to keep per dimension table
+    """
+
+    def __init__(self, data_dir='data', cache_size=DEFAULT_CACHE_SIZE, use_cache=CACHE_ENABLED,
+                 dimension_cache_size=DEFAULT_DIMENSION_CACHE_SIZE):
+        self.data_dir = data_dir
+        self.use_cache = use_cache
+        self.dimension_cache_size = dimension_cache_size
+        self.verdicts = LRUCache(cache_size)
+        self._refresh_lock = threading.Lock()
+        self.snapshot = load_snapshot(data_dir, use_cache, dimension_cache_size)
+
+    def refresh(self, force=False):
+        """
+        Reload the snapshot if any input CSV changed since it was loaded
+
+        Args:
+            force: reload even if no file changed
+
+        Returns:
+            Names of the changed tables (every table when forced)
+        """
+        with self._refresh_lock:
+            fingerprints = file_fingerprints(self.data_dir)
+            changed = [name for name in TABLE_SCHEMAS
+                       if force or fingerprints[name] != self.snapshot.fingerprints[name]]
+            if changed:
+                self.snapshot = load_snapshot(self.data_dir, self.use_cache,
+                                              self.dimension_cache_size)
+                self.verdicts.clear()
+            return changed
+
+    def score_batch(self, records):
+        """
+        Score a micro-batch of referrals (a batch of one with score_record)
+
+        Args:
+            records: list of user_referrals records, dicts of CSV field
+                     values keyed by column name (timestamps in UTC, as in
+                     the input file)
+
+        Returns:
+            List of report rows (dicts with fraud_reason,
+            is_business_logic_valid and the other report columns)
+
+        Raises:
+            RecordError: a value is not a string, number, boolean or null,
+                         or does not convert to its column's type
+        """
+        for record in records:
+            for name, value in record.items():
+                if not isinstance(value, (str, int, float, bool, type(None))):
+                    raise RecordError(f"invalid referral record: {name} is a "
+                                      f"{type(value).__name__}, not a single value")
+        key = json.dumps(records, sort_keys=True, default=str)
+        if self.verdicts.max_size:
+            cached = self.verdicts.get(key)
+            if cached is not None:
+                return [dict(row) for row in cached]
+
+        snapshot = self.snapshot
+        single = len(records) == 1 and snapshot.unique_keys
+        try:
+            referrals = (read_record(records[0], FACT_TABLE) if single
+                         else read_records(records, FACT_TABLE))
+        except (ValueError, TypeError) as e:
+            raise RecordError(f"invalid referral record: {e}") from e
+        if single:
+            result = [report_record(score_record(snapshot, referrals))]
+        else:
+            result = report_records(score_referrals(snapshot, referrals))
+        if self.verdicts.max_size and snapshot is self.snapshot:
+            self.verdicts.put(key, result)
+        return result
+
+    def score(self, record):
+        """Score one referral record (see score_batch); returns its report row"""
+        return self.score_batch([record])[0]
+
+    def health(self):
+        snapshot = self.snapshot
+        return {
+            'status': 'ok',
+            'loaded_at': pd.Timestamp(snapshot.loaded_at, unit='s').isoformat(),
+            'referrals': len(snapshot.referrals),
+            'dimensions': {name: len(df) for name, df in snapshot.dims.items()},
+            'dimension_caches': {dimension.join.dimension: dimension.rows.stats()
+                                 for dimension in snapshot.dimensions},
+            'verdict_cache': self.verdicts.stats(),
+        }
+
+
+def check_against_batch(service, batch_size=1):
+    """
+    Score every referral of the data directory in micro-batches (one at a
+    time by default) and compare the verdicts, as JSON, with a batch run
+    over the same snapshot
+
+    Returns:
+        (referrals checked, list of mismatching referral ids)
+    """
+    snapshot = service.snapshot
+    referrals = read_table(service.data_dir, FACT_TABLE, use_cache=service.use_cache)
+    batch = build_report(process_referrals(referrals, snapshot.dims, indexes=snapshot.indexes,
+                                           context=snapshot.context))
+    expected = dict(zip(batch['referral_id'], report_records(batch)))
+
+    # Requests carry the file's text, as a client would send it
+    records = pd.read_csv(input_path(service.data_dir, FACT_TABLE), dtype=str,
+                          keep_default_na=False).to_dict('records')
+    mismatches = []
+    for start in range(0, len(records), batch_size):
+        batch = records[start:start + batch_size]
+        for record, scored in zip(batch, service.score_batch(batch)):
+            if json.dumps(scored, default=str) != json.dumps(expected[record['referral_id']],
+                                                             default=str):
+                mismatches.append(record['referral_id'])
+    return len(referrals), mismatches
+
+
+def _response(status, payload):
+    body = json.dumps(payload, default=str).encode()
+    head = (f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n")
+    return head.encode('latin-1') + body
+
+
+async def _route(service, method, path, body):
+    """(status, JSON payload) for one request"""
+    routes = {'/score': 'POST', '/refresh': 'POST', '/health': 'GET'}
+    if path not in routes:
+        return 404, {'error': f'unknown path {path}'}
+    if method != routes[path]:
+        return 405, {'error': f'{path} takes {routes[path]}'}
+
+    if path == '/health':
+        return 200, service.health()
+    if path == '/refresh':
+        changed = await asyncio.get_running_loop().run_in_executor(None, service.refresh)
+        return 200, {'changed': changed}
+
+    try:
+        records = json.loads(body)
+    except ValueError as e:
+        return 400, {'error': f'invalid JSON: {e}'}
+    single = isinstance(records, dict)
+    if single:
+        records = [records]
+    elif not (isinstance(records, list) and records and all(isinstance(r, dict) for r in records)):
+        return 400, {'error': 'expected a referral object or a non-empty list of them'}
+    # A micro-batch takes tens of milliseconds; in a worker thread, other
+    # connections are served meanwhile. Non-scalar values and values that
+    # do not convert are answered with 400 (RecordError).
+    try:
+        scored = await asyncio.get_running_loop().run_in_executor(
+            None, service.score_batch, records)
+    except RecordError as e:
+        return 400, {'error': str(e)}
+    return 200, scored[0] if single else scored
+
+
+async def _handle_connection(service, reader, writer):
+    """Serve HTTP/1.1 requests on one connection until the client closes it"""
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line.strip():
+                break
+            method, path, _ = request_line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while (line := await reader.readline()).strip():
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            length = int(headers.get('content-length') or 0)
+            if length > MAX_BODY_BYTES:
+                writer.write(_response(413, {'error': f'body over {MAX_BODY_BYTES} bytes'}))
+                await writer.drain()
+                break
+            body = await reader.readexactly(length) if length else b''
+
+            try:
+                status, payload = await _route(service, method, path.split('?', 1)[0], body)
+            except Exception as e:
+                status, payload = 500, {'error': f'{type(e).__name__}: {e}'}
+            writer.write(_response(status, payload))
+            await writer.drain()
+            if headers.get('connection', '').lower() == 'close':
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _refresh_periodically(service, seconds):
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(seconds)
+        changed = await loop.run_in_executor(None, service.refresh)
+        if changed:
+            print(f"  ✓ Reloaded after changes to: {', '.join(changed)}")
+
+
+async def serve(service, host=DEFAULT_HOST, port=DEFAULT_PORT, refresh_seconds=None):
+    """
+    Run the asyncio HTTP front end until cancelled
+
+    Scoring and reloads run in worker threads, so the event loop keeps
+    accepting and answering other requests meanwhile.
+
+    Args:
+        service: ScoringService
+        refresh_seconds: check the input files for changes this often (None: only on POST /refresh)
+    """
+    server = await asyncio.start_server(
+        lambda reader, writer: _handle_connection(service, reader, writer), host, port)
+    refresher = (asyncio.create_task(_refresh_periodically(service, refresh_seconds))
+                 if refresh_seconds else None)
+    print(f"  ✓ Scoring service listening on http://{host}:{port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if refresher is not None:
+            refresher.cancel()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serve referral fraud scoring over HTTP from in-memory dimension tables."
+    )
+    parser.add_argument('--data-dir', default='data',
+                        help="directory holding the input CSV files (default: %(default)s)")
+    parser.add_argument('--host', default=DEFAULT_HOST, help="(default: %(default)s)")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="(default: %(default)s)")
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE,
+                        help="verdicts kept for repeated requests (0 disables; default: %(default)s)")
+    parser.add_argument('--dimension-cache-size', type=int, default=DEFAULT_DIMENSION_CACHE_SIZE,
+                        help="joined rows kept per dimension table for single referrals "
+                             "(default: %(default)s)")
+    parser.add_argument('--refresh-seconds', type=float,
+                        help="check the input files for changes this often")
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                        default=CACHE_ENABLED,
+                        help="always parse the CSV files instead of the Arrow table cache")
+    parser.add_argument('--check', action='store_true',
+                        help="score every referral in --data-dir one at a time and in "
+                             "micro-batches, compare with a batch run and exit (no server)")
+    args = parser.parse_args(argv)
+
+    if args.cache_size < 0:
+        parser.error("--cache-size must be 0 or a positive number of verdicts")
+    if args.dimension_cache_size < 0:
+        parser.error("--dimension-cache-size must be 0 or a positive number of rows")
+    if args.refresh_seconds is not None and args.refresh_seconds <= 0:
+        parser.error("--refresh-seconds must be positive")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    started = time.perf_counter()
+    service = ScoringService(args.data_dir, cache_size=args.cache_size, use_cache=args.use_cache,
+                             dimension_cache_size=args.dimension_cache_size)
+    print(f"  ✓ Loaded {len(service.snapshot.referrals)} referrals and "
+          f"{len(service.snapshot.dims)} dimension tables in {time.perf_counter() - started:.3f}s")
+
+    if args.check:
+        failed = False
+        for batch_size, label in ((1, "one at a time"),
+                                  (CHECK_BATCH_SIZE, f"in micro-batches of {CHECK_BATCH_SIZE}")):
+            started = time.perf_counter()
+            checked, mismatches = check_against_batch(service, batch_size)
+            seconds = time.perf_counter() - started
+            print(f"  - Scored {checked} referrals {label} "
+                  f"({1000 * seconds / max(checked, 1):.2f} ms each)")
+            if mismatches:
+                print(f"  ✗ {len(mismatches)} verdicts differ from the batch run: "
+                      f"{mismatches[:10]}")
+                failed = True
+        if failed:
+            return 1
+        print("  ✓ Every verdict matches the batch run")
+        return 0
+
+    try:
+        asyncio.run(serve(service, args.host, args.port, args.refresh_seconds))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
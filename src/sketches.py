@@ -0,0 +1,109 @@
+"""
+Streaming Sketches
+Purpose: Fixed-memory summaries for profiling tables too large to hold in
+         memory: a HyperLogLog distinct-count estimate and a reservoir
+         sample, both fed chunk by chunk and mergeable across chunks
+"""
+
+import numpy as np
+import pandas as pd
+
+# 2**14 one-byte registers (16 KB); standard error about 1.04 / sqrt(2**14) = 0.8%
+HLL_PRECISION = 14
+
+
+def hash_values(values):
+    """64-bit hashes of values (equal values hash equally across chunks and dtypes)"""
+    return pd.util.hash_pandas_object(pd.Series(values), index=False).to_numpy()
+
+
+def _bit_length(x):
+    """Vectorized int.bit_length for a uint64 array"""
+    x = x.copy()
+    length = np.zeros(len(x), dtype=np.uint8)
+    for shift in (32, 16, 8, 4, 2, 1):
+        wide = (x >> np.uint64(shift)) > 0
+        length[wide] += shift
+        x[wide] >>= np.uint64(shift)
+    return length + (x > 0)
+
+
+class HyperLogLog:
+    """
+    Approximate count of distinct values
+
+    Each value's hash picks a register (its first `precision` bits) and
+    the register keeps the longest run of leading zeros seen in the rest.
+    Memory is 2**precision bytes however many values are added.
+    """
+
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def add(self, values):
+        """Add the non-null values of an array or Series"""
+        values = pd.Series(values).dropna()
+        if values.empty:
+            return
+        hashes = hash_values(values)
+        low_bits = 64 - self.precision
+        registers = (hashes >> np.uint64(low_bits)).astype(np.intp)
+        remainder = hashes & np.uint64((1 << low_bits) - 1)
+        ranks = (low_bits + 1 - _bit_length(remainder)).astype(np.uint8)
+        np.maximum.at(self.registers, registers, ranks)
+
+    def merge(self, other):
+        """Combine with a sketch of other values (same precision)"""
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def count(self):
+        """Estimated number of distinct values added"""
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        empty = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and empty:
+            # Linear counting is more accurate while many registers are empty
+            estimate = m * np.log(m / empty)
+        return int(round(estimate))
+
+
+class ReservoirSample:
+    """
+    Uniform random sample of fixed size over everything added (Algorithm R)
+
+    Every value added so far has the same chance of being in the sample.
+    """
+
+    def __init__(self, size, seed=0):
+        self.size = size
+        self.seen = 0
+        self.values = []
+        self._rng = np.random.default_rng(seed)
+
+    def add(self, values):
+        """Add the non-null values of an array or Series"""
+        values = pd.Series(values).dropna()
+        fill = min(self.size - len(self.values), len(values))
+        self.values.extend(values.iloc[:fill].tolist())
+        if len(values) > fill:
+            # Item number i (0-based over everything added) replaces slot j ~ U[0, i] if j < size
+            numbers = self.seen + np.arange(fill, len(values))
+            slots = self._rng.integers(0, numbers + 1)
+            chosen = np.flatnonzero(slots < self.size)
+            for value, slot in zip(values.iloc[fill + chosen].tolist(), slots[chosen]):
+                self.values[slot] = value
+        self.seen += len(values)
+
+    def merge(self, other):
+        """Combine with a sample of other values, weighting each by what it has seen"""
+        pool = self.values + other.values
+        if len(pool) > self.size:
+            weights = np.repeat([self.seen / max(len(self.values), 1),
+                                 other.seen / max(len(other.values), 1)],
+                                [len(self.values), len(other.values)])
+            keep = self._rng.choice(len(pool), self.size, replace=False, p=weights / weights.sum())
+            pool = [pool[i] for i in sorted(keep)]
+        self.values = pool
+        self.seen += other.seen
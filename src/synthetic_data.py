@@ -0,0 +1,315 @@
+"""
+Synthetic Data Generator
+Purpose: Write the seven input tables at any size (10K to 10M referrals and
+         beyond) with the value mix of the sample files in data/ and every
+         key resolving to a row of its dimension table, for benchmarks and
+         load tests
+"""
+
+import argparse
+import binascii
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from schema import TABLE_SCHEMAS, input_path
+
+# Named sizes accepted by --referrals
+SIZES = {'10k': 10_000, '100k': 100_000, '1m': 1_000_000, '10m': 10_000_000}
+
+# Referrals generated and appended to the CSV files per batch; bounds memory
+BATCH_SIZE = 500_000
+
+# Members per referral (the sample has 13 referrers for 47 referrals)
+USERS_PER_REFERRAL = 0.25
+
+# Referrals are spread over the first half of 2024
+PERIOD_START = np.datetime64('2024-01-01T00:00:00', 's')
+PERIOD_SECONDS = 182 * 86400
+DAY = 86400
+
+CLUBS = ['BENHIL', 'BLOK M', 'PLUIT', 'ARTERI PONDOK INDAH', 'ADITYAWARMAN',
+         'GREENVILLE', 'GAJAH MADA', 'MAMPANG', 'SUNSET ROAD']
+CLUB_WEIGHTS = [0.30, 0.15, 0.12, 0.10, 0.10, 0.08, 0.06, 0.05, 0.04]
+CLUB_TIMEZONES = np.array(['Asia/Jakarta'] * 8 + ['Asia/Makassar'])
+
+REFERRAL_SOURCES = ['Draft Transaction', 'Lead', 'User Sign Up']
+REFERRAL_SOURCE_WEIGHTS = [0.59, 0.24, 0.17]
+
+# user_referral_statuses ids: 1 Menunggu, 2 Berhasil, 3 Tidak Berhasil
+STATUS_IDS = [1, 2, 3]
+STATUS_WEIGHTS = [0.63, 0.17, 0.20]
+TRANSACTION_RATE_BY_STATUS = np.array([0.0, 0.65, 0.80, 0.85])
+# Transactions of unsuccessful referrals are often still unpaid
+PAID_RATE_BY_STATUS = np.array([0.0, 0.30, 0.95, 0.30])
+REWARD_RATE_BY_STATUS = np.array([0.0, 0.05, 0.90, 0.10])
+
+LEAD_STATUSES = ['Fresh', 'Warm', 'Deal', 'Maybe', 'Appointment']
+
+# Share of rows that break a business rule or carry a missing value
+MISSING_REFERRER_RATE = 0.28
+MISSING_REFEREE_RATE = 0.07
+TRANSACTION_BEFORE_REFERRAL_RATE = 0.03
+DELETED_USER_RATE = 0.03
+REWARD_NOT_GRANTED_RATE = 0.05
+
+# The lookup tables are fixed; copied from the sample files
+STATUS_ROWS = {
+    'id': [1, 3, 2],
+    'description': ['Menunggu', 'Tidak Berhasil', 'Berhasil'],
+    'created_at': ['2024-03-08T08:49:37Z', '2024-03-08T10:07:10Z', '2024-03-08T10:07:10Z'],
+}
+REWARD_ROWS = {
+    'id': [1, 3, 2],
+    'reward_value': ['10 days', '15 days', '20 days'],
+    'created_at': ['2024-03-13T02:44:32Z', '2024-03-13T02:45:15Z', '2024-03-13T02:45:11Z'],
+    'reward_type': [1, 1, 1],
+}
+REWARD_IDS = [1, 2, 3]
+REWARD_WEIGHTS = [0.6, 0.3, 0.1]
+
+
+def hex_ids(rng, n):
+    """n random 32-character hex identifiers (as a fixed-width bytes array)"""
+    return np.frombuffer(binascii.hexlify(rng.bytes(16 * n)), dtype='S32')
+
+
+def format_timestamps(seconds, milliseconds=None):
+    """ISO 8601 UTC strings ('...Z') for offsets in seconds from PERIOD_START"""
+    times = PERIOD_START + seconds.astype('timedelta64[s]')
+    if milliseconds is None:
+        return np.char.add(np.datetime_as_string(times, unit='s'), 'Z')
+    times = times.astype('datetime64[ms]') + milliseconds.astype('timedelta64[ms]')
+    return np.char.add(np.datetime_as_string(times, unit='ms'), 'Z')
+
+
+def with_nulls(values, missing):
+    """Series of values with the masked positions missing (written as 'null')"""
+    return pd.Series(values).mask(missing)
+
+
+def generate_user_logs(rng, user_ids, first_row_id):
+    """
+    user_logs rows for a slice of members, with repeated profile snapshots
+
+    Returns:
+        DataFrame in the user_logs column order
+    """
+    n = len(user_ids)
+    snapshots = 1 + rng.poisson(0.5, n)
+    club = rng.choice(len(CLUBS), n, p=CLUB_WEIGHTS)
+    expiry = pd.DatetimeIndex(
+        PERIOD_START.astype('datetime64[D]') + rng.integers(-60, 600, n).astype('timedelta64[D]')
+    )
+    expiry_text = (expiry.month.astype(str) + '/' + expiry.day.astype(str)
+                   + '/' + expiry.year.astype(str))
+    users = pd.DataFrame({
+        'user_id': user_ids.astype(str),
+        'name': hex_ids(rng, n).astype(str),
+        'phone_number': hex_ids(rng, n).astype(str),
+        'homeclub': np.array(CLUBS)[club],
+        'timezone_homeclub': CLUB_TIMEZONES[club],
+        'membership_expired_date': np.asarray(expiry_text),
+        'is_deleted': np.where(rng.random(n) < DELETED_USER_RATE, 'TRUE', 'FALSE'),
+    })
+    users = users.iloc[np.repeat(np.arange(n), snapshots)].reset_index(drop=True)
+    users.insert(0, 'id', np.arange(first_row_id, first_row_id + len(users)))
+    return users
+
+
+def generate_referral_batch(rng, n, user_ids, referrer_weights, row_ids):
+    """
+    One batch of referrals with the transaction, referral log and lead rows
+    they point to
+
+    Args:
+        rng: numpy Generator
+        n: referrals in the batch
+        user_ids: every member id (referrers are drawn from these)
+        referrer_weights: probability of each member being the referrer
+        row_ids: dict of the next 'id' value per table; advanced in place
+
+    Returns:
+        dict of DataFrames keyed by TABLE_SCHEMAS name
+    """
+    referral_at = rng.integers(0, PERIOD_SECONDS, n)
+    # Many referrals are updated within seconds (sign ups), the rest over days
+    quick_update = rng.random(n) < 0.4
+    updated_at = referral_at + np.where(
+        quick_update, rng.integers(0, 60, n), rng.exponential(3 * DAY, n).astype(np.int64)
+    )
+
+    source = rng.choice(len(REFERRAL_SOURCES), n, p=REFERRAL_SOURCE_WEIGHTS)
+    is_lead = source == REFERRAL_SOURCES.index('Lead')
+    status = rng.choice(STATUS_IDS, n, p=STATUS_WEIGHTS)
+
+    referral_ids = hex_ids(rng, n)
+    referee_ids = hex_ids(rng, n)
+    referee_missing = ~is_lead & (rng.random(n) < MISSING_REFEREE_RATE)
+    referrer_missing = rng.random(n) < MISSING_REFERRER_RATE
+    referrers = user_ids[rng.choice(len(user_ids), n, p=referrer_weights)]
+
+    has_transaction = rng.random(n) < TRANSACTION_RATE_BY_STATUS[status]
+    has_reward = rng.random(n) < REWARD_RATE_BY_STATUS[status]
+    reward_ids = rng.choice(REWARD_IDS, n, p=REWARD_WEIGHTS).astype(float)
+    transaction_ids = hex_ids(rng, n)
+
+    user_referrals = pd.DataFrame({
+        'referral_at': format_timestamps(referral_at),
+        'referral_id': referral_ids.astype(str),
+        'referee_id': with_nulls(referee_ids.astype(str), referee_missing),
+        'referee_name': with_nulls(hex_ids(rng, n).astype(str), referee_missing),
+        'referee_phone': hex_ids(rng, n).astype(str),
+        'referral_reward_id': with_nulls(reward_ids, ~has_reward).astype('Int64'),
+        'referral_source': np.array(REFERRAL_SOURCES)[source],
+        'referrer_id': with_nulls(referrers.astype(str), referrer_missing),
+        'transaction_id': with_nulls(transaction_ids.astype(str), ~has_transaction),
+        'updated_at': format_timestamps(updated_at),
+        'user_referral_status_id': status,
+    })
+
+    # One transaction row per referral that has one, usually after the referral
+    linked = np.flatnonzero(has_transaction)
+    k = len(linked)
+    is_paid = rng.random(k) < PAID_RATE_BY_STATUS[status[linked]]
+    early = rng.random(k) < TRANSACTION_BEFORE_REFERRAL_RATE
+    offset = rng.exponential(2 * DAY, k).astype(np.int64)
+    transaction_at = referral_at[linked] + np.where(early, -offset - 60, offset)
+    club = rng.choice(len(CLUBS), k, p=CLUB_WEIGHTS)
+    paid_transactions = pd.DataFrame({
+        'transaction_id': transaction_ids[linked].astype(str),
+        'transaction_status': np.where(is_paid, 'PAID', 'PENDING'),
+        'transaction_at': format_timestamps(transaction_at, rng.integers(0, 1000, k)),
+        'transaction_location': np.array(CLUBS)[club],
+        'timezone_transaction': CLUB_TIMEZONES[club],
+        'transaction_type': np.where(rng.random(k) < 0.93, 'NEW', 'REJOIN'),
+    })
+
+    # Referral logs: one or more entries between referral_at and updated_at;
+    # the last one records whether the reward was granted
+    entries = 1 + rng.poisson(0.8, n)
+    owner = np.repeat(np.arange(n), entries)
+    position = np.arange(len(owner)) - np.repeat(np.cumsum(entries) - entries, entries)
+    is_last = position == entries[owner] - 1
+    span = updated_at - referral_at
+    granted = (is_last & has_reward[owner] & (status[owner] == 2)
+               & (rng.random(len(owner)) >= REWARD_NOT_GRANTED_RATE))
+    user_referral_logs = pd.DataFrame({
+        'id': np.arange(row_ids['user_referral_logs'], row_ids['user_referral_logs'] + len(owner)),
+        'user_referral_id': referral_ids[owner].astype(str),
+        'source_transaction_id': with_nulls(transaction_ids[owner].astype(str),
+                                            ~(granted & has_transaction[owner])),
+        'created_at': format_timestamps(referral_at[owner] + span[owner] * (position + 1) // entries[owner]),
+        'is_reward_granted': np.where(granted, 'TRUE', 'FALSE'),
+    })
+    row_ids['user_referral_logs'] += len(owner)
+
+    # Lead referees come from lead_log; a lead can have several status entries
+    leads = np.flatnonzero(is_lead)
+    lead_entries = 1 + rng.poisson(0.3, len(leads))
+    lead_owner = np.repeat(leads, lead_entries)
+    m = len(lead_owner)
+    lead_created = referral_at[lead_owner] - rng.exponential(7 * DAY, m).astype(np.int64)
+    club = rng.choice(len(CLUBS), m, p=CLUB_WEIGHTS)
+    lead_logs = pd.DataFrame({
+        'id': np.arange(row_ids['lead_logs'], row_ids['lead_logs'] + m),
+        'lead_id': referee_ids[lead_owner].astype(str),
+        'source_category': np.where(rng.random(m) < 0.75, 'Online', 'Offline'),
+        'created_at': format_timestamps(lead_created, rng.integers(0, 1000, m)),
+        'preferred_location': np.array(CLUBS)[club],
+        'timezone_location': CLUB_TIMEZONES[club],
+        'current_status': rng.choice(LEAD_STATUSES, m),
+    })
+    row_ids['lead_logs'] += m
+
+    return {
+        'lead_logs': lead_logs,
+        'user_referrals': user_referrals,
+        'user_referral_logs': user_referral_logs,
+        'paid_transactions': paid_transactions,
+    }
+
+
+def write_table(df, data_dir, table_name, append):
+    """Write (or append) rows in the column order of the input files"""
+    df[list(TABLE_SCHEMAS[table_name].columns)].to_csv(
+        input_path(data_dir, table_name), index=False, na_rep='null',
+        mode='a' if append else 'w', header=not append
+    )
+
+
+def generate_dataset(data_dir, n_referrals, seed=0, batch_size=BATCH_SIZE):
+    """
+    Write a full synthetic input dataset
+
+    Every non-null referrer_id is a user_logs user_id, every Lead referee_id
+    is a lead_log lead_id, every transaction_id is in paid_transactions,
+    every referral log points at a referral and every reward/status id is in
+    its lookup table. Rows are generated and appended in batches, so memory
+    stays bounded for 10M+ referrals.
+
+    Args:
+        data_dir: directory to write the seven CSV files to
+        n_referrals: number of user_referrals rows
+        seed: random seed (same seed and size give the same files)
+        batch_size: referrals generated per batch
+
+    Returns:
+        dict of rows written per table
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    rows = dict.fromkeys(TABLE_SCHEMAS, 0)
+
+    write_table(pd.DataFrame(STATUS_ROWS), data_dir, 'user_referral_statuses', append=False)
+    write_table(pd.DataFrame(REWARD_ROWS), data_dir, 'referral_rewards', append=False)
+    rows['user_referral_statuses'] = len(STATUS_ROWS['id'])
+    rows['referral_rewards'] = len(REWARD_ROWS['id'])
+
+    # Members, with a long-tailed share of the referrals each
+    n_users = max(1, int(n_referrals * USERS_PER_REFERRAL))
+    user_ids = hex_ids(rng, n_users)
+    referrer_weights = rng.lognormal(0.0, 1.0, n_users)
+    referrer_weights /= referrer_weights.sum()
+
+    for start in range(0, n_users, batch_size):
+        users = generate_user_logs(rng, user_ids[start:start + batch_size], rows['user_logs'] + 1)
+        write_table(users, data_dir, 'user_logs', append=start > 0)
+        rows['user_logs'] += len(users)
+
+    row_ids = {'user_referral_logs': 1, 'lead_logs': 1}
+    for start in range(0, max(n_referrals, 1), batch_size):
+        n = min(batch_size, n_referrals - start)
+        batch = generate_referral_batch(rng, n, user_ids, referrer_weights, row_ids)
+        for table_name, df in batch.items():
+            write_table(df, data_dir, table_name, append=start > 0)
+            rows[table_name] += len(df)
+
+    return rows
+
+
+def parse_size(value):
+    """Number of referrals from '10k', '1m', '10m' or a plain integer"""
+    if value.lower() in SIZES:
+        return SIZES[value.lower()]
+    return int(value.replace('_', ''))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic referral input tables.")
+    parser.add_argument('--referrals', type=parse_size, default='10k',
+                        help=f"number of referrals: an integer or one of {', '.join(SIZES)} "
+                             "(default: %(default)s)")
+    parser.add_argument('--out-dir', default=os.path.join('output', 'synthetic_data'),
+                        help="directory for the generated CSV files (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0, help="random seed (default: %(default)s)")
+    args = parser.parse_args()
+
+    print(f"Generating {args.referrals} referrals into {args.out_dir}...")
+    started = time.perf_counter()
+    written = generate_dataset(args.out_dir, args.referrals, args.seed)
+    for table_name, count in written.items():
+        print(f"  - {table_name}: {count} rows")
+    print(f"  ✓ Done in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,280 @@
+"""
+Columnar Table Cache
+Purpose: Convert each input CSV to an Arrow IPC file the first time it is
+         read, then memory-map that file on later runs so unchanged inputs
+         skip CSV parsing entirely
+"""
+
+import hashlib
+import json
+import os
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from schema import TABLE_SCHEMAS, input_path, read_csv_table
+
+try:
+    import pyarrow as pa
+    from pyarrow import feather
+except ImportError:  # the cache is an optimization; CSV loading still works without it
+    pa = None
+
+# Set REFERRAL_TABLE_CACHE=0 to always parse the CSV files
+CACHE_ENABLED = os.environ.get('REFERRAL_TABLE_CACHE', '1') != '0'
+CACHE_DIR_NAME = '.table_cache'
+
+# Bump when the on-disk layout changes so old entries are rebuilt
+CACHE_FORMAT_VERSION = 1
+
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def default_cache_dir(data_dir):
+    """Cache location used when none is given: a hidden folder inside data_dir"""
+    return os.path.join(data_dir, CACHE_DIR_NAME)
+
+
+def file_content_hash(path):
+    """BLAKE2b digest of a file, read in 1 MB blocks"""
+    return file_hashes(path)[0]
+
+
+def file_hashes(path, prefix_size=None):
+    """
+    BLAKE2b digest of a file and, in the same read, of its first prefix_size bytes
+
+    Returns:
+        (file digest, prefix digest or None, whether the prefix ends a line)
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    prefix_digest, prefix_ends_line = None, False
+    remaining = prefix_size
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            if remaining is not None and remaining <= len(block):
+                digest.update(block[:remaining])
+                prefix_digest = digest.hexdigest()
+                prefix_ends_line = remaining > 0 and block[remaining - 1:remaining] == b'\n'
+                digest.update(block[remaining:])
+                remaining = None
+            else:
+                digest.update(block)
+                if remaining is not None:
+                    remaining -= len(block)
+    return digest.hexdigest(), prefix_digest, prefix_ends_line
+
+
+def source_change(source, manifest, append_only=False):
+    """
+    How a file differs from the size, mtime_ns and content_hash in a manifest
+
+    Args:
+        source: path of the file
+        manifest: dict recorded when the file was last read
+        append_only: the file only ever grows (see TableSchema.append_only)
+
+    Returns:
+        (change, content_hash): change is 'same', 'appended' (the file still
+        starts with the recorded content, and the new rows begin at byte
+        manifest['size']) or 'changed'; content_hash is the file's hash now
+    """
+    stat = os.stat(source)
+    if manifest['size'] == stat.st_size and manifest['mtime_ns'] == stat.st_mtime_ns:
+        return 'same', manifest['content_hash']
+
+    appendable = append_only and stat.st_size > manifest['size']
+    content_hash, prefix_hash, prefix_ends_line = file_hashes(
+        source, manifest['size'] if appendable else None
+    )
+    if manifest['size'] == stat.st_size and manifest['content_hash'] == content_hash:
+        return 'same', content_hash
+    if appendable and prefix_ends_line and prefix_hash == manifest['content_hash']:
+        return 'appended', content_hash
+    return 'changed', content_hash
+
+
+def schema_fingerprint(table_name):
+    """Changes whenever the declared types (or the pandas major version) change"""
+    declared = repr(TABLE_SCHEMAS[table_name]) + pd.__version__.split('.')[0]
+    declared += str(CACHE_FORMAT_VERSION)
+    return hashlib.blake2b(declared.encode(), digest_size=8).hexdigest()
+
+
+def _entry_paths(cache_dir, table_name):
+    base = os.path.join(cache_dir, table_name)
+    return base + '.arrow', base + '.json'
+
+
+def _load_manifest(manifest_path):
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(manifest_path, manifest):
+    tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def lookup(data_dir, table_name, cache_dir=None):
+    """
+    Find a valid cache entry for a table
+
+    The entry is valid when it was built from a file with the same path,
+    size and mtime, or (if size or mtime changed) the same content hash, and
+    with the current schema. A touched-but-identical file refreshes the
+    manifest instead of rebuilding the entry.
+
+    Returns:
+        Path of the Arrow file, or None when the table must be (re)built
+    """
+    cache_dir = cache_dir or default_cache_dir(data_dir)
+    source = os.path.abspath(input_path(data_dir, table_name))
+    arrow_path, manifest_path = _entry_paths(cache_dir, table_name)
+
+    manifest = _load_manifest(manifest_path)
+    if (manifest is None or not os.path.exists(arrow_path)
+            or manifest.get('source') != source
+            or manifest.get('schema') != schema_fingerprint(table_name)):
+        return None
+
+    stat = os.stat(source)
+    if manifest['size'] == stat.st_size and manifest['mtime_ns'] == stat.st_mtime_ns:
+        return arrow_path
+
+    if manifest['size'] == stat.st_size and manifest['content_hash'] == file_content_hash(source):
+        manifest['mtime_ns'] = stat.st_mtime_ns
+        _write_manifest(manifest_path, manifest)
+        return arrow_path
+
+    return None
+
+
+def build(data_dir, table_name, df, cache_dir=None):
+    """
+    Store a freshly parsed table as an uncompressed Arrow IPC file
+
+    Uncompressed IPC can be memory-mapped and read without copying.
+
+    Args:
+        data_dir: directory holding the input CSV files
+        table_name: key in TABLE_SCHEMAS
+        df: the typed DataFrame parsed from that CSV
+        cache_dir: cache location (default: data_dir/.table_cache)
+    """
+    cache_dir = cache_dir or default_cache_dir(data_dir)
+    source = os.path.abspath(input_path(data_dir, table_name))
+    arrow_path, manifest_path = _entry_paths(cache_dir, table_name)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    stat = os.stat(source)
+    # Per-process temporary name: parallel profiling tasks may build the same entry
+    tmp_path = f'{arrow_path}.{os.getpid()}.tmp'
+    feather.write_feather(df, tmp_path, compression='uncompressed')
+    os.replace(tmp_path, arrow_path)
+
+    _write_manifest(manifest_path, {
+        'source': source,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'content_hash': file_content_hash(source),
+        'schema': schema_fingerprint(table_name),
+    })
+
+
+def _read_cached(arrow_path, columns=None, chunksize=None):
+    table = feather.read_table(arrow_path, columns=columns, memory_map=True)
+    if chunksize is None:
+        return table.to_pandas()
+    return (
+        table.slice(offset, chunksize).to_pandas()
+        for offset in range(0, table.num_rows, chunksize)
+    )
+
+
+def read_table(data_dir, table_name, columns=None, chunksize=None, cache_dir=None,
+               engine=None, use_cache=CACHE_ENABLED):
+    """
+    Load an input table with its declared types, through the columnar cache
+
+    Args:
+        data_dir: directory holding the input CSV files
+        table_name: key in TABLE_SCHEMAS
+        columns: optional subset of columns to read
+        chunksize: if set, return an iterator of typed chunks instead
+        cache_dir: cache location (default: data_dir/.table_cache)
+        engine: CSV parser for whole-table reads (see schema.read_csv_table)
+        use_cache: False to always parse the CSV
+
+    Returns:
+        Typed DataFrame, or an iterator of typed DataFrames
+    """
+    if not use_cache or pa is None:
+        return read_csv_table(data_dir, table_name, columns, chunksize, engine)
+
+    arrow_path = lookup(data_dir, table_name, cache_dir)
+    if arrow_path is not None:
+        return _read_cached(arrow_path, columns, chunksize)
+
+    if chunksize is not None:
+        # Building the entry would need the whole table in memory; stream the
+        # CSV instead and leave the cache to the next full read
+        return read_csv_table(data_dir, table_name, columns, chunksize)
+
+    df = read_csv_table(data_dir, table_name, engine=engine)
+    try:
+        build(data_dir, table_name, df, cache_dir)
+    except OSError as e:
+        warnings.warn(f"Could not write table cache for {table_name}: {e}")
+
+    return df if columns is None else df[list(columns)]
+
+
+def _timed_read(data_dir, table_name, **read_options):
+    started = time.perf_counter()
+    df = read_table(data_dir, table_name, **read_options)
+    return df, time.perf_counter() - started
+
+
+def read_tables(data_dir, table_names, max_workers=None, columns=None, **read_options):
+    """
+    Load several input tables concurrently
+
+    Each table is read by read_table in a thread pool. Both the pyarrow CSV
+    parser and Arrow IPC reads release the GIL, so the tables load in
+    parallel rather than one after another.
+
+    Args:
+        data_dir: directory holding the input CSV files
+        table_names: keys in TABLE_SCHEMAS to load
+        max_workers: thread count (default: one per table, capped at the CPU count)
+        columns: optional dict of table name -> columns to read (tables not
+                 in it are read whole)
+        **read_options: cache_dir, engine and use_cache, passed to read_table
+
+    Returns:
+        (tables, load_seconds): dicts keyed by table name, in table_names order
+    """
+    table_names = list(table_names)
+    columns = columns or {}
+    if max_workers is None:
+        max_workers = min(len(table_names), os.cpu_count() or 1) or 1
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            name: pool.submit(_timed_read, data_dir, name, columns=columns.get(name),
+                              **read_options)
+            for name in table_names
+        }
+        results = {name: future.result() for name, future in futures.items()}
+
+    tables = {name: df for name, (df, _) in results.items()}
+    load_seconds = {name: seconds for name, (_, seconds) in results.items()}
+    return tables, load_seconds
@@ -0,0 +1,137 @@
+"""
+Table Profiler
+Purpose: Column statistics (type, nulls, distinct count, sample values)
+         accumulated chunk by chunk, exactly or with fixed-memory sketches,
+         and mergeable across row batches and column groups
+"""
+
+import numpy as np
+import pandas as pd
+
+from sketches import HyperLogLog, ReservoirSample
+
+# Sample values shown per column
+SAMPLE_COUNT = 3
+
+# Values kept per column by the approximate profiler's reservoir sample
+SAMPLE_RESERVOIR_SIZE = 64
+
+
+class ColumnProfiler:
+    """
+    Statistics of one column, updated chunk by chunk
+
+    Each chunk is factorized once, which yields the null count, the
+    distinct values and their first-seen order in a single scan. The exact
+    profiler keeps every distinct value; the approximate one keeps a
+    HyperLogLog sketch and a reservoir sample instead, so its memory does
+    not grow with the number of rows or distinct values.
+    """
+
+    def __init__(self, approximate=False, seed=0):
+        self.approximate = approximate
+        self.data_type = None
+        self.null_count = 0
+        if approximate:
+            self.distinct = HyperLogLog()
+            self.sample = ReservoirSample(SAMPLE_RESERVOIR_SIZE, seed)
+        else:
+            self.values = None
+
+    def update(self, series):
+        if self.data_type is None:
+            self.data_type = str(series.dtype)
+        codes, uniques = pd.factorize(series)
+        self.null_count += int(np.count_nonzero(codes < 0))
+        if self.approximate:
+            self.distinct.add(uniques)
+            self.sample.add(uniques)
+        else:
+            self._add_values(uniques)
+
+    def _add_values(self, uniques):
+        if self.values is None:
+            self.values = uniques
+        else:
+            self.values = self.values.append(uniques).unique()
+
+    def merge(self, other):
+        """Add the statistics of rows that follow the ones profiled so far"""
+        if self.data_type is None:
+            self.data_type = other.data_type
+        self.null_count += other.null_count
+        if self.approximate:
+            self.distinct.merge(other.distinct)
+            self.sample.merge(other.sample)
+        elif other.values is not None:
+            self._add_values(other.values)
+
+    def distinct_count(self):
+        if self.approximate:
+            return self.distinct.count()
+        return len(self.values) if self.values is not None else 0
+
+    def sample_values(self):
+        """The first SAMPLE_COUNT distinct values (distinct sampled values if approximate)"""
+        if self.approximate:
+            return list(dict.fromkeys(self.sample.values))[:SAMPLE_COUNT]
+        return list(self.values[:SAMPLE_COUNT]) if self.values is not None else []
+
+
+class TableProfiler:
+    """
+    Profile of one table built from one DataFrame or a stream of chunks
+
+    Usage:
+        profiler = TableProfiler('user_referrals', approximate=True)
+        for chunk in read_table(data_dir, 'user_referrals', chunksize=1_000_000):
+            profiler.update(chunk)
+        profile_df = profiler.to_frame()
+    """
+
+    def __init__(self, table_name, approximate=False, seed=0):
+        self.table_name = table_name
+        self.approximate = approximate
+        self.seed = seed
+        self.total_rows = 0
+        self.columns = {}
+
+    def update(self, df):
+        self.total_rows += len(df)
+        for column in df.columns:
+            if column not in self.columns:
+                self.columns[column] = ColumnProfiler(self.approximate, self.seed)
+            self.columns[column].update(df[column])
+
+    def merge_rows(self, other):
+        """Add a profile of rows appended after the ones profiled so far"""
+        self.total_rows += other.total_rows
+        for column, stats in other.columns.items():
+            if column in self.columns:
+                self.columns[column].merge(stats)
+            else:
+                self.columns[column] = stats
+
+    def merge_columns(self, other):
+        """Add a profile of other columns of the same rows"""
+        if self.columns and other.columns and self.total_rows != other.total_rows:
+            raise ValueError(f"{self.table_name}: column groups cover {self.total_rows} "
+                             f"and {other.total_rows} rows")
+        self.total_rows = other.total_rows
+        self.columns.update(other.columns)
+
+    def to_frame(self):
+        profile_data = []
+        for column, stats in self.columns.items():
+            null_percentage = (np.int64(stats.null_count) / self.total_rows) * 100
+            profile_data.append({
+                'Table Name': self.table_name,
+                'Column Name': column,
+                'Data Type': stats.data_type,
+                'Total Rows': self.total_rows,
+                'Null Count': stats.null_count,
+                'Null Percentage': round(null_percentage, 2),
+                'Distinct Count': stats.distinct_count(),
+                'Sample Values': ', '.join([str(v) for v in stats.sample_values()])
+            })
+        return pd.DataFrame(profile_data)
@@ -0,0 +1,170 @@
+"""
+Timestamp Conversion Engine
+Purpose: Convert whole columns of UTC timestamps to naive local datetimes,
+         parsing each column once and converting one timezone group at a time
+         (and single timestamps, for scoring one referral)
+"""
+
+import re
+
+import numpy as np
+import pandas as pd
+import pytz
+
+# Timezone used when a referral has no usable timezone of its own
+DEFAULT_TIMEZONE = 'Asia/Jakarta'
+
+# Plain ISO 8601 text, which pd.Timestamp reads as the ISO8601 format does
+# (several times faster for one value)
+ISO_TIMESTAMP = re.compile(r'\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d{1,9})?)?)?'
+                           r'(Z|[+-]\d{2}:?\d{2})?')
+
+
+def parse_utc_timestamps(values):
+    """
+    Parse a column of timestamps into a timezone-aware UTC series
+
+    Strings are parsed in one vectorized ISO 8601 pass. Any value that pass
+    cannot read is retried with the per-value parser (once per distinct
+    string), so mixed or unusual formats resolve exactly as they did when
+    every row was parsed on its own. Unparseable values become NaT.
+
+    Args:
+        values: Series of timestamp strings or datetimes
+
+    Returns:
+        Series of datetime64 values in UTC, aligned to the input index
+    """
+    values = pd.Series(values)
+
+    if isinstance(values.dtype, pd.DatetimeTZDtype):
+        return values.dt.tz_convert('UTC')
+    if pd.api.types.is_datetime64_dtype(values.dtype):
+        return values.dt.tz_localize('UTC')
+
+    parsed = pd.to_datetime(values, utc=True, errors='coerce', format='ISO8601')
+
+    retry = parsed.isna() & values.notna()
+    if retry.any():
+        fallback = {}
+        for value in values[retry].unique():
+            try:
+                fallback[value] = pd.to_datetime(value, utc=True)
+            except Exception:
+                fallback[value] = pd.NaT
+        parsed = parsed.astype(object)
+        parsed[retry] = values[retry].map(fallback)
+        parsed = pd.to_datetime(parsed, utc=True)
+
+    return parsed
+
+
+def parse_utc_timestamp(value):
+    """
+    Parse one timestamp as parse_utc_timestamps parses a column's values
+
+    Args:
+        value: timestamp string, datetime or missing value
+
+    Returns:
+        Timezone-aware UTC Timestamp, or NaT
+    """
+    if isinstance(value, pd.Timestamp):
+        return value.tz_convert('UTC') if value.tzinfo is not None else value.tz_localize('UTC')
+    if value is None or pd.isna(value):
+        return pd.NaT
+    if isinstance(value, str) and ISO_TIMESTAMP.fullmatch(value):
+        try:
+            return parse_utc_timestamp(pd.Timestamp(value))
+        except ValueError:
+            pass
+    parsed = pd.to_datetime(value, utc=True, errors='coerce', format='ISO8601')
+    if parsed is pd.NaT:
+        try:
+            parsed = pd.to_datetime(value, utc=True)
+        except Exception:
+            parsed = pd.NaT
+    return parsed
+
+
+def coalesce_timezones(*candidates):
+    """
+    Resolve a per-row timezone from an ordered fallback chain
+
+    Each candidate is either a Series of timezone names or a single name used
+    as a constant. For every row the first non-null candidate wins, e.g.
+    coalesce_timezones(df['referrer_timezone'], df['timezone_location'], DEFAULT_TIMEZONE).
+
+    Args:
+        *candidates: Series or scalar timezone names, highest priority first
+
+    Returns:
+        Series of timezone names (null where every candidate is null)
+    """
+    index = next(c.index for c in candidates if isinstance(c, pd.Series))
+    resolved = pd.Series(np.nan, index=index, dtype=object)
+
+    for candidate in candidates:
+        resolved = resolved.where(resolved.notna(), candidate)
+
+    return resolved
+
+
+def convert_utc_to_local(utc_times, timezones):
+    """
+    Convert UTC timestamps to naive local datetimes, one timezone group at a time
+
+    The timestamp column is parsed once, rows are grouped by timezone name,
+    and each group is converted with a single tz_convert. Rows with a missing
+    timestamp, a missing timezone or an unknown timezone name come back as NaT.
+
+    Args:
+        utc_times: Series of UTC timestamp strings or datetimes
+        timezones: Series of timezone names aligned with utc_times, or one name
+
+    Returns:
+        Series of naive datetime64 values in each row's local time
+    """
+    utc = parse_utc_timestamps(utc_times)
+    if not isinstance(timezones, pd.Series):
+        timezones = pd.Series(timezones, index=utc.index, dtype=object)
+
+    local = np.full(len(utc), np.datetime64('NaT'), dtype=f'datetime64[{utc.dt.unit}]')
+
+    convertible = (utc.notna() & timezones.notna()).to_numpy()
+    codes, zone_names = pd.factorize(timezones[convertible])
+    # One stable sort puts each zone's rows together, in row order
+    order = np.argsort(codes, kind='stable')
+    groups = np.split(np.flatnonzero(convertible)[order],
+                      np.searchsorted(codes[order], np.arange(1, len(zone_names))))
+
+    for zone_name, group in zip(zone_names, groups):
+        try:
+            zone = pytz.timezone(zone_name)
+        except Exception:
+            continue
+        converted = utc.iloc[group].dt.tz_convert(zone).dt.tz_localize(None)
+        local[group] = converted.to_numpy()
+
+    return pd.Series(local, index=utc.index)
+
+
+def utc_to_local(timestamp, timezone):
+    """
+    Convert one UTC Timestamp to naive local time, as convert_utc_to_local does
+
+    Args:
+        timestamp: timezone-aware Timestamp (or a missing value)
+        timezone: timezone name (or a missing value)
+
+    Returns:
+        Naive Timestamp, or NaT for a missing timestamp or a missing or
+        unknown timezone
+    """
+    if pd.isna(timestamp) or pd.isna(timezone):
+        return pd.NaT
+    try:
+        zone = pytz.timezone(timezone)
+    except Exception:
+        return pd.NaT
+    return timestamp.tz_convert(zone).tz_localize(None)
@@ -0,0 +1,556 @@
+"""
+Referral Velocity Features
+Purpose: Rolling per-referrer counts over time windows (referrals, rewarded
+         referrals and reward days in the last hour, day and month) and
+         per-location referral counts (last hour and day), from one sort of
+         the referral history and binary searches into it
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+# Window name -> length; a referral's window is (referral_at - length, referral_at]
+VELOCITY_WINDOWS = {
+    '1h': pd.Timedelta(hours=1),
+    '24h': pd.Timedelta(hours=24),
+    '30d': pd.Timedelta(days=30),
+}
+
+# Windows also counted per transaction location (referrals only). They are
+# short, as every referral at a busy club falls in the same location windows.
+LOCATION_WINDOWS = {window: VELOCITY_WINDOWS[window] for window in ('1h', '24h')}
+
+# Columns a history is built from (user_referrals joined with the reward
+# days and the transaction location)
+HISTORY_COLUMNS = ['referrer_id', 'referral_at', 'num_reward_days', 'transaction_location']
+
+# One history row as SpilledReferrerHistory writes it to disk: the run it
+# is sorted into (key, then time bucket), its time and its reward days
+SPILL_RECORD = np.dtype([('key', np.int64), ('bucket', np.int64), ('time', np.int64),
+                         ('reward_days', np.float64)])
+
+# Time bucket of the spilled location runs
+LOCATION_BUCKET = pd.Timedelta(days=1)
+
+
+def velocity_columns():
+    """Names of the feature columns, in the order they are added"""
+    return ([f'referrer_{measure}_{window}' for window in VELOCITY_WINDOWS
+             for measure in ('referrals', 'rewarded', 'reward_days')]
+            + [f'location_referrals_{window}' for window in LOCATION_WINDOWS])
+
+
+def _nanoseconds(timestamps):
+    """Timestamps as int64 nanoseconds since the epoch (missing values are undefined)"""
+    return timestamps.dt.as_unit('ns').array.asi8
+
+
+def _plain(values):
+    """Categorical keys as their categories' type, so they compare by value"""
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.astype(values.cat.categories.dtype)
+    return values
+
+
+def _search(haystack, needles, order, side='left'):
+    """np.searchsorted with the needles visited in ascending order (cache-friendly)"""
+    positions = np.empty(len(needles), dtype=np.intp)
+    positions[order] = np.searchsorted(haystack, needles[order], side=side)
+    return positions
+
+
+def _search_runs(haystack, first, last, needles):
+    """
+    Per row, the first position in haystack[first:last] (ascending) holding
+    a value above the row's needle (last if there is none), found with one
+    vectorized binary search over every row's own run
+    """
+    low, high = first.copy(), last.copy()
+    pending = np.flatnonzero(low < high)
+    while len(pending):
+        middle = (low[pending] + high[pending]) // 2
+        above = haystack[middle] > needles[pending]
+        high[pending[above]] = middle[above]
+        low[pending[~above]] = middle[~above] + 1
+        pending = pending[low[pending] < high[pending]]
+    return low
+
+
+def _counts(known, end, starts, prefix):
+    """Referral counts of windows from history positions (missing where not known)"""
+    return {f'{prefix}_referrals_{window}': pd.arrays.IntegerArray(
+                (end - start).astype(np.int64), ~known)
+            for window, start in starts.items()}
+
+
+def _window_features(known, end, starts, rewarded, reward_days):
+    """
+    Referrer feature columns from history positions: each row's window is
+    the history rows from starts[window] up to (not including) end
+
+    Args:
+        known: rows with a referrer and a referral time (others get missing values)
+        rewarded, reward_days: prefix sums over the history rows
+    """
+    features = {}
+    for window, start in starts.items():
+        counts = {
+            'referrals': end - start,
+            'rewarded': rewarded[end] - rewarded[start],
+            'reward_days': reward_days[end] - reward_days[start],
+        }
+        for measure, values in counts.items():
+            if measure == 'reward_days':
+                values = np.where(known, values, np.nan)
+            else:
+                values = pd.arrays.IntegerArray(values.astype(np.int64), ~known)
+            features[f'referrer_{measure}_{window}'] = values
+    return features
+
+
+class _KeyedTimes:
+    """
+    History rows sorted once by (key, time), for window lookups per key
+
+    Each sorted row gets the key key_code * stride + time_rank, where
+    time_rank is the row's position among all the rows' times. All of one
+    key's rows in a time range are then one contiguous run of keys, found
+    with two binary searches. Rows missing the key are left out.
+
+    Args:
+        keys: Series of keys (referrer or location), one per history row
+        times: int64 nanoseconds of the rows (all known)
+    """
+
+    def __init__(self, keys, times):
+        known = keys.notna().to_numpy()
+        codes, uniques = pd.factorize(_plain(keys[known]))
+        self.index = pd.Index(uniques)
+
+        times = times[known]
+        order = np.lexsort((times, codes))
+        # Positions of the sorted rows among the rows given
+        self.order = np.flatnonzero(known)[order]
+        self.times = np.sort(times)
+        self.stride = len(times) + 1
+        ranks = np.searchsorted(self.times, times[order], side='left')
+        self.keys = codes[order].astype(np.int64) * self.stride + ranks
+
+    def positions(self, keys, times, windows):
+        """
+        History positions of each row's windows
+
+        Args:
+            keys: Series of keys of the rows looked up
+            times: int64 nanoseconds of the rows (0 where unknown)
+            windows: dict of window name -> length
+
+        Returns:
+            (end, starts): end position, and start position per window, of
+            each row's windows in the sorted history rows
+        """
+        codes = self.index.get_indexer(_plain(keys))
+        # Unknown keys search past the last key's rows, where there are none
+        codes = np.where(codes >= 0, codes, len(self.index))
+        base = codes.astype(np.int64) * self.stride
+
+        # Binary searches are several times faster over ascending needles, so
+        # the rows are searched by time and by (key, time) order
+        time_order = np.argsort(times, kind='stable')
+        key_order = np.lexsort((times, base))
+
+        # History rows up to and including each referral's own time
+        latest = _search(self.times, times, time_order, side='right')
+        end = _search(self.keys, base + latest, key_order)
+        starts = {}
+        for window, length in windows.items():
+            earliest = _search(self.times, times - length.value, time_order, side='right')
+            starts[window] = _search(self.keys, base + earliest, key_order)
+        return end, starts
+
+
+    def record_positions(self, key, time, windows):
+        """
+        positions() for one row, with scalar binary searches
+
+        Args:
+            key: the row's key (present)
+            time: its int64 nanoseconds
+            windows: dict of window name -> length
+        """
+        try:
+            code = self.index.get_loc(key)
+        except KeyError:
+            code = len(self.index)
+        base = code * self.stride
+        end = int(np.searchsorted(self.keys, base + np.searchsorted(self.times, time, side='right')))
+        starts = {}
+        for window, length in windows.items():
+            earliest = np.searchsorted(self.times, time - length.value, side='right')
+            starts[window] = int(np.searchsorted(self.keys, base + earliest))
+        return end, starts
+
+
+class ReferrerHistory:
+    """
+    Every referral, sorted once by (referrer, referral time) and once by
+    (transaction location, referral time)
+
+    Building the history is two O(n log n) sorts; each lookup is O(log n)
+    (see _KeyedTimes), and window sums are differences of prefix sums.
+
+    Args:
+        history: DataFrame with HISTORY_COLUMNS (rows missing the referral
+                 time are left out, and rows missing the referrer or the
+                 location from that key's counts)
+    """
+
+    def __init__(self, history):
+        history = history[history['referral_at'].notna().to_numpy()]
+        times = _nanoseconds(history['referral_at'])
+        self.referrers = _KeyedTimes(history['referrer_id'], times)
+        self.locations = _KeyedTimes(history['transaction_location'], times)
+
+        reward_days = history['num_reward_days'].to_numpy(dtype='float64', na_value=0.0)
+        reward_days = reward_days[self.referrers.order]
+        self.rewarded = np.concatenate([[0], np.cumsum(reward_days > 0)])
+        self.reward_days = np.concatenate([[0.0], np.cumsum(reward_days)])
+
+    def features(self, df):
+        """
+        Window counts of the referrers and transaction locations of df's
+        rows at each row's referral time
+
+        Args:
+            df: DataFrame with referrer_id, transaction_location and referral_at (UTC)
+
+        Returns:
+            DataFrame aligned to df with velocity_columns(); missing for
+            rows without the key or the referral time, zero for keys the
+            history does not have
+        """
+        timed = df['referral_at'].notna().to_numpy()
+        times = np.where(timed, _nanoseconds(df['referral_at']), 0)
+
+        known = timed & df['referrer_id'].notna().to_numpy()
+        end, starts = self.referrers.positions(df['referrer_id'], times, VELOCITY_WINDOWS)
+        features = _window_features(known, end, starts, self.rewarded, self.reward_days)
+
+        known = timed & df['transaction_location'].notna().to_numpy()
+        end, starts = self.locations.positions(df['transaction_location'], times, LOCATION_WINDOWS)
+        features.update(_counts(known, end, starts, 'location'))
+        return pd.DataFrame(features, index=df.index)
+
+    def record_features(self, referrer_id, location, referral_at):
+        """
+        features() for one referral, without building frames
+
+        Args:
+            referrer_id, location: its referrer and transaction location
+            referral_at: its UTC Timestamp
+
+        Returns:
+            dict of velocity_columns() -> int (float for reward days);
+            None where features() gives a missing value
+        """
+        features = dict.fromkeys(velocity_columns())
+        if pd.isna(referral_at):
+            return features
+        time = referral_at.value
+
+        if not pd.isna(referrer_id):
+            end, starts = self.referrers.record_positions(referrer_id, time, VELOCITY_WINDOWS)
+            for window, start in starts.items():
+                features[f'referrer_referrals_{window}'] = end - start
+                features[f'referrer_rewarded_{window}'] = int(self.rewarded[end] - self.rewarded[start])
+                features[f'referrer_reward_days_{window}'] = float(
+                    self.reward_days[end] - self.reward_days[start])
+        if not pd.isna(location):
+            end, starts = self.locations.record_positions(location, time, LOCATION_WINDOWS)
+            for window, start in starts.items():
+                features[f'location_referrals_{window}'] = end - start
+        return features
+
+
+class _SpilledRuns:
+    """
+    History rows sorted by (key, time) on disk, with keys that are integer
+    codes; see SpilledReferrerHistory
+
+    Rows are counting-sorted into runs of one (key, time bucket) each, so a
+    key's rows are consecutive and in time order, and no run has to be
+    larger than a key's rows in one bucket.
+
+    Args:
+        path: file name prefix of the run's files
+        block_rows: rows read and sorted at once
+    """
+
+    def __init__(self, path, block_rows):
+        self.path = path
+        self.block_rows = block_rows
+        self.counts = np.zeros((0, 1), dtype=np.int64)  # rows per (key, bucket)
+        self.first_bucket = None
+        self._spill = open(self._path('spill'), 'wb')
+
+    def _path(self, name):
+        return f'{self.path}_{name}.bin'
+
+    def _map(self, name, dtype, size, mode='w+'):
+        # np.memmap cannot map an empty file, so there is always one entry
+        return np.memmap(self._path(name), dtype=dtype, mode=mode, shape=(max(size, 1),))
+
+    def _fit(self, keys, buckets):
+        """Grow the count table to hold the keys (doubling) and the buckets"""
+        rows, width = self.counts.shape
+        first = buckets.min() if self.first_bucket is None else min(self.first_bucket, buckets.min())
+        last = buckets.max() if self.first_bucket is None else max(self.first_bucket + width - 1,
+                                                                    buckets.max())
+        new_rows = rows if keys.max() < rows else max(keys.max() + 1, 2 * rows)
+        if new_rows == rows and first == self.first_bucket and last - first + 1 == width:
+            return
+        counts = np.zeros((new_rows, last - first + 1), dtype=np.int64)
+        if self.first_bucket is not None:
+            shift = self.first_bucket - first
+            counts[:rows, shift:shift + width] = self.counts
+        self.counts, self.first_bucket = counts, first
+
+    def add(self, keys, buckets, times, reward_days):
+        """Spill history rows (int64 arrays of key codes, buckets and times)"""
+        records = np.empty(len(keys), dtype=SPILL_RECORD)
+        records['key'], records['bucket'] = keys, buckets
+        records['time'], records['reward_days'] = times, reward_days
+        records.tofile(self._spill)
+        if not len(keys):
+            return
+        self._fit(keys, buckets)
+        runs, counts = np.unique(keys * self.counts.shape[1] + (buckets - self.first_bucket),
+                                 return_counts=True)
+        self.counts.ravel()[runs] += counts
+
+    def finish(self):
+        """Sort the spilled rows and map the sorted history (after the last add)"""
+        self._spill.close()
+        self.width = self.counts.shape[1]
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts.ravel())])
+        self.keys = self.counts.shape[0]
+        del self.counts
+        size = int(self.offsets[-1])
+        spilled = self._map('spill', SPILL_RECORD, size, mode='r') if size else np.empty(0, SPILL_RECORD)
+        times = self._map('times', np.int64, size)
+        reward_days = self._map('reward_days', np.float64, size)
+
+        # Scatter each block into the runs, after the rows earlier blocks put there
+        filled = self.offsets[:-1].copy()
+        for block_start in range(0, size, self.block_rows):
+            block = spilled[block_start:block_start + self.block_rows]
+            run_of = block['key'] * self.width + (block['bucket'] - (self.first_bucket or 0))
+            order = np.argsort(run_of, kind='stable')
+            run_of = run_of[order]
+            runs, firsts, counts = np.unique(run_of, return_index=True, return_counts=True)
+            positions = np.arange(len(run_of)) - np.repeat(firsts - filled[runs], counts)
+            times[positions] = block['time'][order]
+            reward_days[positions] = block['reward_days'][order]
+            filled[runs] += counts
+
+        # Sort the runs by time, as many whole runs at a time as fit in a block
+        start = 0
+        while start < size:
+            end = self.offsets[np.searchsorted(self.offsets, start + self.block_rows, side='right') - 1]
+            if end <= start:
+                end = self.offsets[np.searchsorted(self.offsets, start, side='right')]
+            runs = np.searchsorted(self.offsets, np.arange(start, end), side='right')
+            order = np.lexsort((times[start:end], runs))
+            times[start:end] = times[start:end][order]
+            reward_days[start:end] = reward_days[start:end][order]
+            start = end
+
+        # Prefix sums, carried from block to block in the order np.cumsum adds
+        self.rewarded = self._map('rewarded', np.int64, size + 1)
+        self.reward_days = self._map('reward_day_sums', np.float64, size + 1)
+        self.rewarded[0], self.reward_days[0] = 0, 0.0
+        for block_start in range(0, size, self.block_rows):
+            days = np.asarray(reward_days[block_start:block_start + self.block_rows])
+            block_end = block_start + len(days)
+            self.rewarded[block_start + 1:block_end + 1] = (
+                self.rewarded[block_start] + np.cumsum(days > 0))
+            self.reward_days[block_start + 1:block_end + 1] = np.cumsum(
+                np.concatenate([[self.reward_days[block_start]], days]))[1:]
+        self.times = times
+
+    def positions(self, keys, times, windows):
+        """
+        History positions of each row's windows, like _KeyedTimes.positions
+
+        Args:
+            keys: int64 key codes of the rows (-1 where missing)
+            times: int64 nanoseconds of the rows (0 where unknown)
+        """
+        # Keys the history has no rows for get the empty run after the last key's
+        keys = np.where((keys >= 0) & (keys < self.keys), keys, self.keys)
+        first = self.offsets[keys * self.width]
+        last = self.offsets[np.minimum(keys + 1, self.keys) * self.width]
+        end = _search_runs(self.times, first, last, times)
+        starts = {window: _search_runs(self.times, first, last, times - length.value)
+                  for window, length in windows.items()}
+        return end, starts
+
+
+class SpilledReferrerHistory:
+    """
+    ReferrerHistory kept on disk, for histories added a block at a time
+    that need not fit in memory
+
+    Referrers are integer codes (id_codes.IdDictionary), and locations are
+    numbered as they are added, so the rows are sorted with a counting
+    sort: add() appends each block to a spill file and counts its rows
+    per run, and finish() gives every run that many positions, scatters
+    the spilled rows into their runs a block at a time, and then sorts the
+    runs by time, a block of whole runs at a time. A referrer's rows are
+    one run; a location's are one run per day, as a busy club can hold a
+    good share of the table. The sorted times and the prefix sums are
+    memory-mapped files, so lookups read only the pages they touch. Memory
+    is one block plus an offset per referrer code (a referrer with more
+    rows than a block is sorted in one piece).
+
+    Args:
+        directory: where the files are written (the caller removes them)
+        block_rows: rows read and sorted at once
+    """
+
+    def __init__(self, directory, block_rows):
+        self.referrers = _SpilledRuns(os.path.join(directory, 'referrer_history'), block_rows)
+        self.locations = _SpilledRuns(os.path.join(directory, 'location_history'), block_rows)
+        self.location_names = pd.Index([])
+
+    def _location_codes(self, locations):
+        """Location numbers (-1 where missing), numbering unseen locations"""
+        locations = _plain(locations)
+        unseen = pd.Index(locations.dropna().unique()).difference(self.location_names)
+        self.location_names = self.location_names.append(unseen)
+        return self.location_names.get_indexer(locations).astype(np.int64)
+
+    def add(self, history):
+        """
+        Spill a block of history rows
+
+        Args:
+            history: DataFrame with HISTORY_COLUMNS, referrer_id holding
+                     integer codes (see ReferrerHistory for missing values)
+        """
+        history = history[history['referral_at'].notna().to_numpy()]
+        times = _nanoseconds(history['referral_at'])
+        referrers = history['referrer_id'].to_numpy(dtype=np.int64, na_value=-1)
+        reward_days = history['num_reward_days'].to_numpy(dtype='float64', na_value=0.0)
+        known = referrers >= 0
+        self.referrers.add(referrers[known], np.zeros(known.sum(), dtype=np.int64),
+                           times[known], reward_days[known])
+
+        locations = self._location_codes(history['transaction_location'])
+        known = locations >= 0
+        self.locations.add(locations[known], times[known] // LOCATION_BUCKET.value,
+                           times[known], np.zeros(known.sum()))
+
+    def finish(self):
+        """Sort the spilled rows and map the sorted history (after the last add)"""
+        self.referrers.finish()
+        self.locations.finish()
+
+    def features(self, df):
+        """
+        Window counts like ReferrerHistory.features, with df's referrer_id
+        holding the codes the history was added with
+        """
+        timed = df['referral_at'].notna().to_numpy()
+        times = np.where(timed, _nanoseconds(df['referral_at']), 0)
+
+        referrers = df['referrer_id'].to_numpy(dtype=np.int64, na_value=-1)
+        end, starts = self.referrers.positions(referrers, times, VELOCITY_WINDOWS)
+        features = _window_features(timed & (referrers >= 0), end, starts,
+                                    self.referrers.rewarded, self.referrers.reward_days)
+
+        locations = self.location_names.get_indexer(_plain(df['transaction_location']))
+        known = timed & df['transaction_location'].notna().to_numpy()
+        end, starts = self.locations.positions(locations.astype(np.int64), times, LOCATION_WINDOWS)
+        features.update(_counts(known, end, starts, 'location'))
+        return pd.DataFrame(features, index=df.index)
+
+
+def add_velocity_features(df, history, added=None, removed=None):
+    """
+    STEP 5b: add the referrer and location velocity columns
+
+    Window counts and sums add up over disjoint sets of referrals, so a
+    referral can be counted against history as it would be with some
+    referrals added or replaced, without rebuilding it.
+
+    Args:
+        df: joined referrals with referrer_id, transaction_location and referral_at
+        history: ReferrerHistory over every referral
+        added: ReferrerHistory of referrals to count on top of history
+        removed: ReferrerHistory of referrals in history to leave out
+
+    Returns:
+        df with velocity_columns() added
+    """
+    features = history.features(df)
+    if added is not None:
+        features = features + added.features(df)
+    if removed is not None:
+        features = features - removed.features(df)
+    for column, values in features.items():
+        df[column] = values
+    return df
+
+
+def _record_counts(referral, rows):
+    """
+    Window counts of a few history rows (dicts with HISTORY_COLUMNS) at one
+    referral's keys and time, as a ReferrerHistory of them would give them
+    """
+    features = dict.fromkeys(velocity_columns())
+    referral_at = referral['referral_at']
+    if pd.isna(referral_at):
+        return features
+    keys = [('referrer', 'referrer_id', VELOCITY_WINDOWS),
+            ('location', 'transaction_location', LOCATION_WINDOWS)]
+    for prefix, column, windows in keys:
+        if pd.isna(referral[column]):
+            continue
+        for window, length in windows.items():
+            matching = [row for row in rows
+                        if not pd.isna(row['referral_at']) and row[column] == referral[column]
+                        and referral_at - length < row['referral_at'] <= referral_at]
+            features[f'{prefix}_referrals_{window}'] = len(matching)
+            if prefix == 'referrer':
+                days = [0.0 if pd.isna(row['num_reward_days']) else float(row['num_reward_days'])
+                        for row in matching]
+                features[f'referrer_rewarded_{window}'] = sum(day > 0 for day in days)
+                features[f'referrer_reward_days_{window}'] = float(np.sum(days))
+    return features
+
+
+def add_record_velocity_features(referral, history, added=(), removed=()):
+    """
+    STEP 5b for one referral (see add_velocity_features)
+
+    Args:
+        referral: dict of one joined referral's values
+        history: ReferrerHistory over every referral
+        added, removed: history rows (dicts with HISTORY_COLUMNS) to count
+                        on top of history, and to leave out of it
+
+    Returns:
+        referral with velocity_columns() added (None where missing)
+    """
+    features = history.record_features(referral['referrer_id'], referral['transaction_location'],
+                                       referral['referral_at'])
+    for rows, sign in ((added, 1), (removed, -1)):
+        if rows:
+            counts = _record_counts(referral, rows)
+            features = {column: value if value is None else value + sign * counts[column]
+                        for column, value in features.items()}
+    referral.update(features)
+    return referral
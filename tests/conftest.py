@@ -0,0 +1,12 @@
+"""
+Test Configuration
+Purpose: Make the pipeline modules in src/ importable the way the scripts
+         import each other (flat module names)
+"""
+
+import os
+import sys
+
+# The pipeline modules live in src/
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
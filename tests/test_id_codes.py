@@ -0,0 +1,64 @@
+"""
+Identifier Code Tests
+Purpose: IdDictionary codes stay stable and dense across many appends and
+         piece merges
+"""
+
+import numpy as np
+import pandas as pd
+
+from id_codes import IdDictionary
+
+
+def _identifiers(rng, pool, size):
+    """size identifiers drawn from a pool of pool hex strings, about 5% missing"""
+    values = pd.Series([f'{n:032x}' for n in rng.integers(0, pool, size)], dtype='str')
+    return values.mask(rng.random(size) < 0.05)
+
+
+def test_codes_are_stable_across_appends_and_merges():
+    rng = np.random.default_rng(7)
+    ids = IdDictionary()
+    seen = {}
+    # Batches of varying size, so pieces are appended and merged in many patterns
+    for batch in range(200):
+        values = _identifiers(rng, 20_000, int(rng.integers(1, 400)) * (1 + batch % 7))
+        codes = ids.encode(values)
+
+        missing = values.isna().to_numpy()
+        assert (pd.isna(codes) == missing).all()
+        for value, code in zip(values[~missing], codes[~missing]):
+            # Known identifiers keep their code; new ones get the next free code
+            assert seen.setdefault(value, len(seen)) == code
+        assert len(ids) == len(seen)
+
+        # Piece sizes halve at least every other piece, so lookups probe O(log n) pieces
+        sizes = [len(piece) for _, piece in ids._pieces]
+        assert all(2 * later < earlier for earlier, later in zip(sizes, sizes[1:]))
+        assert [first for first, _ in ids._pieces] == list(np.cumsum([0] + sizes[:-1]))
+
+    # Every code decodes back to its identifier
+    codes = pd.Series(pd.array(list(seen.values()), dtype='Int32'))
+    assert ids.decode(codes).tolist() == list(seen)
+
+
+def test_encode_numbers_new_identifiers_in_order_of_first_appearance():
+    ids = IdDictionary()
+    first = ids.encode(pd.Series(['b', 'a', None, 'b'], dtype='str'))
+    second = ids.encode(pd.Series(['c', 'a', 'd', 'c'], dtype='str'))
+
+    assert first.tolist() == [0, 1, pd.NA, 0]
+    assert second.tolist() == [2, 1, 3, 2]
+    assert ids.values.tolist() == ['b', 'a', 'c', 'd']
+
+
+def test_encode_tables_shares_codes_across_tables():
+    ids = IdDictionary()
+    tables = {
+        'user_referrals': pd.DataFrame({'referrer_id': pd.Series(['u1', 'u2'], dtype='str')}),
+        'user_logs': pd.DataFrame({'user_id': pd.Series(['u2', 'u3'], dtype='str')}),
+    }
+    encoded = ids.encode_tables(tables)
+
+    assert encoded['user_referrals']['referrer_id'].tolist() == [0, 1]
+    assert encoded['user_logs']['user_id'].tolist() == [1, 2]
@@ -0,0 +1,233 @@
+"""
+Identity Ring Tests
+Purpose: UnionFind components against a naive implementation on chain, star
+         and random graphs, cluster labels that do not change when other
+         clusters appear or merge, and clusters built a chunk at a time
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from id_codes import IdDictionary
+from identity_rings import IdentityClusters, StreamedClusters, UnionFind
+from schema import FACT_TABLE
+
+
+def _naive_components(size, left, right):
+    """Component label of each node: the smallest node of its component"""
+    labels = list(range(size))
+    for a, b in zip(left.tolist(), right.tolist()):
+        old, new = sorted((labels[a], labels[b]), reverse=True)
+        if old != new:
+            labels = [new if label == old else label for label in labels]
+    return np.array(labels)
+
+
+def _assert_same_partition(union_find, size, left, right):
+    roots = union_find.find(np.arange(size))
+    labels = _naive_components(size, left, right)
+    # Two nodes share a root exactly when they share a naive label
+    _, root_ids = np.unique(roots, return_inverse=True)
+    _, label_ids = np.unique(labels, return_inverse=True)
+    pairs = set(zip(root_ids.tolist(), label_ids.tolist()))
+    assert len(pairs) == len(set(root_ids.tolist())) == len(set(label_ids.tolist()))
+
+
+def _union(size, left, right):
+    union_find = UnionFind(size)
+    union_find.union(np.asarray(left, dtype=np.int64), np.asarray(right, dtype=np.int64))
+    return union_find
+
+
+@pytest.mark.parametrize('size', [1, 2, 17, 1_000])
+def test_chain_is_one_component(size):
+    left, right = np.arange(size - 1), np.arange(1, size)
+    union_find = _union(size, left, right)
+
+    assert len(np.unique(union_find.find(np.arange(size)))) == 1
+    # Reversed and shuffled edge orders give the same result
+    for order in (slice(None, None, -1), np.random.default_rng(0).permutation(size - 1)):
+        assert len(np.unique(_union(size, left[order], right[order]).find(np.arange(size)))) == 1
+
+
+@pytest.mark.parametrize('size', [2, 50, 5_000])
+def test_star_is_one_component(size):
+    leaves = np.arange(1, size)
+    for left, right in ((np.zeros(size - 1), leaves), (leaves, np.zeros(size - 1))):
+        union_find = _union(size, left, right)
+        assert len(np.unique(union_find.find(np.arange(size)))) == 1
+
+
+@pytest.mark.parametrize('seed', range(15))
+def test_random_graph_matches_naive_components(seed):
+    rng = np.random.default_rng(seed)
+    size = int(rng.integers(1, 400))
+    edges = int(rng.integers(0, size * 2))
+    left, right = rng.integers(0, size, edges), rng.integers(0, size, edges)
+
+    union_find = _union(size, left, right)
+
+    _assert_same_partition(union_find, size, left, right)
+
+
+def test_unions_accumulate_over_calls():
+    rng = np.random.default_rng(99)
+    size = 300
+    left, right = rng.integers(0, size, 250), rng.integers(0, size, 250)
+    union_find = UnionFind(size)
+    for start in range(0, 250, 40):
+        union_find.union(left[start:start + 40], right[start:start + 40])
+
+    _assert_same_partition(union_find, size, left, right)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_few_unions_into_a_growing_forest_match_naive_components(seed):
+    rng = np.random.default_rng(seed)
+    size = 300
+    left, right = rng.integers(0, size, 400), rng.integers(0, size, 400)
+    union_find = UnionFind(0)
+    for start in range(0, 400, 30):
+        batch = slice(start, start + 30)
+        union_find.grow(max(left[batch].max(), right[batch].max()) + 1)
+        union_find.union(left[batch], right[batch], few=True)
+    union_find.grow(size)
+
+    _assert_same_partition(union_find, size, left, right)
+
+
+def test_find_points_every_node_at_its_root():
+    rng = np.random.default_rng(5)
+    left, right = rng.integers(0, 200, 150), rng.integers(0, 200, 150)
+    union_find = _union(200, left, right)
+
+    roots = union_find.find(np.arange(200))
+
+    assert np.array_equal(union_find.parent[roots], roots)
+
+
+def _identity_tables(seed, referrals=60, users=40):
+    """Random referrals and users drawing on small pools of ids, phones and transactions"""
+    rng = np.random.default_rng(seed)
+
+    def draw(prefix, pool, count):
+        values = pd.Series([f'{prefix}{value:02d}' for value in rng.integers(0, pool, count)],
+                           dtype='str')
+        return values.mask(rng.random(count) < 0.1)
+
+    fact = pd.DataFrame({
+        'referral_id': [f'r{number:03d}' for number in range(referrals)],
+        'referee_id': draw('a', 50, referrals),
+        'referee_phone': draw('p', 30, referrals),
+        'transaction_id': draw('t', 40, referrals),
+    })
+    user_logs = pd.DataFrame({'user_id': draw('a', 50, users), 'phone_number': draw('p', 30, users)})
+    return fact, {'user_logs_clean': user_logs}
+
+
+def _naive_labels(fact, dims):
+    """Smallest identifier of each referral's cluster, by repeated relabelling"""
+    user_logs = dims['user_logs_clean']
+    edges = [(a, b) for frame, account, identifier in (
+        (user_logs, 'user_id', 'phone_number'),
+        (fact, 'referee_id', 'referee_phone'),
+        (fact, 'referee_id', 'transaction_id'),
+    ) for a, b in zip(frame[account], frame[identifier]) if pd.notna(a) and pd.notna(b)]
+    label = {node: node for edge in edges for node in edge}
+    changed = True
+    while changed:
+        changed = False
+        for a, b in edges:
+            smallest = min(label[a], label[b])
+            if label[a] != smallest or label[b] != smallest:
+                label[a] = label[b] = smallest
+                changed = True
+
+    labels = []
+    for row in fact.itertuples():
+        node = next((value for value in (row.referee_id, row.transaction_id, row.referee_phone)
+                     if pd.notna(value)), None)
+        labels.append(None if node is None else label.get(node, node))
+    return labels
+
+
+def _cluster_ids(clusters, fact):
+    return clusters.assign(fact.copy())['cluster_id'].astype(object).where(
+        lambda ids: ids.notna(), None).tolist()
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_cluster_id_is_the_smallest_identifier(seed):
+    fact, dims = _identity_tables(seed)
+
+    assert _cluster_ids(IdentityClusters(fact, dims), fact) == _naive_labels(fact, dims)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_encoded_clusters_decode_to_the_same_ids(seed):
+    fact, dims = _identity_tables(seed)
+    ids = IdDictionary()
+    # Codes follow first appearance, which is not the text order
+    encoded = ids.encode_tables({FACT_TABLE: fact.iloc[::-1], 'user_logs': dims['user_logs_clean']})
+    encoded_dims = {'user_logs_clean': encoded['user_logs']}
+    encoded_fact = encoded[FACT_TABLE].iloc[::-1]
+
+    clustered = IdentityClusters(encoded_fact, encoded_dims, ids).assign(encoded_fact.copy())
+
+    decoded = ids.decode_columns(clustered)['cluster_id']
+    assert decoded.where(decoded.notna(), None).tolist() == _naive_labels(fact, dims)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_cluster_ids_survive_new_referrals(seed):
+    fact, dims = _identity_tables(seed)
+    before = dict(zip(fact['referral_id'], _naive_labels(fact, dims)))
+    more, _ = _identity_tables(seed + 100, referrals=5)
+    more['referral_id'] = 'new_' + more['referral_id']
+    grown = pd.concat([fact, more], ignore_index=True)
+
+    after = dict(zip(grown['referral_id'], _cluster_ids(IdentityClusters(grown, dims), grown)))
+
+    for referral_id, label in before.items():
+        if label is None:
+            continue
+        # A cluster keeps its label unless it merged into one with a smaller label
+        assert after[referral_id] <= label
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_added_referrals_cluster_as_if_rebuilt(seed):
+    fact, dims = _identity_tables(seed)
+    more, _ = _identity_tables(seed + 100, referrals=5)
+    more['referral_id'] = 'new_' + more['referral_id']
+    grown = pd.concat([fact, more], ignore_index=True)
+
+    rebuilt = IdentityClusters(grown, dims).assign(grown.copy())
+    overlaid = IdentityClusters(fact, dims).assign(grown.copy(), added=more)
+
+    pd.testing.assert_series_equal(overlaid['cluster_id'].astype(object),
+                                   rebuilt['cluster_id'].astype(object))
+    pd.testing.assert_series_equal(overlaid['cluster_size'], rebuilt['cluster_size'])
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1_000])
+def test_streamed_clusters_match_identity_clusters(chunk_size):
+    fact, dims = _identity_tables(3)
+    ids = IdDictionary()
+    encoded_dims = {'user_logs_clean': ids.encode_table(dims['user_logs_clean'], 'user_logs')}
+    streamed = StreamedClusters(ids)
+    streamed.add(encoded_dims['user_logs_clean'], 'user_logs_clean')
+    chunks = [ids.encode_table(fact.iloc[start:start + chunk_size], FACT_TABLE)
+              for start in range(0, len(fact), chunk_size)]
+    for chunk in chunks:
+        streamed.add(chunk, FACT_TABLE)
+    streamed.finish()
+
+    encoded_fact = pd.concat(chunks)
+    expected = IdentityClusters(encoded_fact, encoded_dims, ids).assign(encoded_fact.copy())
+    assigned = streamed.assign(encoded_fact.copy())
+
+    pd.testing.assert_series_equal(ids.decode(assigned['cluster_id']),
+                                   ids.decode(expected['cluster_id']))
+    pd.testing.assert_series_equal(assigned['cluster_size'], expected['cluster_size'])
@@ -0,0 +1,167 @@
+"""
+Incremental Run Tests
+Purpose: After referrals are linked, unlinked, moved in time or added, a
+         user changes phone, or a club fills up and empties, an incremental
+         run leaves the store holding the report a full run over the changed
+         inputs writes
+"""
+
+import contextlib
+import io
+import shutil
+
+import pandas as pd
+import pytest
+
+from fraud_rules import MAX_LOCATION_REFERRALS_PER_HOUR
+from main_pipeline import PipelineConfig, run_pipeline
+from schema import FACT_TABLE, NA_VALUES, input_path
+from synthetic_data import generate_dataset
+
+REFERRALS = 2_000
+
+
+def _run(data_dir, output_dir, **settings):
+    """Report of one quiet pipeline run, as text sorted by referral_id"""
+    config = PipelineConfig(data_dir=str(data_dir), output_dir=str(output_dir), **settings)
+    with contextlib.redirect_stdout(io.StringIO()):
+        run_pipeline(config)
+    report = pd.read_csv(config.output_file, dtype=str, keep_default_na=False)
+    return report.sort_values('referral_id', kind='stable').reset_index(drop=True)
+
+
+def _read_input(data_dir, table_name):
+    return pd.read_csv(input_path(data_dir, table_name), dtype=str, keep_default_na=False)
+
+
+def _write_input(df, data_dir, table_name):
+    df.to_csv(input_path(data_dir, table_name), index=False)
+
+
+def _touch(referrals, rows, day):
+    """Mark rows as updated after every earlier run"""
+    referrals.loc[rows, 'updated_at'] = f'2031-01-{day:02d}T00:00:00Z'
+
+
+def _linkable(referrals):
+    """Rows with a referee and a phone (a referral without a referee is not linked by its phone)"""
+    present = ~referrals[['referee_id', 'referee_phone']].isin(NA_VALUES).any(axis=1)
+    return referrals.index[present.to_numpy()]
+
+
+def _link_referees(data_dir, day):
+    """Give referees a shared phone and a shared transaction, and add a referral"""
+    referrals = _read_input(data_dir, FACT_TABLE)
+    rows = _linkable(referrals)
+    referrals.loc[rows[10:15], 'referee_phone'] = referrals.loc[rows[0], 'referee_phone']
+    referrals.loc[rows[20:22], 'transaction_id'] = referrals.loc[rows[22], 'transaction_id']
+    _touch(referrals, rows[10:15].append(rows[20:22]), day)
+
+    added = referrals.loc[rows[40:41]].copy()
+    added['referral_id'] = 'f' * 32
+    added['referee_phone'] = referrals.loc[rows[50], 'referee_phone']
+    _touch(added, added.index, day)
+    _write_input(pd.concat([referrals, added], ignore_index=True), data_dir, FACT_TABLE)
+
+
+def _move_and_unlink(data_dir, day):
+    """Move referrals in time, break a link and give a user a referee's phone"""
+    referrals = _read_input(data_dir, FACT_TABLE)
+    rows = _linkable(referrals)
+    referrals.loc[rows[12], 'referee_phone'] = ''
+    referrals.loc[rows[30], 'referral_at'] = referrals.loc[rows[31], 'referral_at']
+    referrals.loc[rows[32], 'referral_at'] = '2024-01-01T00:00:00Z'
+    _touch(referrals, rows[[12, 30, 32]], day)
+    _write_input(referrals, data_dir, FACT_TABLE)
+
+    users = _read_input(data_dir, 'user_logs')
+    # user_logs_clean keeps the first row of each user
+    first_rows = users.drop_duplicates('user_id').index
+    users.loc[first_rows[5], 'phone_number'] = referrals.loc[rows[60], 'referee_phone']
+    _write_input(users, data_dir, 'user_logs')
+
+
+def _club_referrals(data_dir):
+    """Rows of referrals whose transaction is at the busiest club"""
+    referrals = _read_input(data_dir, FACT_TABLE)
+    transactions = _read_input(data_dir, 'paid_transactions')
+    club = transactions['transaction_location'].value_counts().index[0]
+    at_club = referrals['transaction_id'].isin(
+        transactions.loc[transactions['transaction_location'] == club, 'transaction_id'])
+    return referrals, referrals.index[at_club.to_numpy()][:MAX_LOCATION_REFERRALS_PER_HOUR]
+
+
+def _crowd_club(data_dir, day):
+    """Move enough of one club's referrals into one hour for a location burst"""
+    referrals, rows = _club_referrals(data_dir)
+    for minute, row in enumerate(rows):
+        referrals.loc[row, 'referral_at'] = f'2024-02-01T10:{minute:02d}:00Z'
+    _touch(referrals, rows, day)
+    _write_input(referrals, data_dir, FACT_TABLE)
+
+
+def _leave_club(data_dir, day):
+    """Move one referral out of the crowded hour, so the others drop below the threshold"""
+    referrals, rows = _club_referrals(data_dir)
+    referrals.loc[rows[0], 'referral_at'] = '2024-03-01T10:00:00Z'
+    _touch(referrals, rows[:1], day)
+    _write_input(referrals, data_dir, FACT_TABLE)
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    data_dir = tmp_path / 'data'
+    generate_dataset(str(data_dir), REFERRALS, seed=3)
+    return data_dir
+
+
+def test_incremental_runs_follow_changed_inputs(inputs, tmp_path):
+    store = tmp_path / 'store'
+    _run(inputs, store, mode='incremental', export=True)
+
+    for day, change in enumerate([_link_referees, _move_and_unlink], start=1):
+        change(inputs, day)
+        # Fresh copies, so the full run does not share the incremental run's caches
+        full_inputs = tmp_path / f'full_data_{day}'
+        shutil.copytree(inputs, full_inputs, ignore=shutil.ignore_patterns('.*'))
+
+        incremental = _run(inputs, store, mode='incremental', export=True)
+        full = _run(full_inputs, tmp_path / f'full_{day}', use_cache=False)
+
+        pd.testing.assert_frame_equal(incremental, full)
+
+
+def test_linked_referrals_share_a_cluster(inputs, tmp_path):
+    store = tmp_path / 'store'
+    _run(inputs, store, mode='incremental', export=True)
+    _link_referees(inputs, 1)
+
+    report = _run(inputs, store, mode='incremental', export=True).set_index('referral_id')
+
+    referrals = _read_input(inputs, FACT_TABLE)
+    rows = _linkable(referrals)
+    linked = report.loc[referrals.loc[rows[[0, 10, 11, 12, 13, 14]], 'referral_id']]
+    assert linked['cluster_id'].nunique() == 1
+    assert (linked['cluster_size'].astype(int) > 1).all()
+
+
+def test_location_bursts_follow_moved_referrals(inputs, tmp_path):
+    store = tmp_path / 'store'
+    _run(inputs, store, mode='incremental', export=True)
+
+    bursts = []
+    for day, change in enumerate([_crowd_club, _leave_club], start=1):
+        change(inputs, day)
+        full_inputs = tmp_path / f'full_data_{day}'
+        shutil.copytree(inputs, full_inputs, ignore=shutil.ignore_patterns('.*'))
+
+        incremental = _run(inputs, store, mode='incremental', export=True)
+        full = _run(full_inputs, tmp_path / f'full_{day}', use_cache=False)
+
+        pd.testing.assert_frame_equal(incremental, full)
+        # Bit 14: location_burst_1h
+        bits = incremental['fraud_rule_bitmask'].astype(int).to_numpy()
+        bursts.append(int(((bits >> 14) & 1).sum()))
+
+    # The crowded hour set the rule off, and leaving it cleared some of it
+    assert bursts[0] > bursts[1]
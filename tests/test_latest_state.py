@@ -0,0 +1,65 @@
+"""
+Latest-State Tests
+Purpose: latest_rows picks the rows a stable sort followed by
+         drop_duplicates(keep='last') would, ties and missing values included
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from latest_state import latest_rows
+
+
+def _reference(table, key, order_by):
+    """Latest row per key the slow way: stable sort, keep the last row per key"""
+    ordered = table.sort_values(order_by, kind='stable', na_position='last')
+    return ordered.drop_duplicates(key, keep='last')
+
+
+def _event_log(rng, rows, keys, stamps):
+    """Random log with repeated keys, tied timestamps and missing values of both"""
+    key = pd.Series([f'k{n}' for n in rng.integers(0, keys, rows)], dtype='str')
+    created_at = pd.Series(pd.to_datetime(rng.integers(0, stamps, rows), unit='s', utc=True))
+    return pd.DataFrame({
+        'user_referral_id': key.mask(rng.random(rows) < 0.05),
+        'created_at': created_at.mask(rng.random(rows) < 0.1),
+        'row': np.arange(rows),
+    })
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_latest_rows_matches_sort_and_drop_duplicates(seed):
+    rng = np.random.default_rng(seed)
+    rows = int(rng.integers(1, 2_000))
+    # Few distinct timestamps, so many rows of a key tie
+    table = _event_log(rng, rows, keys=int(rng.integers(1, 300)), stamps=int(rng.integers(1, 50)))
+
+    latest = latest_rows(table, 'user_referral_id', 'created_at')
+    expected = _reference(table, 'user_referral_id', 'created_at')
+
+    assert sorted(latest['row']) == sorted(expected['row'])
+    # Rows keep their table order
+    assert latest['row'].is_monotonic_increasing
+
+
+def test_latest_rows_tie_goes_to_the_row_further_down():
+    table = pd.DataFrame({
+        'lead_id': ['a', 'a', 'b', 'b', 'a'],
+        'created_at': pd.to_datetime(['2024-01-02', '2024-01-02', None, '2024-01-05',
+                                      '2024-01-01'], utc=True),
+        'row': range(5),
+    })
+
+    latest = latest_rows(table, 'lead_id', 'created_at')
+
+    # 'a': rows 0 and 1 tie on the latest time, row 1 is further down;
+    # 'b': a missing timestamp counts as later than any other
+    assert latest['row'].tolist() == [1, 2]
+
+
+def test_latest_rows_of_empty_table():
+    table = pd.DataFrame({'lead_id': pd.Series([], dtype='str'),
+                          'created_at': pd.Series([], dtype='datetime64[ns, UTC]')})
+
+    assert latest_rows(table, 'lead_id', 'created_at').empty
@@ -0,0 +1,68 @@
+"""
+Pipeline Equivalence Tests
+Purpose: Every way of running the pipeline (CSV parser, table cache,
+         streaming, worker processes, background writes, incremental export)
+         writes the same report as a plain full run, on generated data
+"""
+
+import contextlib
+import gzip
+import io
+import os
+import shutil
+
+import pytest
+
+from main_pipeline import PipelineConfig, run_pipeline
+from synthetic_data import generate_dataset
+
+# Large enough for several chunks, partitions and report blocks per run
+REFERRALS = 3_000
+
+
+def _run(data_dir, output_dir, **settings):
+    """Report bytes of one quiet pipeline run"""
+    config = PipelineConfig(data_dir=str(data_dir), output_dir=str(output_dir), **settings)
+    with contextlib.redirect_stdout(io.StringIO()):
+        run_pipeline(config)
+    opener = gzip.open if config.output_file.endswith('.gz') else open
+    with opener(config.output_file, 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture(scope='module')
+def dataset(tmp_path_factory):
+    """Generated inputs and the report of a plain full run over them"""
+    root = tmp_path_factory.mktemp('equivalence')
+    data_dir = root / 'data'
+    generate_dataset(str(data_dir), REFERRALS, seed=11)
+    return data_dir, _run(data_dir, root / 'reference', use_cache=False, engine='c')
+
+
+@pytest.mark.parametrize('settings', [
+    {'engine': 'pyarrow', 'use_cache': False},
+    {'use_cache': True},
+    {'chunk_size': 700},
+    {'chunk_size': 700, 'background_write': True},
+    {'workers': 2},
+    {'output_format': 'csv.gz'},
+    {'memory_budget': 2 ** 34},
+], ids=lambda settings: ','.join(f'{key}={value}' for key, value in settings.items()))
+def test_run_writes_the_reference_report(dataset, tmp_path, settings):
+    data_dir, reference = dataset
+
+    assert _run(data_dir, tmp_path, **settings) == reference
+
+
+def test_incremental_export_writes_the_reference_report(dataset, tmp_path):
+    data_dir, reference = dataset
+    # A copy, so the latest-state store of the other runs is not reused
+    inputs = tmp_path / 'data'
+    shutil.copytree(data_dir, inputs, ignore=shutil.ignore_patterns('.*'))
+
+    first = _run(inputs, tmp_path / 'out', mode='incremental', export=True)
+    second = _run(inputs, tmp_path / 'out', mode='incremental', export=True)
+
+    assert first == reference
+    assert second == reference
+    assert os.path.exists(tmp_path / 'out' / 'referral_fraud_detection.db')
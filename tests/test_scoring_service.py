@@ -0,0 +1,87 @@
+"""
+Scoring Service Tests
+Purpose: Verdicts of the online scoring service, one referral at a time and
+         in micro-batches, against a batch run, the single-record path
+         against the DataFrame path for records unlike the file's, and its
+         dimension caches and request validation
+"""
+
+import asyncio
+import json
+
+import pandas as pd
+import pytest
+
+from schema import FACT_TABLE, input_path, read_record, read_records
+from scoring_service import (RecordError, ScoringService, _route, check_against_batch,
+                             report_record, report_records, score_record, score_referrals)
+from synthetic_data import generate_dataset
+
+
+@pytest.fixture(scope='module')
+def service(tmp_path_factory):
+    data_dir = tmp_path_factory.mktemp('scoring') / 'data'
+    generate_dataset(str(data_dir), 600, seed=5)
+    return ScoringService(str(data_dir), cache_size=0, use_cache=False)
+
+
+@pytest.mark.parametrize('batch_size', [1, 50])
+def test_verdicts_match_the_batch_run(service, batch_size):
+    checked, mismatches = check_against_batch(service, batch_size)
+
+    assert checked == 600
+    assert mismatches == []
+
+
+def _edited_records(service):
+    """File records with new ids, missing identifiers and unreadable values"""
+    records = pd.read_csv(input_path(service.data_dir, FACT_TABLE), dtype=str,
+                          keep_default_na=False).to_dict('records')
+    shared_phone = records[0]['referee_phone']
+    edits = [
+        {'referral_id': 'new-referral'},
+        {'referral_id': 'new-referral', 'referee_phone': shared_phone},
+        {'referee_id': None, 'referee_phone': None, 'transaction_id': None},
+        {'referee_id': 'new-referee', 'transaction_id': 'new-transaction'},
+        {'referral_at': '5/2/2024 10:00', 'referral_reward_id': '999'},
+        {'referral_at': 'not a time', 'user_referral_status_id': 'null'},
+        {'referrer_id': None, 'referral_source': 'Lead'},
+        {'referral_reward_id': 2.0, 'updated_at': ''},
+    ]
+    return [{**record, **edit} for record in records[:8] for edit in edits]
+
+
+def test_single_record_path_matches_the_dataframe_path(service):
+    snapshot = service.snapshot
+    assert snapshot.unique_keys
+
+    for record in _edited_records(service):
+        expected = report_records(score_referrals(snapshot, read_records([record], FACT_TABLE)))
+        scored = report_record(score_record(snapshot, read_record(record, FACT_TABLE)))
+
+        assert json.dumps(scored, default=str) == json.dumps(expected[0], default=str), record
+
+
+def test_small_dimension_caches_evict_and_keep_verdicts(service):
+    small = ScoringService(service.data_dir, cache_size=0, use_cache=False, dimension_cache_size=3)
+
+    _, mismatches = check_against_batch(small)
+
+    assert mismatches == []
+    caches = small.health()['dimension_caches']
+    assert set(caches) == {'latest_logs', 'user_referral_statuses', 'referral_rewards',
+                           'paid_transactions', 'user_logs_clean', 'lead_logs_clean'}
+    assert all(cache['entries'] <= 3 for cache in caches.values())
+    assert caches['user_logs_clean']['evictions'] > 0
+    assert caches['user_referral_statuses']['hits'] > 0
+
+
+@pytest.mark.parametrize('value', [['a', 'b'], {'id': 'a'}])
+def test_non_scalar_values_are_rejected(service, value):
+    record = {'referral_id': 'r1', 'referrer_id': value}
+
+    with pytest.raises(RecordError, match='referrer_id'):
+        service.score(record)
+    status, payload = asyncio.run(_route(service, 'POST', '/score', json.dumps(record).encode()))
+    assert status == 400
+    assert 'referrer_id' in payload['error']
@@ -0,0 +1,99 @@
+"""
+Sketch Tests
+Purpose: HyperLogLog error bounds and merge behaviour, reservoir sample size
+         and membership
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from sketches import HLL_PRECISION, HyperLogLog, ReservoirSample
+
+# Three standard errors of the HyperLogLog estimate at the default precision
+HLL_TOLERANCE = 3 * 1.04 / np.sqrt(2 ** HLL_PRECISION)
+
+
+def _strings(start, stop):
+    return pd.Series([f'{n:032x}' for n in range(start, stop)], dtype='str')
+
+
+@pytest.mark.parametrize('distinct', [10, 1_000, 50_000, 300_000])
+def test_hyperloglog_count_within_error_bound(distinct):
+    sketch = HyperLogLog()
+    sketch.add(_strings(0, distinct))
+
+    assert abs(sketch.count() - distinct) <= HLL_TOLERANCE * distinct + 1
+
+
+def test_hyperloglog_ignores_duplicates_and_missing_values():
+    values = _strings(0, 5_000)
+    once, repeated = HyperLogLog(), HyperLogLog()
+    once.add(values)
+    repeated.add(pd.concat([values, values.sample(frac=1, random_state=0), pd.Series([None])]))
+
+    assert np.array_equal(once.registers, repeated.registers)
+
+
+def test_hyperloglog_counts_equal_values_of_different_dtypes_once():
+    ints, floats = HyperLogLog(), HyperLogLog()
+    ints.add(pd.Series(range(1_000), dtype='int64'))
+    floats.add(pd.Series(range(1_000), dtype='Int32'))
+
+    assert np.array_equal(ints.registers, floats.registers)
+
+
+def test_hyperloglog_merge_equals_sketch_of_the_union():
+    # Overlapping chunks, as when chunks of one column are profiled apart
+    left, right, whole = HyperLogLog(), HyperLogLog(), HyperLogLog()
+    left.add(_strings(0, 60_000))
+    right.add(_strings(40_000, 100_000))
+    whole.add(_strings(0, 100_000))
+
+    left.merge(right)
+
+    assert np.array_equal(left.registers, whole.registers)
+    assert abs(left.count() - 100_000) <= HLL_TOLERANCE * 100_000
+
+
+def test_hyperloglog_empty_counts_zero():
+    sketch = HyperLogLog()
+    sketch.add(pd.Series([], dtype='str'))
+
+    assert sketch.count() == 0
+
+
+def test_reservoir_sample_keeps_size_and_draws_from_the_input():
+    sample = ReservoirSample(100, seed=3)
+    for start in range(0, 10_000, 700):
+        sample.add(pd.Series(range(start, min(start + 700, 10_000))))
+
+    assert sample.seen == 10_000
+    assert len(sample.values) == 100
+    assert len(set(sample.values)) == 100
+    assert all(0 <= value < 10_000 for value in sample.values)
+
+
+def test_reservoir_sample_is_roughly_uniform():
+    # Each of 10 equal blocks should hold about a tenth of the sample
+    counts = np.zeros(10)
+    for seed in range(40):
+        sample = ReservoirSample(50, seed=seed)
+        for start in range(0, 1_000, 100):
+            sample.add(pd.Series(range(start, start + 100)))
+        counts += np.bincount(np.array(sample.values) // 100, minlength=10)
+
+    assert counts.min() > 0.6 * counts.mean()
+    assert counts.max() < 1.4 * counts.mean()
+
+
+def test_reservoir_merge_keeps_size_and_counts_everything_seen():
+    left, right = ReservoirSample(20, seed=1), ReservoirSample(20, seed=2)
+    left.add(pd.Series(range(0, 500)))
+    right.add(pd.Series(range(500, 600)))
+
+    left.merge(right)
+
+    assert left.seen == 600
+    assert len(left.values) == 20
+    assert all(0 <= value < 600 for value in left.values)
@@ -0,0 +1,94 @@
+"""
+Velocity Tests
+Purpose: Referrer and location window counts of the sorted in-memory
+         history against direct counting, and of the spilled on-disk history
+         against the in-memory one
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from velocity import LOCATION_WINDOWS, VELOCITY_WINDOWS, ReferrerHistory, SpilledReferrerHistory
+
+
+def _history(seed, rows=300):
+    """Referrals of a few referrers and clubs (one much busier), with ties and missing values"""
+    rng = np.random.default_rng(seed)
+    referrers = np.where(rng.random(rows) < 0.3, 0, rng.integers(1, 25, rows))
+    minutes = rng.integers(0, 60 * 24 * 60, rows) // 7 * 7
+    history = pd.DataFrame({
+        'referrer_id': pd.array(referrers, dtype='Int32'),
+        'referral_at': pd.Timestamp('2024-01-01', tz='UTC') + pd.to_timedelta(minutes, unit='min'),
+        'num_reward_days': np.where(rng.random(rows) < 0.5, rng.integers(1, 40, rows), np.nan),
+        'transaction_location': pd.Categorical(np.where(rng.random(rows) < 0.6, 'BENHIL',
+                                                        rng.choice(['PLUIT', 'BLOK M'], rows))),
+    })
+    history.loc[rng.random(rows) < 0.05, 'referrer_id'] = pd.NA
+    history.loc[rng.random(rows) < 0.2, 'transaction_location'] = np.nan
+    history.loc[rng.random(rows) < 0.05, 'referral_at'] = pd.NaT
+    return history
+
+
+def _naive_features(history, df):
+    """Window counts of each row of df by scanning the whole history"""
+    def inside(rows, at, length):
+        return rows[(rows['referral_at'] > at - length) & (rows['referral_at'] <= at)]
+
+    rows = []
+    for referrer, location, at in zip(df['referrer_id'], df['transaction_location'],
+                                      df['referral_at']):
+        row = {}
+        mine = history[(history['referrer_id'] == referrer).fillna(False)]
+        for window, length in VELOCITY_WINDOWS.items():
+            days = inside(mine, at, length)['num_reward_days'].fillna(0)
+            missing = pd.isna(referrer) or pd.isna(at)
+            row.update({f'referrer_referrals_{window}': None if missing else float(len(days)),
+                        f'referrer_rewarded_{window}': None if missing else float((days > 0).sum()),
+                        f'referrer_reward_days_{window}': None if missing else float(days.sum())})
+        here = history[(history['transaction_location'] == location).fillna(False)]
+        for window, length in LOCATION_WINDOWS.items():
+            missing = pd.isna(location) or pd.isna(at)
+            row[f'location_referrals_{window}'] = (None if missing
+                                                   else float(len(inside(here, at, length))))
+        rows.append(row)
+    return rows
+
+
+def _rows(features):
+    return [{key: None if pd.isna(value) else float(value) for key, value in row.items()}
+            for row in features.to_dict('records')]
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_window_counts_match_direct_counting(seed):
+    history = _history(seed)
+
+    features = ReferrerHistory(history).features(history)
+
+    assert _rows(features) == _naive_features(history, history)
+
+
+@pytest.mark.parametrize('block_rows', [1, 16, 10_000])
+def test_spilled_history_matches_the_in_memory_history(tmp_path, block_rows):
+    history = _history(7)
+    spilled = SpilledReferrerHistory(str(tmp_path), block_rows)
+    for start in range(0, len(history), 45):
+        spilled.add(history.iloc[start:start + 45])
+    spilled.finish()
+
+    # Referrers without history (99) and missing values included
+    lookups = pd.concat([history, history.head(5).assign(referrer_id=99)], ignore_index=True)
+    pd.testing.assert_frame_equal(spilled.features(lookups),
+                                  ReferrerHistory(history).features(lookups))
+
+
+def test_empty_spilled_history_counts_nothing(tmp_path):
+    history = _history(1, rows=10)
+    spilled = SpilledReferrerHistory(str(tmp_path), 4)
+    spilled.finish()
+
+    features = spilled.features(history)
+
+    known = (history['referrer_id'].notna() & history['referral_at'].notna()).to_numpy()
+    assert (features[known].fillna(0) == 0).all().all()